@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+"""
+    Attribute Table
+
+    Store the custom token attributes of a document (e.g. SH, NEG, TIME) in
+    one small integer column per attribute, instead of one doc.user_data
+    entry per token and attribute. Tables are kept outside of the document,
+    which can still be serialised, and are available as doc._.attribute_table
+    while the document exists (the values are not serialised). Each column holds int16 codes into a value
+    vocabulary that is shared by all documents, where code 0 is the default
+    value False, e.g.
+
+        SH: [0, 0, 1, 0, 2]    values: [False, 'SH', 'NON_SH']
+
+    Registered attributes (see register_attributes) can still be read and
+    written as token._.SH etc., and matched in Matcher patterns, through
+    extension getters and setters, while components in the hot path read
+    and write the table directly (see get_attribute_table and set_value).
+
+    spaCy stores extension values by character offset, so when tokens are
+    merged, the merged token keeps the values of its first token. The table
+    behaves the same way: when the number of tokens in a document changes,
+    each token takes the row of the token that started at the same offset,
+    and tokens without one take default values.
+
+    A WindowIndex answers queries such as "is there a NEG token in this
+    window" in constant time, whatever the window size, from the prefix
+    counts of a column mask (see AttributeTable.mask).
+"""
+
+import numpy as np
+
+from spacy.attrs import IDX
+from spacy.tokens import Doc, Token
+from weakref import finalize
+
+
+# the table of each document by document id, removed with the document
+TABLES = {}
+
+# value vocabulary of each attribute, shared by all documents
+VALUES = {}
+CODES = {}
+
+# the getter of each registered attribute
+GETTERS = {}
+
+
+def get_code(name, value):
+    """
+    Get the code of an attribute value, adding the value to the vocabulary
+    of the attribute if needed.
+
+    Arguments:
+        - name: str; the attribute name.
+        - value: object; the value.
+
+    Return:
+        - code: int; the code of the value.
+    """
+    if name not in CODES:
+        CODES[name] = {False: 0}
+        VALUES[name] = [False]
+    codes = CODES[name]
+    code = codes.get(value, None)
+    if code is None:
+        values = VALUES[name]
+        code = len(values)
+        if code > np.iinfo(np.int16).max:
+            raise ValueError('-- Error: too many values for attribute: ' + name)
+        values.append(value)
+        codes[value] = code
+
+    return code
+
+
+class AttributeTable(object):
+    """
+    Attribute Table
+
+    The custom token attribute values of one document.
+    """
+
+    def __init__(self, doc):
+        """
+        Create a new AttributeTable instance.
+
+        Arguments:
+            - doc: spaCy Doc; the document.
+        """
+        self.n_tokens = len(doc)
+        self.offsets = self.get_offsets(doc)
+        self.columns = {}
+
+    def get_offsets(self, doc):
+        """
+        Get the character offset of each token of a document.
+
+        Arguments:
+            - doc: spaCy Doc; the document.
+
+        Return:
+            - offsets: numpy array; the offsets.
+        """
+        if len(doc) == 0:
+            return np.zeros(0, dtype=np.uint64)
+
+        return doc.to_array(IDX)
+
+    def sync(self, doc):
+        """
+        Realign the rows with the tokens of a document that has been
+        retokenized since the table was created or last realigned.
+
+        Arguments:
+            - doc: spaCy Doc; the document.
+        """
+        if len(doc) == self.n_tokens:
+            return
+        offsets = self.get_offsets(doc)
+        rows = np.searchsorted(self.offsets, offsets)
+        found = rows < len(self.offsets)
+        found[found] = self.offsets[rows[found]] == offsets[found]
+        for (name, column) in self.columns.items():
+            new_column = np.zeros(len(doc), dtype=np.int16)
+            new_column[found] = column[rows[found]]
+            self.columns[name] = new_column
+        self.n_tokens = len(doc)
+        self.offsets = offsets
+
+    def column(self, name):
+        """
+        Get the column of an attribute, creating it if needed. The column is
+        a view of the table, i.e. changing a code changes the value.
+
+        Arguments:
+            - name: str; the attribute name.
+
+        Return:
+            - column: numpy array; the int16 codes of the attribute values.
+        """
+        column = self.columns.get(name, None)
+        if column is None:
+            column = np.zeros(self.n_tokens, dtype=np.int16)
+            self.columns[name] = column
+
+        return column
+
+    def get(self, name, i):
+        """
+        Get the value of an attribute for a token.
+
+        Arguments:
+            - name: str; the attribute name.
+            - i: int; the token index.
+
+        Return:
+            - value: object; the value, or False if not set.
+        """
+        column = self.columns.get(name, None)
+        if column is None:
+            return False
+
+        return VALUES[name][column[i]]
+
+    def set(self, name, i, value):
+        """
+        Set the value of an attribute for a token or range of tokens.
+
+        Arguments:
+            - name: str; the attribute name.
+            - i: int or slice; the token index or indexes.
+            - value: object; the value.
+        """
+        self.column(name)[i] = get_code(name, value)
+
+    def find(self, name, values):
+        """
+        Find the tokens with given values of an attribute.
+
+        Arguments:
+            - name: str; the attribute name.
+            - values: list; the values.
+
+        Return:
+            - indexes: list; the token indexes, in document order.
+        """
+        codes = [CODES[name][value] for value in values if value in CODES.get(name, {})]
+        column = self.columns.get(name, None)
+        if column is None or len(codes) == 0:
+            return []
+
+        return np.flatnonzero(np.isin(column, codes)).tolist()
+
+    def mask(self, name, values):
+        """
+        Mark the tokens with given values of an attribute.
+
+        Arguments:
+            - name: str; the attribute name.
+            - values: list; the values.
+
+        Return:
+            - mask: numpy array; True for each token with one of the values,
+                    else False.
+        """
+        codes = [CODES[name][value] for value in values if value in CODES.get(name, {})]
+        column = self.columns.get(name, None)
+        if column is None or len(codes) == 0:
+            return np.zeros(self.n_tokens, dtype=bool)
+
+        return np.isin(column, codes)
+
+
+class WindowIndex(object):
+    """
+    Window Index
+
+    Answer queries about the marked tokens in a window of tokens in constant
+    time, whatever the window size, using the prefix counts of the marked
+    tokens and the position of the next marked token after each token.
+    """
+
+    def __init__(self, mask):
+        """
+        Create a new WindowIndex instance.
+
+        Arguments:
+            - mask: numpy array; True for each marked token, else False.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        n = len(mask)
+        positions = np.where(mask, np.arange(n), n)
+        # lists rather than arrays, as single items are read much faster
+        self.counts = np.concatenate(([0], np.cumsum(mask))).tolist()
+        self.next = np.append(np.minimum.accumulate(positions[::-1])[::-1], n).tolist()
+
+    def count(self, start, end):
+        """
+        Count the marked tokens in a window.
+
+        Arguments:
+            - start: int; the index of the first token of the window.
+            - end: int; the index after the last token of the window.
+
+        Return:
+            - n: int; the number of marked tokens.
+        """
+        if end <= start:
+            return 0
+
+        return self.counts[end] - self.counts[start]
+
+    def any(self, start, end):
+        """
+        Check if a window contains a marked token.
+
+        Arguments:
+            - start: int; the index of the first token of the window.
+            - end: int; the index after the last token of the window.
+
+        Return: bool; True if a marked token is found, else False.
+        """
+        return self.count(start, end) > 0
+
+    def first(self, start, end):
+        """
+        Find the first marked token in a window.
+
+        Arguments:
+            - start: int; the index of the first token of the window.
+            - end: int; the index after the last token of the window.
+
+        Return:
+            - i: int; the index of the first marked token, or None if there
+                 is none.
+        """
+        if end <= start:
+            return None
+        i = self.next[start]
+
+        return i if i < end else None
+
+
+def get_attribute_table(doc):
+    """
+    Get the attribute table of a document, creating it if needed.
+
+    Arguments:
+        - doc: spaCy Doc; the document.
+
+    Return:
+        - table: AttributeTable; the table, aligned with the tokens.
+    """
+    table = TABLES.get(id(doc), None)
+    if table is None:
+        table = AttributeTable(doc)
+        TABLES[id(doc)] = table
+        finalize(doc, TABLES.pop, id(doc), None)
+    else:
+        table.sync(doc)
+
+    return table
+
+
+Doc.set_extension('attribute_table', getter=get_attribute_table, force=True)
+
+
+def make_getter(name):
+    def getter(token):
+        return get_attribute_table(token.doc).get(name, token.i)
+
+    return getter
+
+
+def make_setter(name):
+    def setter(token, value):
+        get_attribute_table(token.doc).set(name, token.i, value)
+
+    return setter
+
+
+def register_attributes(names):
+    """
+    Store custom token attributes in attribute tables. This replaces any
+    previous definition of the extensions, so it must be done after the
+    components that declare them are created.
+
+    Arguments:
+        - names: iterable; the attribute names.
+    """
+    for name in names:
+        if name not in GETTERS:
+            GETTERS[name] = make_getter(name)
+            get_code(name, False)
+        Token.set_extension(name, getter=GETTERS[name], setter=make_setter(name), force=True)
+
+
+def is_registered(name):
+    """
+    Check if a custom token attribute is currently stored in attribute
+    tables.
+
+    Arguments:
+        - name: str; the attribute name.
+
+    Return: bool; True if the attribute is stored in tables, else False.
+    """
+    if name not in GETTERS or not Token.has_extension(name):
+        return False
+
+    return Token.get_extension(name)[2] is GETTERS[name]
+
+
+def set_value(doc, name, start, end, value):
+    """
+    Set the value of a custom attribute for a range of tokens, in the
+    attribute table if the attribute is registered, else with token._.
+
+    Arguments:
+        - doc: spaCy Doc; the document.
+        - name: str; the attribute name.
+        - start: int; the index of the first token.
+        - end: int; the index after the last token.
+        - value: object; the value.
+    """
+    if is_registered(name):
+        get_attribute_table(doc).set(name, slice(start, end), value)
+    else:
+        for token in doc[start:end]:
+            token._.set(name, value)
+
+
+def get_attribute_names(doc):
+    """
+    Get the names of the custom token attributes with values in a document,
+    in attribute tables or in doc.user_data.
+
+    Arguments:
+        - doc: spaCy Doc; the document.
+
+    Return:
+        - names: list; the attribute names, sorted.
+    """
+    names = set()
+    if id(doc) in TABLES:
+        names.update(get_attribute_table(doc).columns.keys())
+    for key in doc.user_data:
+        if isinstance(key, tuple) and len(key) > 1:
+            names.add(key[1])
+
+    return sorted(names)
+
+
+if __name__ == '__main__':
+    import spacy
+    import sys
+
+    from time import time
+
+    nlp = spacy.blank('en')
+    doc = nlp('She took an overdose of paracetamol and cut her arms. ' * 10000)
+    names = ['SH', 'NEG', 'TIME', 'HEDGING', 'MODALITY']
+
+    times = []
+    for registered in [False, True]:
+        if registered:
+            register_attributes(names)
+        else:
+            for name in names:
+                Token.set_extension(name, default=False, force=True)
+        t0 = time()
+        for token in doc:
+            if token.lower_ in ['overdose', 'cut']:
+                token._.SH = 'SH'
+        n = 0
+        for name in names:
+            for token in doc:
+                if token._.get(name) == 'SH':
+                    n += 1
+        times.append(time() - t0)
+        print('-- Registered:', registered, 'mentions:', n, 'time:', round(times[-1], 3), 's', file=sys.stderr)
+
+    t0 = time()
+    table = get_attribute_table(doc)
+    n = len(table.find('SH', ['SH']))
+    print('-- Table lookup, mentions:', n, 'time:', round(time() - t0, 3), 's', file=sys.stderr)
+
+    with doc.retokenize() as retokenizer:
+        retokenizer.merge(doc[3:5])
+    ok = doc[3]._.SH == 'SH' and doc[4]._.SH is False and doc[6]._.SH == 'SH'
+    print('-- Merge check:', 'OK' if ok else 'FAILED', file=sys.stderr)
+
+    try:
+        Doc(nlp.vocab).from_bytes(doc.to_bytes())
+        print('-- Serialisation check: OK', file=sys.stderr)
+    except Exception as e:
+        print('-- Serialisation check: FAILED', e, file=sys.stderr)
+        ok = False
+
+    mask = np.random.RandomState(0).random_sample(1000) < 0.05
+    index = WindowIndex(mask)
+    marked = np.flatnonzero(mask).tolist()
+    window_ok = True
+    for start in range(len(mask)):
+        for end in range(start, min(start + 30, len(mask)) + 1):
+            found = [j for j in marked if start <= j < end]
+            if index.count(start, end) != len(found) or index.first(start, end) != (found[0] if found else None):
+                window_ok = False
+    print('-- Window check:', 'OK' if window_ok else 'FAILED', file=sys.stderr)
+    sys.exit(0 if ok and window_ok else 1)
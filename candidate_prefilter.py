@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""
+    Candidate Prefilter
+
+    Scan raw text for the strings without which no self-harm mention can be
+    annotated, so that documents without any candidate can skip the spaCy
+    pipeline altogether.
+
+    The trigger strings are derived from the assembled pipeline rather than
+    listed by hand. A token is a mention if its SH attribute is 'SH' or
+    'NON_SH'. This attribute is set by lexicons (e.g. sh_lex.txt) and by
+    token sequence rules. Each rule only matches if all of its mandatory
+    pattern tokens match, so one mandatory token per rule is enough: its
+    lemmas or surface forms, or, for a custom attribute value such as
+    LA=HARM_ACTION, recursively the triggers of the lexicons and rules that
+    set the value. A rule that depends on the value being computed (e.g. a
+    rule that extends an existing SH mention) adds no triggers, as some other
+    lexicon or rule must have set the value first.
+
+    A lemma can appear in the text as an inflected form, so each lemma is
+    expanded to the part of it kept by each of spaCy's lemmatizer suffix
+    rules (e.g. 'overdose' -> 'overdos' for 'overdosed'), its irregular forms
+    from the lemmatizer exception and lookup tables (e.g. 'take' -> 'took'),
+    and the surface forms of tokenizer special cases with that lemma (e.g.
+    the detokenization rules).
+
+    All triggers are prefixes of the token text, so they are only matched
+    case-insensitively where a token can start, i.e. not after a letter.
+    The exception are prefixes of the pieces that a tokenizer special case
+    splits off inside a word (e.g. 've' in 'Ive'), which are matched
+    anywhere. Both sets of triggers are matched with one regular expression
+    built from a trie of the trigger strings.
+
+    Use SelfHarmAnnotator.audit_prefilter to check on a corpus that no
+    mention is lost.
+"""
+
+import os
+import re
+import sys
+
+from lexical_annotator import LemmaAnnotator, LexicalAnnotator, LexiconBank
+from spacy.symbols import LEMMA, LOWER, ORTH
+from token_sequence_annotator import TokenSequenceAnnotator
+
+
+# (ending, replacement) pairs of spaCy's English suffix rules, used if the
+# lemmatizer tables cannot be read from the pipeline
+DEFAULT_LEMMA_RULES = [('s', ''), ('ses', 's'), ('ves', 'f'), ('xes', 'x'), ('zes', 'z'), ('ches', 'ch'),
+                       ('shes', 'sh'), ('men', 'man'), ('ies', 'y'), ('es', 'e'), ('es', ''), ('ed', 'e'),
+                       ('ed', ''), ('ing', 'e'), ('ing', ''), ('er', ''), ('est', ''), ('er', 'e'), ('est', 'e')]
+
+# pattern keys that match the surface form or the lemma of a token
+SURFACE_KEYS = ['ORTH', 'TEXT', 'LOWER']
+LEMMA_KEYS = ['LEMMA']
+
+# a token cannot start right after a letter, except inside special cases
+TOKEN_START = r'(?<![^\W\d_])'
+
+
+def build_trie_regex(strings):
+    """
+    Build a regular expression that matches any of a set of strings, with
+    the alternatives nested as in a trie so that matching at each position
+    follows a single path.
+
+    Arguments:
+        - strings: iterable; the strings to match.
+
+    Return:
+        - regex: str; the regular expression.
+    """
+    trie = {}
+    for s in strings:
+        node = trie
+        for c in s:
+            node = node.setdefault(c, {})
+        node[''] = {}
+
+    def to_regex(node):
+        if '' in node:
+            # any string ending here is already a match
+            return ''
+        branches = sorted(node.keys())
+        alternatives = [re.escape(c) + to_regex(node[c]) for c in branches]
+        if len(alternatives) == 1:
+            return alternatives[0]
+
+        return '(?:' + '|'.join(alternatives) + ')'
+
+    if len(trie) == 0:
+        # matches nothing
+        return '(?!)'
+
+    return to_regex(trie)
+
+
+def remove_redundant(prefixes, substrings):
+    """
+    Remove the triggers that never need to be matched: the token prefixes
+    that start with another token prefix or contain another substring
+    trigger, and the substring triggers that contain another one.
+
+    Arguments:
+        - prefixes: iterable; the triggers matched where a token can start.
+        - substrings: iterable; the triggers matched anywhere.
+
+    Return:
+        - prefixes: list; the remaining token prefixes, sorted.
+        - substrings: list; the remaining substring triggers, sorted.
+    """
+    kept_substrings = []
+    for s in sorted(set(substrings), key=len):
+        if not any(k in s for k in kept_substrings):
+            kept_substrings.append(s)
+
+    kept_prefixes = []
+    for s in sorted(set(prefixes), key=len):
+        if not any(s.startswith(k) for k in kept_prefixes) and not any(k in s for k in kept_substrings):
+            kept_prefixes.append(s)
+
+    return sorted(kept_prefixes), sorted(kept_substrings)
+
+
+def get_table(nlp, name):
+    """
+    Get a lemmatizer table from a pipeline, for spaCy versions with and
+    without the lookups API.
+
+    Arguments:
+        - nlp: spaCy Language; the pipeline.
+        - name: str; the table name ('lemma_rules', 'lemma_exc' or
+                'lemma_lookup').
+
+    Return:
+        - table: dict; the table, or an empty dict if it does not exist.
+    """
+    lookups = getattr(nlp.vocab, 'lookups', None)
+    if lookups is not None and lookups.has_table(name):
+        return dict(lookups.get_table(name).items())
+    lemmatizer = getattr(nlp.vocab.morphology, 'lemmatizer', None)
+    attribute = {'lemma_rules': 'rules', 'lemma_exc': 'exc', 'lemma_lookup': 'lookup_table'}[name]
+    if lemmatizer is not None and getattr(lemmatizer, attribute, None):
+        return dict(getattr(lemmatizer, attribute))
+
+    return {}
+
+
+class CandidatePrefilter(object):
+    """
+    Candidate Prefilter
+
+    Decide from the raw text whether a document can contain a mention.
+    """
+
+    def __init__(self, nlp, attribute='SH', values=('SH', 'NON_SH'), verbose=False):
+        """
+        Create a new CandidatePrefilter instance from an assembled pipeline.
+
+        Arguments:
+            - nlp: spaCy Language; the pipeline, with its lexicon and token
+                   sequence components.
+            - attribute: str; the custom token attribute of mentions.
+            - values: list; the attribute values of mentions.
+            - verbose: bool; print all messages.
+        """
+        self.nlp = nlp
+        self.verbose = verbose
+        self.lexicons = []
+        self.rules = []
+        for (_, component) in nlp.pipeline:
+            if isinstance(component, LemmaAnnotator):
+                self.lexicons.append((component.attribute, component.label, LEMMA, component.lemma_sequences, None))
+            elif isinstance(component, LexicalAnnotator):
+                self.lexicons.append((component.target_attribute, component.label, component.source_attribute, component.terms, component.patterns))
+            elif isinstance(component, LexiconBank):
+                for group in component.groups:
+                    self.lexicons.append((group['target_attribute'], group['label'], group['source_attribute'], group['terms'], group['patterns']))
+            elif isinstance(component, TokenSequenceAnnotator):
+                self.rules.extend(component.rules)
+        self.load_lemma_forms()
+
+        triggers = set()
+        for value in values:
+            value_triggers = self.get_value_triggers(attribute, value, frozenset())
+            if value_triggers is None:
+                raise ValueError('-- Error: mentions with ' + attribute + '=' + value + ' can be annotated without any trigger word, the prefilter cannot be used.')
+            triggers |= value_triggers
+
+        substrings = [t for t in triggers if self.is_inner_prefix(t)]
+        prefixes = [t for t in triggers if not self.is_inner_prefix(t)]
+        self.prefixes, self.substrings = remove_redundant(prefixes, substrings)
+        self.regex = re.compile(TOKEN_START + build_trie_regex(self.prefixes) + '|' + build_trie_regex(self.substrings), re.IGNORECASE)
+
+        print('-- Prefilter triggers:', len(self.prefixes), 'token prefixes,', len(self.substrings), 'substrings', file=sys.stderr)
+        if self.verbose:
+            print('  -- Token prefixes: ' + ', '.join(self.prefixes), file=sys.stderr)
+            print('  -- Substrings: ' + ', '.join(self.substrings), file=sys.stderr)
+
+    def __call__(self, text):
+        """
+        Check if a text can contain a mention.
+
+        Arguments:
+            - text: str; the raw text.
+
+        Return: bool; True if the text contains a trigger, else False.
+        """
+        return self.regex.search(text) is not None
+
+    def load_lemma_forms(self):
+        """
+        Collect the lemmatizer suffix rules, the irregular forms of each lemma
+        from the lemmatizer tables and the tokenizer special cases, and the
+        pieces that special cases split off inside a word.
+        """
+        lemma_rules = set()
+        for rules in get_table(self.nlp, 'lemma_rules').values():
+            for (ending, replacement) in rules:
+                if ending != replacement:
+                    lemma_rules.add((ending, replacement))
+        if len(lemma_rules) == 0:
+            print('-- Warning: lemmatizer rules not found, using default rules.', file=sys.stderr)
+            lemma_rules = set(DEFAULT_LEMMA_RULES)
+        self.lemma_rules = sorted(lemma_rules)
+
+        self.lemma_forms = {}
+        for exceptions in get_table(self.nlp, 'lemma_exc').values():
+            for (form, lemmas) in exceptions.items():
+                for lemma in lemmas:
+                    self.lemma_forms.setdefault(lemma.lower(), set()).add(form.lower())
+        for (form, lemma) in get_table(self.nlp, 'lemma_lookup').items():
+            if isinstance(form, str) and isinstance(lemma, str):
+                self.lemma_forms.setdefault(lemma.lower(), set()).add(form.lower())
+
+        self.inner_pieces = set()
+        special_cases = getattr(self.nlp.tokenizer, 'rules', None) or getattr(self.nlp.tokenizer, '_rules', None) or {}
+        for pieces in special_cases.values():
+            for (i, piece) in enumerate(pieces):
+                form = piece.get(ORTH, piece.get('ORTH', None))
+                if not isinstance(form, str):
+                    continue
+                if i > 0:
+                    self.inner_pieces.add(form.lower())
+                lemma = piece.get(LEMMA, piece.get('LEMMA', None))
+                if isinstance(lemma, str):
+                    self.lemma_forms.setdefault(lemma.lower(), set()).add(form.lower())
+
+    def is_inner_prefix(self, trigger):
+        """
+        Check if a trigger can start inside a word, i.e. if it is a prefix of
+        a piece split off inside a word by a tokenizer special case, or does
+        not start with a letter.
+
+        Arguments:
+            - trigger: str; the trigger.
+
+        Return: bool; True if the trigger must be matched anywhere.
+        """
+        if not trigger[0].isalpha():
+            return True
+
+        return any(piece.startswith(trigger) for piece in self.inner_pieces)
+
+    def get_lemma_triggers(self, lemma):
+        """
+        Get the strings of which at least one starts any token with a given
+        lemma.
+
+        Arguments:
+            - lemma: str; the lemma. For merged tokens, whose lemma is the
+                     text of the span, only the first word is used.
+
+        Return:
+            - triggers: set; the trigger strings.
+        """
+        words = lemma.lower().split()
+        if len(words) == 0:
+            return set()
+        lemma = words[0]
+        triggers = set([lemma])
+        for (ending, replacement) in self.lemma_rules:
+            if lemma.endswith(replacement):
+                # the token is stem + ending, with the lemma stem + replacement
+                stem = lemma[:len(lemma) - len(replacement)]
+                kept = os.path.commonprefix([ending, replacement])
+                triggers.add(stem + kept if stem + kept != '' else ending)
+        triggers |= self.lemma_forms.get(lemma, set())
+
+        return set(t for t in triggers if t != '')
+
+    def get_term_triggers(self, term, source_attribute, pattern):
+        """
+        Get the triggers of a lexicon term, from its most selective token.
+
+        Arguments:
+            - term: str; the term (or lemma sequence).
+            - source_attribute: spaCy symbol; the attribute the term is
+                                matched on.
+            - pattern: spaCy Doc; the tokenized term, if matched on a surface
+                       attribute.
+
+        Return:
+            - triggers: set; the trigger strings, or None if the term is
+                        matched on an attribute that does not determine the
+                        text of the tokens.
+        """
+        if source_attribute == LEMMA:
+            words = term.split() if isinstance(term, str) else term
+            return self.select_triggers([self.get_lemma_triggers(word) for word in words])
+        if source_attribute in [ORTH, LOWER]:
+            if pattern is None:
+                pattern = self.nlp.make_doc(term)
+            return self.select_triggers([set([token.lower_]) for token in pattern if token.lower_.strip() != ''])
+
+        return None
+
+    def get_value_triggers(self, attribute, value, visiting):
+        """
+        Get the triggers of a custom attribute value, from the lexicons and
+        the rules that set it.
+
+        Arguments:
+            - attribute: str; the custom attribute.
+            - value: str; the attribute value.
+            - visiting: frozenset; the (attribute, value) pairs being
+                        computed, which add no triggers.
+
+        Return:
+            - triggers: set; the trigger strings, or None if the value can be
+                        set without any trigger.
+        """
+        if (attribute, value) in visiting:
+            return set()
+        visiting = visiting | set([(attribute, value)])
+
+        triggers = set()
+        for (target_attribute, label, source_attribute, terms, patterns) in self.lexicons:
+            if target_attribute != attribute or label != value:
+                continue
+            for (i, term) in enumerate(terms):
+                term_triggers = self.get_term_triggers(term, source_attribute, patterns[i] if patterns is not None else None)
+                if term_triggers is None:
+                    if self.verbose:
+                        print('-- Warning: lexicon term without trigger for', attribute + '=' + value + ':', term, file=sys.stderr)
+                    return None
+                triggers |= term_triggers
+
+        for rule in self.rules:
+            sets_value = False
+            for avm in rule['avm'].values():
+                if avm.get(attribute, None) == value:
+                    sets_value = True
+            if not sets_value:
+                continue
+            rule_triggers = self.get_rule_triggers(rule, visiting)
+            if rule_triggers is None:
+                if self.verbose:
+                    print('-- Warning: rule without trigger for', attribute + '=' + value + ':', rule['name'], file=sys.stderr)
+                return None
+            triggers |= rule_triggers
+
+        return triggers
+
+    def get_rule_triggers(self, rule, visiting):
+        """
+        Get the triggers of a token sequence rule, from its most selective
+        mandatory token.
+
+        Arguments:
+            - rule: dict; the rule.
+            - visiting: frozenset; see get_value_triggers.
+
+        Return:
+            - triggers: set; the trigger strings, or None if no mandatory
+                        token has triggers.
+        """
+        candidates = []
+        for token in rule['pattern']:
+            if token.get('OP', '1') in ['?', '*', '!']:
+                continue
+            token_triggers = self.get_token_triggers(token, visiting)
+            if token_triggers is not None:
+                candidates.append(token_triggers)
+
+        return self.select_triggers(candidates)
+
+    def get_token_triggers(self, token, visiting):
+        """
+        Get the triggers of a token pattern, from its most selective
+        constraint.
+
+        Arguments:
+            - token: dict; the token pattern.
+            - visiting: frozenset; see get_value_triggers.
+
+        Return:
+            - triggers: set; the trigger strings, or None if the constraints
+                        do not determine the text of the token.
+        """
+        candidates = []
+        for (key, constraint) in token.items():
+            if key == '_':
+                for (attribute, value) in constraint.items():
+                    values = self.get_constraint_values(value)
+                    if values is None:
+                        continue
+                    triggers = set()
+                    for v in values:
+                        value_triggers = self.get_value_triggers(attribute, v, visiting)
+                        if value_triggers is None:
+                            triggers = None
+                            break
+                        triggers |= value_triggers
+                    if triggers is not None:
+                        candidates.append(triggers)
+            elif isinstance(key, str) and (key.upper() in LEMMA_KEYS or key.upper() in SURFACE_KEYS):
+                values = self.get_constraint_values(constraint)
+                if values is None:
+                    continue
+                triggers = set()
+                for v in values:
+                    if key.upper() in LEMMA_KEYS:
+                        triggers |= self.get_lemma_triggers(v)
+                    elif v.strip() != '':
+                        # merged tokens start with their first word
+                        triggers.add(v.lower().split()[0])
+                if len(triggers) > 0:
+                    candidates.append(triggers)
+
+        return self.select_triggers(candidates)
+
+    def get_constraint_values(self, constraint):
+        """
+        Get the values allowed by a token attribute constraint.
+
+        Arguments:
+            - constraint: object; a value, or a dict such as {'IN': [...]}.
+
+        Return:
+            - values: list; the string values, or None if the constraint does
+                      not list them (e.g. REGEX or NOT_IN).
+        """
+        if isinstance(constraint, str):
+            return [constraint]
+        if isinstance(constraint, dict) and list(constraint.keys()) == ['IN']:
+            if all(isinstance(v, str) for v in constraint['IN']):
+                return constraint['IN']
+
+        return None
+
+    def get_selectivity(self, triggers):
+        """
+        Estimate how rarely a set of triggers matches: by its shortest
+        trigger, counting triggers matched anywhere as shorter, then by the
+        number of triggers.
+
+        Arguments:
+            - triggers: set; the trigger strings.
+
+        Return:
+            - key: tuple; a sort key, higher is more selective.
+        """
+        if len(triggers) == 0:
+            # set by a value being computed, never matches on its own
+            return (float('inf'), 0)
+
+        return (min([len(t) - 2 if self.is_inner_prefix(t) else len(t) for t in triggers]), -len(triggers))
+
+    def select_triggers(self, candidates):
+        """
+        Select the most selective set of triggers.
+
+        Arguments:
+            - candidates: list; sets of triggers, any of which is sufficient.
+
+        Return:
+            - triggers: set; the selected triggers, or None if there are no
+                        candidates.
+        """
+        if len(candidates) == 0:
+            return None
+
+        return max(candidates, key=self.get_selectivity)
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+    eHOST Reader
+
+    Read annotations from eHOST XML files (.knowtator.xml) for evaluation.
+    Files are parsed incrementally with ElementTree's iterparse, optionally
+    in a process pool, and the parsed mentions can be cached in an SQLite
+    index keyed by file path, modification time and size, so that repeated
+    evaluations over the same system or gold directories only parse files
+    that are new or have changed.
+
+    The annotations of a file are returned in the format of
+    ehost_annotation_reader.load_mentions_with_attributes, i.e. a dictionary
+    keyed by file path of the mentions of the file, which are keyed by
+    mention id, each with the keys 'annotator', 'class', 'comment', 'start',
+    'end' and 'text', and one key for each slot (e.g. 'polarity'), so they
+    can be passed to convert_file_annotations as before.
+
+    Run this file to check the reader on files written by ehost_writer,
+    against load_mentions_with_attributes if available, and to benchmark
+    serial, parallel and cached reading.
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import xml.etree.ElementTree as ET
+import zlib
+
+from multiprocessing import Pool
+from time import time
+
+
+def parse_ehost_xml(pin):
+    """
+    Parse the annotations of an eHOST XML file.
+
+    Arguments:
+        - pin: str; the path to the file.
+
+    Return:
+        - mentions: dict; the mentions, keyed by mention id, in the order of
+                    the file.
+    """
+    mentions = {}
+    class_mentions = {}
+    slot_mentions = {}
+    try:
+        for (_, elem) in ET.iterparse(pin, events=('end',)):
+            tag = elem.tag
+            if tag == 'annotation':
+                spans = elem.findall('span')
+                mention_id = elem.find('mention').get('id')
+                mentions[mention_id] = {'annotator': elem.findtext('annotator'),
+                                        'class': None,
+                                        'comment': elem.findtext('annotationComment'),
+                                        'start': spans[0].get('start') if len(spans) > 0 else None,
+                                        'end': spans[-1].get('end') if len(spans) > 0 else None,
+                                        'text': elem.findtext('spannedText')
+                                        }
+                elem.clear()
+            elif tag == 'classMention':
+                mention_class = elem.find('mentionClass')
+                class_mentions[elem.get('id')] = (mention_class.get('id') if mention_class is not None else None,
+                                                  [slot.get('id') for slot in elem.findall('hasSlotMention')])
+                elem.clear()
+            elif tag == 'stringSlotMention':
+                slot = elem.find('mentionSlot')
+                value = elem.find('stringSlotMentionValue')
+                if slot is not None and value is not None:
+                    slot_mentions[elem.get('id')] = (slot.get('id'), value.get('value'))
+                elem.clear()
+    except ET.ParseError as e:
+        raise ValueError('-- Error: cannot parse file: ' + pin + ' (' + str(e) + ')')
+
+    for (mention_id, mention) in mentions.items():
+        if mention_id not in class_mentions:
+            continue
+        (mention_class, slot_ids) = class_mentions[mention_id]
+        mention['class'] = mention_class
+        for slot_id in slot_ids:
+            if slot_id in slot_mentions:
+                (slot, value) = slot_mentions[slot_id]
+                mention[slot] = value
+
+    return mentions
+
+
+class EhostCache(object):
+    """
+    eHOST Cache
+
+    Store and look up the parsed mentions of eHOST files. An entry is only
+    used if the modification time and size of the file are unchanged.
+    """
+
+    def __init__(self, path, chunk_size=500):
+        """
+        Create a new EhostCache instance.
+
+        Arguments:
+            - path: str; the path to the SQLite database file.
+            - chunk_size: int; the number of files in each lookup query.
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+
+        dirname = os.path.dirname(path)
+        if dirname != '':
+            os.makedirs(dirname, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                'path TEXT PRIMARY KEY, '
+                                'mtime INTEGER NOT NULL, '
+                                'size INTEGER NOT NULL, '
+                                'mentions BLOB NOT NULL)')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self.connection.close()
+
+    def get_many(self, stats):
+        """
+        Look up the mentions of files.
+
+        Arguments:
+            - stats: dict; the (mtime, size) of each absolute file path.
+
+        Return:
+            - results: dict; the mentions of each file with an up-to-date
+                       entry. Other files are omitted.
+        """
+        paths = list(stats.keys())
+        results = {}
+        for start in range(0, len(paths), self.chunk_size):
+            chunk = paths[start:start + self.chunk_size]
+            query = 'SELECT path, mtime, size, mentions FROM files WHERE path IN (' + ', '.join(['?'] * len(chunk)) + ')'
+            for (path, mtime, size, mentions) in self.connection.execute(query, chunk):
+                if stats[path] == (mtime, size):
+                    results[path] = json.loads(zlib.decompress(mentions).decode('utf-8'))
+
+        return results
+
+    def put_many(self, rows):
+        """
+        Store the mentions of files, and commit.
+
+        Arguments:
+            - rows: list; (path, (mtime, size), mentions) tuples.
+        """
+        self.connection.executemany('INSERT OR REPLACE INTO files (path, mtime, size, mentions) VALUES (?, ?, ?, ?)',
+                                    [(path, mtime, size, zlib.compress(json.dumps(mentions, separators=(',', ':')).encode('utf-8')))
+                                     for (path, (mtime, size), mentions) in rows])
+        self.connection.commit()
+
+
+def load_ehost_files(files, cache_path=None, n_process=1, chunksize=16, commit_size=1000):
+    """
+    Load the mentions of eHOST files, parsing only the files that are not in
+    the cache.
+
+    Arguments:
+        - files: list; the paths to the eHOST XML files.
+        - cache_path: str; the path to the cache database. If None, no cache
+                      is used.
+        - n_process: int; the number of worker processes used for parsing.
+        - chunksize: int; the number of files sent to a worker at a time.
+        - commit_size: int; the number of parsed files cached at once.
+
+    Return:
+        - mentions: dict; the annotations of each file, keyed by the paths as
+                    given, in the format of load_mentions_with_attributes,
+                    i.e. {path: {path: {mention_id: mention}}}.
+    """
+    paths = {}
+    for f in files:
+        paths[f] = os.path.abspath(f)
+    stats = {}
+    for path in paths.values():
+        st = os.stat(path)
+        stats[path] = (st.st_mtime_ns, st.st_size)
+
+    cache = None
+    parsed = {}
+    if cache_path is not None:
+        cache = EhostCache(cache_path)
+        parsed = cache.get_many(stats)
+    todo = [path for path in stats if path not in parsed]
+    print('-- eHOST files:', len(stats), 'cached:', len(parsed), 'to parse:', len(todo), file=sys.stderr)
+
+    try:
+        if n_process > 1 and len(todo) > chunksize:
+            pool = Pool(n_process)
+            results = pool.imap(parse_ehost_xml, todo, chunksize=chunksize)
+        else:
+            pool = None
+            results = map(parse_ehost_xml, todo)
+        rows = []
+        for (path, mentions) in zip(todo, results):
+            parsed[path] = mentions
+            if cache is not None:
+                rows.append((path, stats[path], mentions))
+                if len(rows) >= commit_size:
+                    cache.put_many(rows)
+                    rows = []
+        if cache is not None:
+            cache.put_many(rows)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if cache is not None:
+            cache.close()
+
+    return {f: {f: parsed[path]} for (f, path) in paths.items()}
+
+
+def check_files(out_dir, n_files=500):
+    """
+    Write random annotations with ehost_writer and check that they are read
+    back unchanged.
+
+    Arguments:
+        - out_dir: str; the directory in which to write the files.
+        - n_files: int; the number of files.
+
+    Return:
+        - ok: bool; True if all annotations are read back unchanged, else
+              False.
+        - files: list; the paths to the files.
+    """
+    import random
+
+    from ehost_writer import ATTRIBUTES, random_annotations, write_ehost_xml
+
+    rng = random.Random(0)
+    ok = True
+    files = []
+    expected = {}
+    for n in range(n_files):
+        annotations = random_annotations(rng, rng.randint(0, 20))
+        pout = os.path.join(out_dir, 'doc_' + str(n) + '.knowtator.xml')
+        if write_ehost_xml(pout, 'doc_' + str(n) + '.txt', annotations) is None:
+            continue
+        mentions = {}
+        for (i, annotation_id) in enumerate(sorted(annotations.keys())):
+            annotation = annotations[annotation_id]
+            mention = {'annotator': annotation['annotator'],
+                       'class': annotation['class'],
+                       'comment': annotation.get('comment', None),
+                       'start': annotation['start'],
+                       'end': annotation['end'],
+                       'text': annotation['text'].replace('\r\n', '\n').replace('\r', '\n')}
+            for (slot, default) in ATTRIBUTES:
+                mention[slot] = annotation.get(slot, default)
+            mentions['EHOST_Instance_' + str(i + 1)] = mention
+        files.append(pout)
+        expected[pout] = mentions
+
+    for (pin, annotations) in load_ehost_files(files).items():
+        if annotations != {pin: expected[pin]}:
+            print('-- Error: mentions differ for:', pin, file=sys.stderr)
+            ok = False
+
+    print('-- Checked', len(files), 'files:', 'OK' if ok else 'FAILED', file=sys.stderr)
+
+    return ok, files
+
+
+def compare_readers(files):
+    """
+    Check that the annotations of files are the same as those loaded with
+    ehost_annotation_reader.load_mentions_with_attributes, one file at a
+    time.
+
+    Arguments:
+        - files: list; the paths to the eHOST XML files.
+
+    Return:
+        - ok: bool; True if all annotations are the same, else False.
+    """
+    from ehost_annotation_reader import load_mentions_with_attributes
+
+    ok = True
+    for (pin, annotations) in load_ehost_files(files).items():
+        expected = load_mentions_with_attributes(pin)
+        if annotations != expected:
+            print('-- Error: annotations differ from load_mentions_with_attributes for:', pin, file=sys.stderr)
+            ok = False
+
+    print('-- Compared', len(files), 'files with load_mentions_with_attributes:', 'OK' if ok else 'FAILED', file=sys.stderr)
+
+    return ok
+
+
+def benchmark(files, cache_path, n_process=4):
+    """
+    Time serial, parallel and cached reading.
+
+    Arguments:
+        - files: list; the paths to the eHOST XML files.
+        - cache_path: str; the path to the cache database.
+        - n_process: int; the number of worker processes.
+    """
+    t0 = time()
+    load_ehost_files(files)
+    t1 = time()
+    load_ehost_files(files, n_process=n_process)
+    t2 = time()
+    load_ehost_files(files, cache_path=cache_path)
+    t3 = time()
+    load_ehost_files(files, cache_path=cache_path)
+    t4 = time()
+
+    print('-- Serial          :', len(files), 'files in', round(t1 - t0, 4), 's', file=sys.stderr)
+    print('-- Parallel (' + str(n_process) + ')    :', len(files), 'files in', round(t2 - t1, 4), 's', file=sys.stderr)
+    print('-- Filling cache   :', len(files), 'files in', round(t3 - t2, 4), 's', file=sys.stderr)
+    print('-- Cached          :', len(files), 'files in', round(t4 - t3, 4), 's', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ok, files = check_files(tmp_dir)
+        try:
+            ok = compare_readers(files) and ok
+        except ImportError:
+            print('-- Warning: ehost_annotation_reader not found, readers not compared', file=sys.stderr)
+        benchmark(files, os.path.join(tmp_dir, 'ehost_cache.sqlite'))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+    eHOST Writer
+
+    Serialise annotations in the eHOST XML stand-off format (.knowtator.xml)
+    without building an ElementTree and re-parsing it with minidom. The output
+    is identical to serialising the tree with ElementTree, parsing it with
+    xml.dom.minidom and pretty-printing it with toprettyxml(indent='\t'), which
+    is what SelfHarmAnnotator.write_ehost_output did previously:
+
+        - the declaration is '<?xml version="1.0" ?>';
+        - empty elements are written as '<tag/>';
+        - elements that only contain text are written on a single line;
+        - '&', '<', '>' and '"' are escaped in text and attribute values;
+        - line breaks in text are normalised to '\n' as by the XML parser.
+
+    Text containing characters that are not allowed in XML 1.0 made the
+    minidom round-trip fail, and no file was written. Such texts are detected
+    up front, and no output is produced for them either.
+
+    The round-trip also failed for any non-ASCII text, as the 'utf8' encoding
+    declared by ElementTree is not recognised by the XML parser. Such
+    documents are now written, encoded as UTF-8.
+
+    Run this file to check the output against the ElementTree/minidom
+    round-trip on random annotations and to benchmark both.
+"""
+
+import random
+import re
+import sys
+import xml.etree.ElementTree as ET
+
+from datetime import datetime
+from time import time
+from xml.dom.minidom import parseString
+from xml.parsers.expat import ExpatError
+
+
+# characters that are not allowed in XML 1.0 documents
+XML_INVALID_CHARS = re.compile('[^\x09\x0A\x0D\x20-\uD7FF\uE000-\uFFFD\U00010000-\U0010FFFF]')
+
+ATTRIBUTES = [('sh_type', 'SELF-HARM'), ('polarity', 'POSITIVE'), ('status', 'NON-RELEVANT'), ('temporality', 'CURRENT')]
+
+
+def escape(data):
+    """
+    Escape text or an attribute value as minidom does.
+
+    Arguments:
+        - data: str; the text to escape.
+
+    Return:
+        - data: str; the escaped text.
+    """
+    return data.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+
+def get_creation_date():
+    """
+    Get the eHOST creation date for the current time.
+
+    Return: str; the formatted date.
+    """
+    return datetime.now().strftime('%a %b %d %H:%M:%S %Z%Y')
+
+
+def escape_text(data):
+    """
+    Escape text as minidom does after the text has been parsed, i.e. with
+    line breaks normalised to '\n'.
+
+    Arguments:
+        - data: str; the text to escape.
+
+    Return:
+        - data: str; the escaped text.
+    """
+    return escape(data.replace('\r\n', '\n').replace('\r', '\n'))
+
+
+def element(indent, tag, attributes, text, newl):
+    """
+    Serialise an element without child elements as minidom's 
+    Element.writexml does.
+
+    Arguments:
+        - indent: str; the indentation of the element.
+        - tag: str; the tag name.
+        - attributes: list; (name, value) pairs.
+        - text: str; the text content, or None.
+        - newl: str; the newline string.
+
+    Return:
+        - xml: str; the serialised element.
+    """
+    s = indent + '<' + tag
+    for (name, value) in attributes:
+        s += ' ' + name + '="' + escape(value) + '"'
+    if text:
+        return s + '>' + escape_text(text) + '</' + tag + '>' + newl
+
+    return s + '/>' + newl
+
+
+def iter_ehost_xml(text_source, annotations, creation_date, compact=False):
+    """
+    Serialise annotations as an eHOST XML document, one annotation at a time.
+    The output is that of minidom's Document.toprettyxml(indent='\t'), or of
+    Document.toxml() in compact mode.
+
+    Arguments:
+        - text_source: str; the name of the annotated text file.
+        - annotations: dict; the dictionary of detected annotations.
+        - creation_date: str; the creation date of all annotations.
+        - compact: bool; omit indentation and line breaks.
+
+    Return:
+        - generator; strings of XML.
+    """
+    if compact:
+        i1, i2, i3, newl = '', '', '', ''
+    else:
+        i1, i2, i3, newl = '\t', '\t\t', '\t\t\t', '\n'
+
+    yield '<?xml version="1.0" ?>' + newl
+    yield '<annotations textSource="' + escape(text_source) + '">' + newl
+
+    n = 1
+    m = 1000
+    for annotation_id in sorted(annotations.keys()):
+        annotation = annotations[annotation_id]
+        mention_id = 'EHOST_Instance_' + str(n)
+
+        s = [i1 + '<annotation>' + newl,
+             element(i2, 'mention', [('id', mention_id)], None, newl),
+             element(i2, 'annotator', [('id', 'eHOST_2010')], annotation['annotator'], newl),
+             element(i2, 'spannedText', [], annotation['text'], newl)]
+        if annotation.get('comment', None) is not None:
+            s.append(element(i2, 'annotationComment', [], annotation['comment'], newl))
+        s.append(element(i2, 'creationDate', [], creation_date, newl))
+        s.append(element(i2, 'span', [('start', annotation['start']), ('end', annotation['end'])], None, newl))
+        s.append(i1 + '</annotation>' + newl)
+
+        s.append(i1 + '<classMention id="' + mention_id + '">' + newl)
+        s.append(element(i2, 'mentionClass', [('id', annotation['class'])], annotation['text'], newl))
+        slot_mentions = []
+        for (slot, default) in ATTRIBUTES:
+            slot_id = 'EHOST_Instance_' + str(m)
+            s.append(i2 + '<hasSlotMention id="' + slot_id + '"/>' + newl)
+            slot_mentions.append(i1 + '<stringSlotMention id="' + slot_id + '">' + newl +
+                                 i2 + '<mentionSlot id="' + slot + '"/>' + newl +
+                                 element(i2, 'stringSlotMentionValue', [('value', annotation.get(slot, default))], None, newl) +
+                                 i1 + '</stringSlotMention>' + newl)
+            m += 1
+        s.append(i1 + '</classMention>' + newl)
+        s.extend(slot_mentions)
+
+        n += 1
+        yield ''.join(s)
+
+    # Create Adjudication status with default values
+    s = [i1 + '<eHOST_Adjudication_Status version="1.0">' + newl,
+         i2 + '<Adjudication_Selected_Annotators version="1.0"/>' + newl,
+         i2 + '<Adjudication_Selected_Classes version="1.0"/>' + newl,
+         i2 + '<Adjudication_Others>' + newl]
+    for tag in ['CHECK_OVERLAPPED_SPANS', 'CHECK_ATTRIBUTES', 'CHECK_RELATIONSHIP', 'CHECK_CLASS', 'CHECK_COMMENT']:
+        s.append(i3 + '<' + tag + '>false</' + tag + '>' + newl)
+    s.append(i2 + '</Adjudication_Others>' + newl)
+    s.append(i1 + '</eHOST_Adjudication_Status>' + newl)
+    s.append('</annotations>' + newl)
+    yield ''.join(s)
+
+
+def get_ehost_xml(text_source, annotations, creation_date=None, compact=False):
+    """
+    Serialise annotations as an eHOST XML string.
+
+    Arguments:
+        - text_source: str; the name of the annotated text file.
+        - annotations: dict; the dictionary of detected annotations.
+        - creation_date: str; the creation date of all annotations. If None,
+                         the current time is used.
+        - compact: bool; omit indentation and line breaks.
+
+    Return:
+        - xml: str; the XML document, or None if the annotations contain
+               characters that are not allowed in XML.
+    """
+    if creation_date is None:
+        creation_date = get_creation_date()
+    xml = ''.join(iter_ehost_xml(text_source, annotations, creation_date, compact))
+    # escaping never adds invalid characters, so check the output once
+    if XML_INVALID_CHARS.search(xml) is not None:
+        return None
+
+    return xml
+
+
+def write_ehost_xml(pout, text_source, annotations, creation_date=None, compact=False):
+    """
+    Write annotations to an eHOST XML file.
+
+    Arguments:
+        - pout: str; the output file path.
+        - text_source: str; the name of the annotated text file.
+        - annotations: dict; the dictionary of detected annotations.
+        - creation_date: str; the creation date of all annotations. If None,
+                         the current time is used.
+        - compact: bool; omit indentation and line breaks.
+
+    Return:
+        - xml: str; the XML document, or None if the annotations contain
+               characters that are not allowed in XML, in which case no
+               file is written.
+    """
+    xml = get_ehost_xml(text_source, annotations, creation_date, compact)
+    if xml is None:
+        return None
+
+    with open(pout, 'w', encoding='utf-8') as fout:
+        fout.write(xml)
+
+    return xml
+
+
+def get_ehost_xml_minidom(text_source, annotations, creation_date, encoding='utf8', compact=False):
+    """
+    Serialise annotations with ElementTree and minidom, as was done before
+    this module was added. Used for testing.
+
+    Arguments:
+        - text_source: str; the name of the annotated text file.
+        - annotations: dict; the dictionary of detected annotations.
+        - creation_date: str; the creation date of all annotations.
+        - encoding: str; the encoding used by ElementTree. The previous 
+                    encoding ('utf8') fails for non-ASCII text.
+        - compact: bool; use toxml() instead of toprettyxml().
+
+    Return:
+        - xml: str; the XML document, or None if it cannot be parsed.
+    """
+    root = ET.Element('annotations')
+    root.attrib['textSource'] = text_source
+    n = 1
+    m = 1000
+    for annotation_id in sorted(annotations.keys()):
+        annotation = annotations[annotation_id]
+        annotation_node = ET.SubElement(root, 'annotation')
+        mention = ET.SubElement(annotation_node, 'mention')
+        mention_id = 'EHOST_Instance_' + str(n)
+        mention.attrib['id'] = mention_id
+        annotator = ET.SubElement(annotation_node, 'annotator')
+        annotator.attrib['id'] = 'eHOST_2010'
+        annotator.text = annotation['annotator']
+        spanned_text = ET.SubElement(annotation_node, 'spannedText')
+        if annotation.get('comment', None) is not None:
+            comment = ET.SubElement(annotation_node, 'annotationComment')
+            comment.text = annotation['comment']
+        ET.SubElement(annotation_node, 'creationDate').text = creation_date
+        span = ET.SubElement(annotation_node, 'span')
+        span.attrib['start'] = annotation['start']
+        span.attrib['end'] = annotation['end']
+        spanned_text.text = annotation['text']
+        class_mention = ET.SubElement(root, 'classMention')
+        class_mention.attrib['id'] = mention_id
+        mention_class_node = ET.SubElement(class_mention, 'mentionClass')
+        mention_class_node.attrib['id'] = annotation['class']
+        mention_class_node.text = annotation['text']
+        for (slot, default) in ATTRIBUTES:
+            slot_mention_node = ET.SubElement(root, 'stringSlotMention')
+            slot_mention_node.attrib['id'] = 'EHOST_Instance_' + str(m)
+            ET.SubElement(slot_mention_node, 'mentionSlot').attrib['id'] = slot
+            ET.SubElement(slot_mention_node, 'stringSlotMentionValue').attrib['value'] = annotation.get(slot, default)
+            ET.SubElement(class_mention, 'hasSlotMention').attrib['id'] = 'EHOST_Instance_' + str(m)
+            m += 1
+        n += 1
+    adj_status = ET.SubElement(root, 'eHOST_Adjudication_Status')
+    adj_status.attrib['version'] = '1.0'
+    ET.SubElement(adj_status, 'Adjudication_Selected_Annotators').attrib['version'] = '1.0'
+    ET.SubElement(adj_status, 'Adjudication_Selected_Classes').attrib['version'] = '1.0'
+    adj_o = ET.SubElement(adj_status, 'Adjudication_Others')
+    for tag in ['CHECK_OVERLAPPED_SPANS', 'CHECK_ATTRIBUTES', 'CHECK_RELATIONSHIP', 'CHECK_CLASS', 'CHECK_COMMENT']:
+        ET.SubElement(adj_o, tag).text = 'false'
+
+    try:
+        pxmlstr = parseString(ET.tostring(root, encoding=encoding, method='xml'))
+    except ExpatError:
+        return None
+
+    if compact:
+        return pxmlstr.toxml()
+
+    return pxmlstr.toprettyxml(indent='\t')
+
+
+def random_annotations(rng, n_annotations):
+    """
+    Create random annotations, including texts with markup characters, line
+    breaks and characters that are not allowed in XML.
+
+    Arguments:
+        - rng: Random; the random number generator.
+        - n_annotations: int; the number of annotations.
+
+    Return:
+        - annotations: dict; the annotations.
+    """
+    alphabet = 'ab c&<>"\'\t\n\r\r\né’' + ('\x01' if rng.random() < 0.05 else '')
+    annotations = {}
+    for n in range(n_annotations):
+        start = rng.randint(0, 10000)
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+        annotation = {'annotator': rng.choice(['SH annotator', '']),
+                      'class': 'Self-harm',
+                      'start': str(start),
+                      'end': str(start + len(text)),
+                      'text': text}
+        if rng.random() < 0.3:
+            annotation['comment'] = rng.choice(['', 'a comment', 'x < y & "z"'])
+        for (slot, _) in ATTRIBUTES:
+            if rng.random() < 0.5:
+                annotation[slot] = rng.choice(['POSITIVE', 'NEGATIVE', 'A&B'])
+        annotations['ann_' + str(n)] = annotation
+
+    return annotations
+
+
+def check_output(n_tests=2000):
+    """
+    Check that the output is identical to the ElementTree/minidom round-trip
+    on random annotations.
+
+    Arguments:
+        - n_tests: int; the number of random documents.
+
+    Return: bool; True if all outputs are identical, else False.
+    """
+    rng = random.Random(0)
+    creation_date = get_creation_date()
+    for _ in range(n_tests):
+        annotations = random_annotations(rng, rng.randint(0, 5))
+        expected = get_ehost_xml_minidom('test&"1".txt', annotations, creation_date)
+        output = get_ehost_xml('test&"1".txt', annotations, creation_date)
+        if expected is None and output is not None and not output.isascii():
+            expected = get_ehost_xml_minidom('test&"1".txt', annotations, creation_date, encoding='utf-8')
+        if output != expected:
+            print('-- Error: output differs for:', annotations, file=sys.stderr)
+            return False
+        if output is not None:
+            compact = get_ehost_xml('test&"1".txt', annotations, creation_date, compact=True)
+            if compact != get_ehost_xml_minidom('test&"1".txt', annotations, creation_date, encoding='utf-8', compact=True):
+                print('-- Error: compact output differs for:', annotations, file=sys.stderr)
+                return False
+
+    print('-- Checked', n_tests, 'random documents: OK', file=sys.stderr)
+
+    return True
+
+
+def benchmark(n_docs=2000, n_annotations=10):
+    """
+    Time the writer and the ElementTree/minidom round-trip.
+
+    Arguments:
+        - n_docs: int; the number of documents.
+        - n_annotations: int; the number of annotations per document.
+    """
+    rng = random.Random(1)
+    docs = [random_annotations(rng, n_annotations) for _ in range(n_docs)]
+    creation_date = get_creation_date()
+
+    t0 = time()
+    for annotations in docs:
+        get_ehost_xml('test.txt', annotations, creation_date)
+    t1 = time()
+    for annotations in docs:
+        get_ehost_xml_minidom('test.txt', annotations, creation_date)
+    t2 = time()
+
+    print('-- eHOST writer   :', n_docs, 'documents in', round(t1 - t0, 4), 's', file=sys.stderr)
+    print('-- ET and minidom :', n_docs, 'documents in', round(t2 - t1, 4), 's', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    ok = check_output()
+    benchmark()
+    sys.exit(0 if ok else 1)
@@ -2,13 +2,21 @@
 """
     This is a utility script to calculate agreement for Karyn Ayre's project.
 """
+import hashlib
+import os
 import pandas as pd
+import pickle
+import sys
 
 from ehost_annotation_reader import convert_file_annotations, get_corpus_files, load_mentions_with_attributes
+from ehost_reader import load_ehost_files
 
 #HEURISTICS = ['base', '2m', '2m_diff', '2m_diff_strict']
 HEURISTICS = ['1m_doc', '2m_doc', '1m_patient', '2m_patient', '2m_diff_doc', '2m_diff_patient', '2m_diff_strict_doc', '2m_diff_strict_patient']
 
+# reference indexes loaded in this session: pin_ref -> (signature, index)
+REFERENCE_INDEXES = {}
+
 
 
 def has_SH_mention(mentions):
@@ -36,7 +44,80 @@ def has_SH_mention(mentions):
     return False
 
 
-def get_brcid_mapping(pin, pin_ref):
+def get_tree_signature(pin):
+    """
+    Calculate a signature of a directory tree from the modification times of
+    its directories, which change whenever a file is added, removed or 
+    renamed.
+    
+    Arguments:
+        - pin: str; the path to the directory.
+    
+    Return:
+        - signature: str; the hexadecimal hash digest.
+    """
+    sha = hashlib.sha1()
+    for root, dirs, files in os.walk(pin):
+        dirs.sort()
+        sha.update((os.path.relpath(root, pin) + '|' + str(os.stat(root).st_mtime_ns) + '\n').encode('utf-8'))
+    
+    return sha.hexdigest()
+
+
+def get_reference_index(pin_ref, index_path=None):
+    """
+    Get the index of BRCIDs for each file name in a reference corpus, where 
+    the BRCID is given by the original directory structure. The index is 
+    saved next to the corpus directory, and rebuilt when the directory tree 
+    changes.
+    
+    Arguments:
+        - pin_ref: str; the path to the reference corpus directory.
+        - index_path: str; the path to the index file. If None, the index 
+                      is saved to <pin_ref>.brcid_index.pickle
+    
+    Return:
+        - index: dict; the BRCID of each file name
+    """
+    if index_path is None:
+        index_path = pin_ref.rstrip('/\\') + '.brcid_index.pickle'
+    signature = get_tree_signature(pin_ref)
+    
+    if pin_ref in REFERENCE_INDEXES and REFERENCE_INDEXES[pin_ref][0] == signature:
+        return REFERENCE_INDEXES[pin_ref][1]
+    
+    index = None
+    if os.path.isfile(index_path):
+        with open(index_path, 'rb') as fin:
+            (saved_signature, saved_index) = pickle.load(fin)
+        if saved_signature == signature:
+            index = saved_index
+    
+    if index is None:
+        print('-- Building BRCID index for:', pin_ref, file=sys.stderr)
+        ref = get_corpus_files(pin_ref)
+        ref = [k for k in ref if 'xml' in k]
+        
+        # get the brcids from the original directory structure
+        index = {}
+        for f in ref:
+            s = f.split('\\')
+            if isinstance(s[1], float):
+                brcid = str(int(s[1]))
+            else:
+                brcid = str(s[1])
+            index[s[3]] = brcid
+        
+        with open(index_path, 'wb') as fout:
+            pickle.dump((signature, index), fout)
+        print('-- Saved BRCID index:', index_path, file=sys.stderr)
+    
+    REFERENCE_INDEXES[pin_ref] = (signature, index)
+    
+    return index
+
+
+def get_brcid_mapping(pin, pin_ref, index_path=None):
     """
     Determine the BRCIDs for each file in the gold standard corpus. To get 
     results use 'train_dev' as gold and 'system_train_dev' as system.
@@ -44,39 +125,32 @@ def get_brcid_mapping(pin, pin_ref):
     Arguments:
         - pin: str; the path to the corpus directory containing annotations
           i.e. system annotations or gold annotations
+        - pin_ref: str; the path to the reference corpus directory (e.g. 
+          Corpus_full)
+        - index_path: str; the path to the reference index file (see 
+          get_reference_index)
 
     Return:
         - brcid_mapping: dict; the mapping of BRCIDs
         - files: list; the list of files in the corpus
     """
     files = get_corpus_files(pin)
-    files_trunc = [f.split('\\')[-1] for f in files if 'xml' in f]
-    
-    brcid_mapping = {}
+    files_trunc = set([f.split('\\')[-1] for f in files if 'xml' in f])
     
     #ref = get_corpus_files('T:/Andre Bittar/Projects/KA_Self-harm/Corpus_full')
     #ref = get_corpus_files('T:/Andre Bittar/Projects/ASD_TS/ASD_ALL_SUI_POS_AND_FHx')
-    ref = get_corpus_files(pin_ref)
-    ref = [k for k in ref if 'xml' in k]
-    
-    # get the brcids from the original directory structure
-    for f in ref:
-        s = f.split('\\')
-        if isinstance(s[1], float):
-            brcid = str(int(s[1]))
-        else:
-            brcid = str(s[1])
-        fname = s[3]
-        if fname in files_trunc:
-            brcid_mapping[fname] = brcid
+    index = get_reference_index(pin_ref, index_path)
+    brcid_mapping = {fname: brcid for (fname, brcid) in index.items() if fname in files_trunc}
     
     return brcid_mapping, files
 
 
-def check_prevalence(files, heuristic, cohort='full'):
+def check_prevalence(files, heuristic, cohort='full', cache_path=None, n_process=1):
     """
     Determine SH prevalence by applying the heuristics to a list of annotated 
     files.
+    The parsed files are cached in cache_path (if set), and parsed with 
+    n_process processes.
     """
 
     if cohort not in ['full', 'restricted']:
@@ -85,9 +159,10 @@ def check_prevalence(files, heuristic, cohort='full'):
     global_mentions = {}
     xml = [x for x in files if 'xml' in x]
     n = len(xml)
+    all_mentions = load_ehost_files(xml, cache_path=cache_path, n_process=n_process)
 
     for i, f in enumerate(xml):
-        mentions = load_mentions_with_attributes(f)
+        mentions = all_mentions[f]
         mentions = convert_file_annotations(mentions)
         brcid = f.split('\\')[1]
         tmp = global_mentions.get(brcid, [])
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+    Lemma Matcher
+
+    Match sequences of lemmas in a document. This replaces spaCy's
+    token-pattern Matcher for lemma lexicons, which are plain lemma sequences
+    and do not need the general pattern engine. Patterns are stored in a trie
+    keyed by lemma hash, and a document is matched in one scan over its lemma
+    array, following the trie from each token for at most the length of the
+    longest pattern.
+
+    The matcher returns the same (match_id, start, end) matches as a Matcher
+    with one {LEMMA: lemma} dict per lemma in each pattern. Matching is exact
+    (i.e. case-sensitive) on the token lemma.
+
+    Run this file to compare the matches with spaCy's Matcher and to
+    benchmark both on the lemma lexicons.
+"""
+
+import sys
+
+from spacy.attrs import LEMMA
+from time import time
+
+
+class LemmaMatcher(object):
+    """
+    Lemma Matcher
+
+    Match sequences of lemmas with a trie over lemma hashes.
+    """
+
+    def __init__(self, vocab):
+        """
+        Create a new LemmaMatcher instance.
+
+        Arguments:
+            - vocab: spaCy Vocab; the vocabulary used to hash lemmas and keys.
+        """
+        self.vocab = vocab
+        # a trie node is a pair of a dict of child nodes keyed by lemma hash
+        # and a list of the match ids of patterns that end at the node
+        self.root = ({}, [])
+        self.n_patterns = 0
+
+    def __len__(self):
+        return self.n_patterns
+
+    def add(self, key, on_match, *patterns):
+        """
+        Add lemma sequences to the matcher.
+
+        Arguments:
+            - key: str; the match id.
+            - on_match: function; not supported, must be None (the argument
+                        mirrors spaCy's Matcher.add).
+            - patterns: list; each pattern is a list of lemmas or a string of
+                        space separated lemmas.
+        """
+        if on_match is not None:
+            raise ValueError('-- Error: LemmaMatcher does not support on_match callbacks.')
+        key_id = self.vocab.strings.add(key)
+        for pattern in patterns:
+            if isinstance(pattern, str):
+                pattern = pattern.split()
+            if len(pattern) == 0:
+                continue
+            node = self.root
+            for lemma in pattern:
+                lemma_id = self.vocab.strings.add(lemma)
+                if lemma_id not in node[0]:
+                    node[0][lemma_id] = ({}, [])
+                node = node[0][lemma_id]
+            # duplicate patterns only match once
+            if key_id not in node[1]:
+                node[1].append(key_id)
+            self.n_patterns += 1
+
+    def __call__(self, doc):
+        """
+        Find all matches in a document.
+
+        Arguments:
+            - doc: spaCy Doc; the document to match.
+
+        Return:
+            - matches: list; (match_id, start, end) tuples, ordered by start
+                       and end offsets.
+        """
+        lemmas = doc.to_array([LEMMA]).tolist() if len(doc) > 0 else []
+        children = self.root[0]
+        matches = []
+        n = len(lemmas)
+        for start in range(n):
+            node = children.get(lemmas[start])
+            end = start + 1
+            while node is not None:
+                for key_id in node[1]:
+                    matches.append((key_id, start, end))
+                if end == n:
+                    break
+                node = node[0].get(lemmas[end])
+                end += 1
+
+        return matches
+
+
+def benchmark(texts, n_repeat=20):
+    """
+    Compare LemmaMatcher with spaCy's Matcher on the lemma lexicons, and time
+    both.
+
+    Arguments:
+        - texts: list; the texts to match.
+        - n_repeat: int; the number of times each document is matched.
+
+    Return: bool; True if both matchers give the same matches, else False.
+    """
+    import spacy
+
+    from lexical_annotator import LemmaAnnotatorSequence
+    from spacy.matcher import Matcher
+
+    nlp = spacy.load('en_core_web_sm', disable=['ner'])
+    matcher = Matcher(nlp.vocab)
+    lemma_matcher = LemmaMatcher(nlp.vocab)
+    for lexicon in ['sh_lex', 'sh_type_lex', 'time_present_lex', 'time_life_stage_lex', 'negation_lex',
+                    'modality_lex', 'hedging_lex', 'intent_lex', 'body_part_lex', 'harm_action_lex',
+                    'harm_action_type_lex', 'med_lex']:
+        lsa = LemmaAnnotatorSequence(nlp, 'resources/' + lexicon + '.txt', 'LA')
+        lsa.load_lexicon()
+        for (label, lemma_sequences) in lsa.get_annotation_rules().items():
+            key = lexicon + '_' + label
+            for lemmas in lemma_sequences:
+                matcher.add(key, None, [{LEMMA: lemma} for lemma in lemmas.split()])
+            lemma_matcher.add(key, None, *lemma_sequences)
+
+    docs = list(nlp.pipe(texts))
+
+    ok = True
+    for doc in docs:
+        if sorted(set(matcher(doc))) != sorted(set(lemma_matcher(doc))):
+            print('-- Error: matches differ for:', doc.text, file=sys.stderr)
+            ok = False
+
+    t0 = time()
+    for _ in range(n_repeat):
+        for doc in docs:
+            matcher(doc)
+    t1 = time()
+    for _ in range(n_repeat):
+        for doc in docs:
+            lemma_matcher(doc)
+    t2 = time()
+
+    n_docs = len(docs) * n_repeat
+    print('-- Patterns      :', len(lemma_matcher), file=sys.stderr)
+    print('-- Documents     :', len(docs), 'x', n_repeat, file=sys.stderr)
+    print('-- Matcher       :', round(1000 * (t1 - t0) / n_docs, 4), 'ms per document', file=sys.stderr)
+    print('-- LemmaMatcher  :', round(1000 * (t2 - t1) / n_docs, 4), 'ms per document', file=sys.stderr)
+
+    return ok
+
+
+if __name__ == '__main__':
+    from examples.test_examples import text
+
+    # the test examples as single sentences and as one long document
+    texts = [example for example in text if example.strip() != '']
+    texts.append(' '.join(texts))
+
+    ok = benchmark(texts)
+    sys.exit(0 if ok else 1)
@@ -16,9 +16,70 @@
 import spacy
 import sys
 
-from spacy.matcher import PhraseMatcher, Matcher
+from attribute_table import set_value
+from bisect import bisect_left, bisect_right
+from lemma_matcher import LemmaMatcher
+from spacy.matcher import PhraseMatcher
 from spacy.tokens import Span, Token
 from spacy.symbols import LEMMA, LOWER
+from span_selector import select_longest_spans
+
+
+def add_entities(doc, entities):
+    """
+    Add entities to a document, resolving overlaps with the existing entities
+    in a single pass and assigning doc.ents once.
+    
+    An entity that is already in the document is skipped. An entity that 
+    overlaps an existing entity (inclusive of boundary tokens) is only added 
+    if it is longer than that entity, which is then removed. Entities that do 
+    not overlap any existing entity are not added.
+    
+    Arguments:
+        - doc: spaCy Doc; a spaCy document instance.
+        - entities: list; entity spans to add, in order.
+    
+    Return:
+        - doc: spaCy Doc; the document with updated entities.
+    """
+    # existing entities never overlap, so sorting by start also sorts by end
+    ents = sorted(doc.ents, key=lambda ent: ent.start)
+    starts = [ent.start for ent in ents]
+    ends = [ent.end for ent in ents]
+    keys = set((ent.start, ent.end, ent.label) for ent in ents)
+    changed = False
+    for entity in entities:
+        # avoid adding entities twice, but CAREFUL make sure this doesn't stop several annotations being added to the same token sequence
+        if (entity.start, entity.end, entity.label) in keys:
+            continue
+        # check for overlap: candidates have start <= entity.end and end >= entity.start
+        replaced = None
+        for k in range(bisect_left(ends, entity.start), bisect_right(starts, entity.end)):
+            start, end = starts[k], ends[k]
+            # overlap - retain the new entity if it is longer
+            if (entity.end - entity.start) > (end - start):
+                replaced = (start, end)
+                break
+            if (entity.end - entity.start) == (end - start):
+                print('-- Warning: exactly overlapping entities:', entity.end, entity.start, entity, '&', start, end, doc[start:end], file=sys.stderr)
+        if replaced is None:
+            continue
+        start, end = replaced
+        ents = [ent for ent in ents if ent.start != start and ent.end != end]
+        k = bisect_right([ent.start for ent in ents], entity.start)
+        if (k > 0 and ents[k - 1].end > entity.start) or (k < len(ents) and ents[k].start < entity.end):
+            # the new entity still overlaps another entity: let spaCy reject it as before
+            doc.ents = ents + [entity]
+        ents.insert(k, entity)
+        starts = [ent.start for ent in ents]
+        ends = [ent.end for ent in ents]
+        keys = set((ent.start, ent.end, ent.label) for ent in ents)
+        changed = True
+    
+    if changed:
+        doc.ents = ents
+    
+    return doc
 
 
 class LexicalAnnotatorSequence(object):
@@ -125,7 +186,7 @@ class LexicalAnnotator(object):
     accoring to a word list. Match is only performed on textual surface form.
     """
     
-    def __init__(self, nlp, terms, source_attribute, target_attribute, label, name, merge=False):
+    def __init__(self, nlp, terms, source_attribute, target_attribute, label, name, merge=False, patterns=None):
         """
         Create a new LexicalAnnotator instance.
         
@@ -139,14 +200,21 @@ class LexicalAnnotator(object):
             - label: str; the label to add to the tokens' target attribute.
             - name: str; the name of the pipeline component.
             - merge: bool; merge annotated spans into a single span.
+            - patterns: list; precompiled pattern Doc objects for the terms
+              (e.g. loaded from a pipeline cache). If None, patterns are built
+              by processing each term.
         """
         self.name = name
         self.nlp = nlp
+        self.terms = terms
         self.label = label  # get entity label ID
+        self.source_attribute = source_attribute
         self.target_attribute = target_attribute
         self.merge = merge
 
-        patterns = [self.nlp(text) for text in terms] # using make_doc as nlp() causes UseWarning saying that it may be much slower for tokenizer-based attributes (ORTH, LOWER)
+        if patterns is None:
+            patterns = [self.nlp(text) for text in terms] # using make_doc as nlp() causes UseWarning saying that it may be much slower for tokenizer-based attributes (ORTH, LOWER)
+        self.patterns = patterns
         self.matcher = PhraseMatcher(self.nlp.vocab, attr=source_attribute)
         self.matcher.add(label, None, *patterns)
         Token.set_extension(target_attribute, default=False, force=True)
@@ -161,18 +229,15 @@ class LexicalAnnotator(object):
             spans.append(entity)
             # Copy tense attribute to entity (for self-harm annotator)
             tense = '_'
+            set_value(doc, self.target_attribute, start, end, self.label)
             for token in entity:
-                token._.set(self.target_attribute, self.label)
                 if token.pos_ == 'VERB':
                     tense = token.tag_
             for token in entity:
                 token._.set('tense', tense)
 
-            # avoid adding entities twice, but CAREFUL make sure this doesn't stop several annotations being added to the same token sequence
-            if entity not in doc.ents:
-                # check for overlap
-                if self.check_entity_overlap(doc, entity):
-                    doc.ents = list(doc.ents) + [entity]
+        # resolve overlaps with existing entities and set doc.ents once
+        add_entities(doc, spans)
 
         # Merge all entities
         # TO DO spaCy stores ALL matches so we get 'deliberate' and 'self-harm' annotated separately - fix
@@ -184,33 +249,6 @@ class LexicalAnnotator(object):
 
         return doc
 
-    def check_entity_overlap(self, doc, entity):
-        """
-        Check the document for overlapping entities.
-        
-        Arguments:
-            - doc: spaCy Doc; a spaCy document instance.
-            - entity: spaCy Span; an entity span to check for overlap.
-        
-        Return: bool; True if entities are foudn that overlap with entity, else False
-        """
-        ent_offsets = [(ent.start, ent.end) for ent in doc.ents]
-        for (start, end) in ent_offsets:
-            # no overlap, no problem
-            if entity.start > end:
-                continue
-            if entity.end < start:
-                continue
-            # overlap - retain the new entity if it is longer
-            if (entity.end - entity.start) > (end - start):
-                #print('-- Replacing entity', ent.start, ent.end, ent, 'with', entity.end, entity.start, entity, file=sys.stderr)
-                new_ents = [ent for ent in doc.ents if ent.start != start and ent.end != end]
-                doc.ents = new_ents
-                return True
-            if (entity.end - entity.start) == (end - start):
-                print('-- Warning: exactly overlapping entities:', entity.end, entity.start, entity, '&', start, end, doc[start:end], file=sys.stderr)
-        return False
-
     def get_longest_matches(self, matches):
         """
         Remove all shortest matching overlapping spans.
@@ -221,26 +259,7 @@ class LexicalAnnotator(object):
         Return:
             - matches: list; all longest matches only.
         """
-        offsets = [(match[1], match[2]) for match in matches]
-        overlaps = {}
-        for offset in offsets:
-            o = [(i[0], i[1]) for i in offsets if i[0] >= offset[0] and 
-                 i[0] <= offset[1] or i[1] >= offset[0] and 
-                 i[1] <= offset[1] if (i[0], i[1]) != offset and
-                 (i[0], i[1]) and (i[0], i[1]) not in overlaps]
-            if len(o) > 0:
-                overlaps[offset] = o
-            
-        overlapping_spans = [[k] + v for (k, v) in overlaps.items()]
-        for os in overlapping_spans:
-            longest_span = sorted(os, key=lambda x: x[1] - x[0], reverse=True)[0]
-            for match in matches:
-                start, end = match[1], match[2]
-                # if it's not the longest match then chuck it out
-                if (start, end) in os and (start != longest_span[0] or end != longest_span[1]):
-                    matches.remove(match)
-            
-        return matches
+        return select_longest_spans(matches, lambda match: (match[1], match[2]))
 
 
 class LemmaAnnotatorSequence(object):
@@ -358,17 +377,14 @@ class LemmaAnnotator(object):
         """
         self.name = name
         self.nlp = nlp
+        self.lemma_sequences = lemma_sequences
         self.label = label
         self.attribute = attribute
-        self.matcher = Matcher(self.nlp.vocab)
+        self.matcher = LemmaMatcher(self.nlp.vocab)
         self.merge = merge
 
         # Build patterns from sequences of lemmas read from the lexicon file
-        for lemmas in lemma_sequences:
-            pattern = []
-            for lemma in lemmas.split():
-                pattern.append({LEMMA: lemma})
-            self.matcher.add(label, None, pattern)
+        self.matcher.add(label, None, *lemma_sequences)
 
         Token.set_extension(attribute, default=False, force=True)
         
@@ -382,18 +398,15 @@ class LemmaAnnotator(object):
             spans.append(entity)
             # Copy tense attribute to entity (for Self-harm annotator)
             tense = '_'
+            set_value(doc, self.attribute, start, end, self.label)
             for token in entity:
-                token._.set(self.attribute, self.label)
                 if token.pos_ == 'VERB':
                     tense = token.tag_
             for token in entity:
                 token._.set('tense', tense)
 
-            # avoid adding entities twice, but CAREFUL make sure this doesn't stop several annotations being added to the same token sequence
-            if entity not in doc.ents:
-                # check for overlap
-                if self.check_entity_overlap(doc, entity):
-                    doc.ents = list(doc.ents) + [entity]
+        # resolve overlaps with existing entities and set doc.ents once
+        add_entities(doc, spans)
 
         # Merge all entities
         # TO DO spaCy stores ALL matches so we get 'deliberate' and 'self-harm' annotated separately - fix
@@ -405,63 +418,156 @@ class LemmaAnnotator(object):
 
         return doc
 
-    def check_entity_overlap(self, doc, entity):
+    def get_longest_matches(self, matches):
         """
-        Check the document for overlapping entities.
+        Remove all shortest matching overlapping spans.
         
         Arguments:
-            - doc: spaCy Doc; a spaCy document instance.
-            - entity: spaCy Span; an entity span to check for overlap.
+            - matches: list; a list of matched entities.
         
-        Return: bool; True if entities are foudn that overlap with entity, else False
+        Return:
+            - matches: list; all longest matches only.
         """
-        ent_offsets = [(ent.start, ent.end) for ent in doc.ents]
-        for (start, end) in ent_offsets:
-            # no overlap, no problem
-            if entity.start > end:
-                continue
-            if entity.end < start:
-                continue
-            # overlap - retain the new entity if it is longer
-            if (entity.end - entity.start) > (end - start):
-                #print('-- Replacing entity', ent.start, ent.end, ent, 'with', entity.end, entity.start, entity, file=sys.stderr)
-                new_ents = [ent for ent in doc.ents if ent.start != start and ent.end != end]
-                doc.ents = new_ents
-                return True
-            if (entity.end - entity.start) == (end - start):
-                print('-- Warning: exactly overlapping entities:', entity.end, entity.start, entity, '&', start, end, doc[start:end], file=sys.stderr)
-        return False
+        return select_longest_spans(matches, lambda match: (match[1], match[2]))
 
-    def get_longest_matches(self, matches):
+
+class LexiconBank(object):
+    """
+    Lexicon Bank
+    
+    A single pipeline component that applies the lexicons of several 
+    LexicalAnnotator and LemmaAnnotator components. All surface form 
+    patterns are matched with one PhraseMatcher per source attribute and all 
+    lemma patterns with one LemmaMatcher, so each document is matched once per 
+    attribute instead of once per label. Matches are then applied label by 
+    label in the order in which the lexicons were added, so annotations have 
+    the same precedence as the equivalent sequence of components.
+    
+    Spans are not merged, as merging changes the token offsets that later 
+    labels are matched on. Add all lexicons before adding the component to 
+    the pipeline, as surface form patterns are built by processing each term.
+    """
+
+    def __init__(self, nlp, name='lexicon_bank'):
         """
-        Remove all shortest matching overlapping spans.
+        Create a new LexiconBank instance.
         
         Arguments:
-            - matches: list; a list of matched entities.
+            - nlp: spaCy Language; a spaCy text processing pipeline instance.
+            - name: str; the name of the pipeline component.
+        """
+        self.name = name
+        self.nlp = nlp
+        self.groups = []
+        self.group_index = {}
+        self.phrase_matchers = {}
+        self.matcher = LemmaMatcher(self.nlp.vocab)
+        Token.set_extension('tense', default=False, force=True)
+
+    def add_lexicon(self, pin, source_attribute, target_attribute):
+        """
+        Load a lexicon file and add a group of patterns for each of its 
+        labels. Group names follow the component names of 
+        LexicalAnnotatorSequence and LemmaAnnotatorSequence, and a group is 
+        skipped where those would not add a component.
         
-        Return:
-            - matches: list; all longest matches only.
+        Arguments:
+            - pin: str; the input path of a lexical rule file.
+            - source_attribute: spaCy symbol; the token attribute to match
+              on (e.g. LEMMA).
+            - target_attribute: spaCy symbol; the token attribute to add the 
+              lexical annotations to (e.g. TAG, or custom attribute LA, SH).
         """
-        offsets = [(match[1], match[2]) for match in matches]
-        overlaps = {}
-        for offset in offsets:
-            o = [(i[0], i[1]) for i in offsets if i[0] >= offset[0] and 
-                 i[0] <= offset[1] or i[1] >= offset[0] and 
-                 i[1] <= offset[1] if (i[0], i[1]) != offset and
-                 (i[0], i[1]) and (i[0], i[1]) not in overlaps]
-            if len(o) > 0:
-                overlaps[offset] = o
-            
-        overlapping_spans = [[k] + v for (k, v) in overlaps.items()]
-        for os in overlapping_spans:
-            longest_span = sorted(os, key=lambda x: x[1] - x[0], reverse=True)[0]
-            for match in matches:
-                start, end = match[1], match[2]
-                # if it's not the longest match then chuck it out
-                if (start, end) in os and (start != longest_span[0] or end != longest_span[1]):
-                    matches.remove(match)
-            
-        return matches
+        if source_attribute == LEMMA:
+            lsa = LemmaAnnotatorSequence(self.nlp, pin, target_attribute)
+        else:
+            lsa = LexicalAnnotatorSequence(self.nlp, pin, source_attribute, target_attribute)
+        lsa.load_lexicon()
+
+        annotation_rules = lsa.get_annotation_rules()
+        for label in annotation_rules:
+            # Avoid group name clashes
+            name = 'lex_' + label
+            if name in self.nlp.pipe_names or name in self.group_index:
+                name += '_'
+
+            if name not in self.nlp.pipe_names and name not in self.group_index:
+                self.add_group(name, annotation_rules[label], source_attribute, target_attribute, label)
+            else:
+                print('-- ', name, 'exists already. Group not added.')
+
+    def add_group(self, name, terms, source_attribute, target_attribute, label, patterns=None):
+        """
+        Add the patterns for one label.
+        
+        Arguments:
+            - name: str; the name of the group.
+            - terms: list; the terms (or lemma sequences if source_attribute
+              is LEMMA) to be annotated.
+            - source_attribute: spaCy symbol; the token attribute to match
+              on (e.g. LEMMA).
+            - target_attribute: spaCy symbol; the token attribute to add the 
+              lexical annotations to.
+            - label: str; the label to add to the tokens' target attribute.
+            - patterns: list; precompiled pattern Doc objects for the terms
+              (e.g. loaded from a pipeline cache). If None, patterns are built
+              by processing each term. Ignored for LEMMA.
+        """
+        if source_attribute == LEMMA:
+            # Build patterns from sequences of lemmas read from the lexicon file
+            self.matcher.add(name, None, *terms)
+            patterns = None
+        else:
+            if patterns is None:
+                patterns = [self.nlp(text) for text in terms]
+            if source_attribute not in self.phrase_matchers:
+                self.phrase_matchers[source_attribute] = PhraseMatcher(self.nlp.vocab, attr=source_attribute)
+            self.phrase_matchers[source_attribute].add(name, None, *patterns)
+
+        self.group_index[name] = len(self.groups)
+        self.groups.append({'name': name,
+                            'terms': terms,
+                            'source_attribute': source_attribute,
+                            'target_attribute': target_attribute,
+                            'label': label,
+                            'patterns': patterns
+                            })
+        self.nlp.vocab.strings.add(label)
+        Token.set_extension(target_attribute, default=False, force=True)
+
+    def __call__(self, doc):
+        matches = []
+        for matcher in self.phrase_matchers.values():
+            matches.extend(matcher(doc))
+        matches.extend(self.matcher(doc))
+
+        # dispatch matches to their groups
+        group_matches = [[] for _ in self.groups]
+        for match in matches:
+            group_matches[self.group_index[self.nlp.vocab.strings[match[0]]]].append(match)
+
+        Token.set_extension('tense', default=False, force=True)
+        for (group, matches) in zip(self.groups, group_matches):
+            if len(matches) == 0:
+                continue
+            matches = select_longest_spans(matches, lambda match: (match[1], match[2]))
+            spans = []
+            for _, start, end in matches:
+                entity = Span(doc, start, end, label=self.nlp.vocab.strings[group['label']])
+                spans.append(entity)
+                # Copy tense attribute to entity (for self-harm annotator)
+                tense = '_'
+                set_value(doc, group['target_attribute'], start, end, group['label'])
+                for token in entity:
+                    if token.pos_ == 'VERB':
+                        tense = token.tag_
+                for token in entity:
+                    token._.set('tense', tense)
+
+            # resolve overlaps with existing entities and set doc.ents once
+            add_entities(doc, spans)
+
+        return doc
 
 
 class TokenSequenceAnnotatorSequence(object):
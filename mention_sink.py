@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+    Mention Sink
+
+    Stream the mentions output by SelfHarmAnnotator.build_ehost_output into
+    columnar Parquet files, with one row per mention. Rows are buffered and
+    written in row groups of a fixed size, and a new part file is started
+    when the current one reaches a maximum number of rows, e.g.
+
+        out_dir/mentions-00000.parquet
+        out_dir/mentions-00001.parquet
+
+    Mentions can also be written in numbered parts, e.g. one per chunk of a
+    cohort (see self_harm_cohort_annotator.process), so that a restarted run
+    replaces the files of the parts it writes again, e.g.
+
+        out_dir/mentions-chunk-00000.parquet
+        out_dir/mentions-chunk-00001.parquet
+        out_dir/mentions-chunk-00001-1.parquet
+
+    A sink refuses an output directory that already has mention files,
+    unless it is opened with resume=True.
+
+    The files can be read back as a single table, and only the columns that
+    are needed, e.g. with read_mentions(out_dir, columns=['brcid', 'status']),
+    rather than re-parsing eHOST XML files.
+"""
+
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+import re
+import sys
+
+
+SCHEMA = pa.schema([('doc_id', pa.string()),
+                    ('brcid', pa.string()),
+                    ('mention_id', pa.string()),
+                    ('start', pa.int64()),
+                    ('end', pa.int64()),
+                    ('text', pa.string()),
+                    ('sh_type', pa.string()),
+                    ('polarity', pa.string()),
+                    ('status', pa.string()),
+                    ('temporality', pa.string())])
+
+STRING_ATTRIBUTES = ['text', 'sh_type', 'polarity', 'status', 'temporality']
+
+
+def to_id_string(value):
+    """
+    Convert a document or patient identifier to a string. Integer values
+    stored as floats (e.g. brcids in a DataFrame with missing values) are
+    converted without the decimal part.
+
+    Arguments:
+        - value: object; the identifier.
+
+    Return: str; the identifier string, or None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, float):
+        if value != value:
+            return None
+        if value.is_integer():
+            return str(int(value))
+
+    return str(value)
+
+
+class MentionSink(object):
+    """
+    Mention Sink
+
+    Write mentions to partitioned Parquet files in fixed-size row groups.
+    """
+
+    def __init__(self, out_dir, prefix='mentions', row_group_size=100000, rows_per_file=5000000, compression='snappy', resume=False):
+        """
+        Create a new MentionSink instance.
+
+        Arguments:
+            - out_dir: str; the output directory, which is created if needed.
+            - prefix: str; the prefix of the part file names.
+            - row_group_size: int; the number of rows in each row group.
+            - rows_per_file: int; the number of rows after which a new part
+                             file is started (rounded up to a whole number of
+                             row groups).
+            - compression: str; the Parquet compression codec.
+            - resume: bool; add to the mention files already in the output
+                      directory, replacing the files of parts that are 
+                      written again. If False, a ValueError is raised if
+                      there are any.
+        """
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.row_group_size = row_group_size
+        self.rows_per_file = rows_per_file
+        self.compression = compression
+        self.writer = None
+        self.part = None
+        self.n_part_files = 0
+        self.n_files = 0
+        self.n_file_rows = 0
+        self.n_rows = 0
+        self.n_docs = 0
+        self.buffer = {name: [] for name in SCHEMA.names}
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        existing = [f for f in os.listdir(self.out_dir) if self.is_mention_file(f)]
+        if len(existing) > 0 and not resume:
+            raise ValueError('-- Error: output directory already has mention files: ' + self.out_dir + ' (use resume=True to add to them)')
+
+        # files written without a part number are numbered after existing ones
+        numbers = [int(m.group(1)) for m in [re.fullmatch(re.escape(self.prefix) + r'-(\d+)\.parquet', f) for f in existing] if m is not None]
+        self.n_parts = max(numbers) + 1 if len(numbers) > 0 else 0
+
+    def is_mention_file(self, f):
+        """
+        Check if a file name is the name of a mention file of this sink.
+
+        Arguments:
+            - f: str; the file name.
+
+        Return: bool; True if the file is a mention file, else False.
+        """
+        return f.startswith(self.prefix + '-') and f.endswith('.parquet')
+
+    def get_part_name(self, part):
+        """
+        Get the name of the first file of a numbered part, without extension.
+
+        Arguments:
+            - part: int; the part number.
+
+        Return: str; the file name.
+        """
+        return self.prefix + '-chunk-' + str(part).zfill(5)
+
+    def get_path(self):
+        """
+        Get the path of the next file to write.
+
+        Return: str; the path.
+        """
+        if self.part is None:
+            name = self.prefix + '-' + str(self.n_parts).zfill(5)
+            self.n_parts += 1
+        else:
+            name = self.get_part_name(self.part)
+            if self.n_part_files > 0:
+                name += '-' + str(self.n_part_files)
+            self.n_part_files += 1
+
+        return os.path.join(self.out_dir, name + '.parquet')
+
+    def start_part(self, part):
+        """
+        Finish the current part, and write the following mentions to the
+        files of a numbered part, removing any files it already has.
+
+        Arguments:
+            - part: int; the part number, or None to write files without
+                    part number.
+        """
+        self.end_part()
+        self.part = part
+        self.n_part_files = 0
+        if part is None:
+            return
+        name = self.get_part_name(part)
+        for f in os.listdir(self.out_dir):
+            if f == name + '.parquet' or re.fullmatch(re.escape(name) + r'-\d+\.parquet', f):
+                os.remove(os.path.join(self.out_dir, f))
+
+    def end_part(self):
+        """
+        Write the buffered mentions and close the current file, e.g. before
+        the results of a chunk are checkpointed.
+        """
+        self.flush(final=True)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.n_file_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, doc_id, mentions, brcid=None, part=None):
+        """
+        Add the mentions of a document.
+
+        Arguments:
+            - doc_id: str; the document identifier (e.g. the cn_doc_id).
+            - mentions: dict; the mentions of the document, as output by
+                        SelfHarmAnnotator.build_ehost_output.
+            - brcid: str; the patient identifier, if known.
+            - part: int; the number of the part to write the mentions to
+                    (see start_part), or None.
+        """
+        if part != self.part:
+            self.start_part(part)
+        doc_id = to_id_string(doc_id)
+        brcid = to_id_string(brcid)
+        buffer = self.buffer
+        for mention_id in sorted(mentions.keys()):
+            mention = mentions[mention_id]
+            buffer['doc_id'].append(doc_id)
+            buffer['brcid'].append(brcid)
+            buffer['mention_id'].append(mention_id)
+            buffer['start'].append(int(mention['start']))
+            buffer['end'].append(int(mention['end']))
+            for name in STRING_ATTRIBUTES:
+                # unset attributes are False on tokens
+                value = mention.get(name, None)
+                buffer[name].append(value if value else None)
+
+        self.n_docs += 1
+        if len(buffer['doc_id']) >= self.row_group_size:
+            self.flush()
+
+    def flush(self, final=False):
+        """
+        Write the buffered mentions as full row groups. The remaining rows 
+        are kept in the buffer, unless this is the final flush.
+
+        Arguments:
+            - final: bool; also write a last, partial row group.
+        """
+        n = len(self.buffer['doc_id'])
+        if not final:
+            n = n - n % self.row_group_size
+        if n == 0:
+            return
+
+        table = pa.Table.from_pydict({name: values[:n] for (name, values) in self.buffer.items()}, schema=SCHEMA)
+        self.buffer = {name: values[n:] for (name, values) in self.buffer.items()}
+
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.get_path(), SCHEMA, compression=self.compression)
+            self.n_files += 1
+
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self.n_file_rows += n
+        self.n_rows += n
+
+        if self.n_file_rows >= self.rows_per_file:
+            self.writer.close()
+            self.writer = None
+            self.n_file_rows = 0
+
+    def close(self):
+        """
+        Write any buffered mentions and close the current part file.
+        """
+        self.end_part()
+
+        print('-- Wrote', self.n_rows, 'mentions from', self.n_docs, 'documents to', self.n_files, 'files in:', self.out_dir, file=sys.stderr)
+
+
+def read_mentions(path, columns=None, filters=None):
+    """
+    Read mentions written by a MentionSink.
+
+    Arguments:
+        - path: str; the output directory of the sink, or a single part file.
+        - columns: list; the columns to read. If None, all columns are read.
+        - filters: list; row filters passed to pyarrow, e.g.
+                   [('status', '=', 'RELEVANT')].
+
+    Return:
+        - df: DataFrame; the mentions.
+    """
+    return pq.read_table(path, columns=columns, filters=filters).to_pandas()
+
+
+def random_mentions(rng, n_mentions):
+    """
+    Create random mentions in the format output by 
+    SelfHarmAnnotator.build_ehost_output.
+
+    Arguments:
+        - rng: Random; the random number generator.
+        - n_mentions: int; the number of mentions.
+
+    Return:
+        - mentions: dict; the mentions.
+    """
+    mentions = {}
+    for n in range(n_mentions):
+        start = rng.randint(0, 10000)
+        text = ''.join(rng.choice('ab c\né’') for _ in range(rng.randint(1, 12)))
+        mentions['EHOST_Instance_' + str(n + 1)] = {'annotator': 'SYSTEM',
+                                                  'class': 'SELF-HARM',
+                                                  'comment': None,
+                                                  'start': str(start),
+                                                  'end': str(start + len(text)),
+                                                  'text': text,
+                                                  'sh_type': rng.choice(['OVERDOSE', 'CUTTING', False]),
+                                                  'polarity': rng.choice(['POSITIVE', 'NEGATIVE']),
+                                                  'status': rng.choice(['RELEVANT', 'NON-RELEVANT', 'UNCERTAIN']),
+                                                  'temporality': rng.choice(['CURRENT', 'HISTORICAL'])}
+
+    return mentions
+
+
+def get_rows(doc_id, mentions, brcid):
+    """
+    Get the rows expected in the sink output for the mentions of a document.
+    """
+    return [(doc_id, brcid, mention_id, int(mentions[mention_id]['start']), int(mentions[mention_id]['end'])) +
+            tuple(mentions[mention_id][name] or None for name in STRING_ATTRIBUTES)
+            for mention_id in sorted(mentions.keys())]
+
+
+def check_output(out_dir, n_docs=500):
+    """
+    Write random mentions, in numbered parts and without, and check that
+    they are read back unchanged, that a non-empty directory is refused and
+    that parts written again on resume replace the previous files.
+
+    Arguments:
+        - out_dir: str; the output directory (must not exist or be empty).
+        - n_docs: int; the number of documents.
+
+    Return: bool; True if all checks pass, else False.
+    """
+    import random
+
+    rng = random.Random(0)
+    docs = [('doc_' + str(n), random_mentions(rng, rng.randint(0, 4)), rng.choice([None, 1234.0, 'p1'])) for n in range(n_docs)]
+    ok = True
+
+    def read_rows():
+        df = read_mentions(out_dir)
+        return sorted(tuple(None if v != v else v for v in row) for row in df[SCHEMA.names].itertuples(index=False))
+
+    # parts of 100 documents, with small files to roll over within parts
+    expected = []
+    with MentionSink(out_dir, row_group_size=10, rows_per_file=50) as sink:
+        for (n, (doc_id, mentions, brcid)) in enumerate(docs):
+            sink.write(doc_id, mentions, brcid=brcid, part=n // 100)
+            expected += get_rows(doc_id, mentions, to_id_string(brcid))
+    if read_rows() != sorted(expected):
+        print('-- Error: mentions differ after writing', file=sys.stderr)
+        ok = False
+
+    try:
+        MentionSink(out_dir)
+        print('-- Error: non-empty output directory not refused', file=sys.stderr)
+        ok = False
+    except ValueError:
+        pass
+
+    # rewrite part 1 with half of its documents, and add documents without part
+    expected = []
+    with MentionSink(out_dir, row_group_size=10, rows_per_file=50, resume=True) as sink:
+        for (n, (doc_id, mentions, brcid)) in enumerate(docs):
+            if n // 100 == 1 and n % 2 == 0:
+                sink.write(doc_id, mentions, brcid=brcid, part=1)
+            if n // 100 != 1 or n % 2 == 0:
+                expected += get_rows(doc_id, mentions, to_id_string(brcid))
+        for (doc_id, mentions, brcid) in docs[:50]:
+            sink.write(doc_id + '_new', mentions, brcid=brcid)
+            expected += get_rows(doc_id + '_new', mentions, to_id_string(brcid))
+    if read_rows() != sorted(expected):
+        print('-- Error: mentions differ after resuming', file=sys.stderr)
+        ok = False
+
+    print('-- Checked', n_docs, 'random documents:', 'OK' if ok else 'FAILED', file=sys.stderr)
+
+    return ok
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ok = check_output(os.path.join(tmp_dir, 'mentions'))
+    sys.exit(0 if ok else 1)
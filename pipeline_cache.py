@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+    Pipeline Cache
+
+    Store an assembled spaCy pipeline on disk so that it can be reloaded
+    without being rebuilt from the resource files. The cache holds the base
+    spaCy pipeline (including tokenizer special cases added by the
+    detokenizer) and a list of specifications from which the custom pipeline
+    components are recreated, e.g. precompiled phrase matcher patterns.
+
+    Cache entries are keyed by a hash of the contents of the resource
+    directory, the spaCy version and the name and version of the spaCy model,
+    so any change to a lexicon, a rule file, the spaCy installation or the
+    model creates a new entry.
+
+    An entry is written to a temporary directory next to it and then renamed
+    into place, so worker processes that build the same pipeline at the same
+    time never write into the same directory and never see a partial entry.
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import spacy
+import sys
+import tempfile
+
+
+RESOURCE_EXTENSIONS = ['.py', '.txt']
+
+
+def get_resource_hash(resource_dir, extra_keys=None):
+    """
+    Calculate a hash of all resource files in a directory.
+
+    Arguments:
+        - resource_dir: str; the path to the resource directory.
+        - extra_keys: list; further strings to include in the hash (e.g.
+                      the spaCy version).
+
+    Return:
+        - key: str; the hexadecimal hash digest.
+    """
+    sha = hashlib.sha1()
+    for root, dirs, files in os.walk(resource_dir):
+        dirs[:] = sorted([d for d in dirs if d != '__pycache__'])
+        for f in sorted(files):
+            if os.path.splitext(f)[1] not in RESOURCE_EXTENSIONS:
+                continue
+            pin = os.path.join(root, f)
+            sha.update(os.path.relpath(pin, resource_dir).replace('\\', '/').encode('utf-8'))
+            with open(pin, 'rb') as fin:
+                sha.update(fin.read())
+    for key in extra_keys or []:
+        sha.update(str(key).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def get_model_version(model):
+    """
+    Get the name and version of an installed spaCy model, from its meta data,
+    without loading it.
+
+    Arguments:
+        - model: str; the model package name or path, as passed to
+                 spacy.load.
+
+    Return:
+        - version: str; the model name and version, e.g.
+                   'en_core_web_sm-2.3.1'.
+    """
+    if spacy.util.is_package(model):
+        path = spacy.util.get_package_path(model)
+    else:
+        path = spacy.util.ensure_path(model)
+    meta = spacy.util.get_model_meta(path)
+
+    return meta['lang'] + '_' + meta['name'] + '-' + meta['version']
+
+
+class PipelineCache(object):
+    """
+    Pipeline Cache
+
+    Save and load an assembled pipeline and its custom component
+    specifications.
+    """
+
+    def __init__(self, cache_dir, resource_dir='resources', extra_keys=None, model=None):
+        """
+        Create a new PipelineCache instance.
+
+        Arguments:
+            - cache_dir: str; the directory in which cache entries are stored.
+            - resource_dir: str; the resource directory used to build the
+                            pipeline.
+            - extra_keys: list; further strings that identify the pipeline
+                          (e.g. the gender setting).
+            - model: str; the spaCy model the pipeline is built on, whose name
+                     and version are included in the key.
+        """
+        self.cache_dir = cache_dir
+        self.resource_dir = resource_dir
+        model_keys = [get_model_version(model)] if model is not None else []
+        self.key = get_resource_hash(resource_dir, [spacy.__version__] + model_keys + (extra_keys or []))
+        self.path = os.path.join(cache_dir, self.key)
+        self.nlp_path = os.path.join(self.path, 'nlp')
+        self.components_path = os.path.join(self.path, 'components.pickle')
+
+    def exists(self):
+        """
+        Check whether a complete cache entry exists for the current key.
+
+        Return: bool; True if the entry exists, else False.
+        """
+        return os.path.isfile(self.components_path)
+
+    def save(self, nlp, components, custom_names):
+        """
+        Save a pipeline to the cache. If another process saves the same
+        entry first, that entry is kept and this one is discarded.
+
+        Arguments:
+            - nlp: spaCy Language; the assembled pipeline.
+            - components: list; the specifications of the custom components,
+                          in pipeline order.
+            - custom_names: list; the names of the custom components, which
+                            are not serialised with the base pipeline.
+        """
+        if self.exists():
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=self.key + '.tmp-', dir=self.cache_dir)
+        try:
+            with nlp.disable_pipes(*custom_names):
+                nlp.to_disk(os.path.join(tmp_path, 'nlp'))
+            with open(os.path.join(tmp_path, 'components.pickle'), 'wb') as fout:
+                pickle.dump(components, fout, protocol=pickle.HIGHEST_PROTOCOL)
+
+            # an incomplete entry can only be left by an interrupted save
+            if os.path.isdir(self.path) and not self.exists():
+                shutil.rmtree(self.path, ignore_errors=True)
+            try:
+                os.replace(tmp_path, self.path)
+            except OSError:
+                # the target directory is not empty: another process saved it
+                if not self.exists():
+                    raise
+                print('-- Pipeline already saved to cache:', self.path, file=sys.stderr)
+                return
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        print('-- Saved pipeline to cache:', self.path, file=sys.stderr)
+
+    def load(self, disable=None):
+        """
+        Load a pipeline from the cache.
+
+        Arguments:
+            - disable: list; the names of base pipeline components to disable.
+
+        Return:
+            - nlp: spaCy Language; the base pipeline.
+            - components: list; the specifications of the custom components.
+        """
+        nlp = spacy.load(self.nlp_path, disable=disable or [])
+        with open(self.components_path, 'rb') as fin:
+            components = pickle.load(fin)
+
+        print('-- Loaded pipeline from cache:', self.path, file=sys.stderr)
+
+        return nlp, components
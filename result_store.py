@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+    Result Store
+
+    A persistent SQLite store of the mentions found in each document, so that
+    a cohort can be refreshed incrementally. Results are keyed by:
+
+        - cn_doc_id: the document identifier;
+        - text_hash: a hash of the document text, so an edited document is
+                     re-annotated;
+        - resource_hash: a hash of the lexicons, rules, annotator code, spaCy
+                         model and annotator settings (see 
+                         get_annotator_hash), so results produced by other
+                         versions of any of them are never reused.
+
+    Mentions rather than flags are stored, so that document and patient flags
+    can be recalculated with any heuristic without re-annotating.
+"""
+
+import hashlib
+import json
+import os
+import spacy
+import sqlite3
+import sys
+
+from pipeline_cache import get_model_version, get_resource_hash
+from self_harm_annotator import SPACY_MODEL
+
+
+# the modules whose code determines the mentions found by SelfHarmAnnotator
+ANNOTATOR_SOURCES = ['attribute_table.py',
+                     'candidate_prefilter.py',
+                     'detokenizer.py',
+                     'lemma_matcher.py',
+                     'lexical_annotator.py',
+                     'self_harm_annotator.py',
+                     'span_selector.py',
+                     'token_sequence_annotator.py']
+
+
+def get_text_hash(text):
+    """
+    Calculate the hash of a document text.
+
+    Arguments:
+        - text: str; the text (may be None).
+
+    Return:
+        - key: str; the hexadecimal hash digest.
+    """
+    if text is None:
+        return ''
+
+    return hashlib.sha1(str(text).encode('utf-8', errors='surrogatepass')).hexdigest()
+
+
+def get_source_hash(source_dir=None):
+    """
+    Calculate a hash of the code of the annotator modules.
+
+    Arguments:
+        - source_dir: str; the directory of the modules (default: the
+                      directory of this module).
+
+    Return:
+        - key: str; the hexadecimal hash digest.
+    """
+    if source_dir is None:
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+    sha = hashlib.sha1()
+    for f in ANNOTATOR_SOURCES:
+        sha.update(f.encode('utf-8'))
+        with open(os.path.join(source_dir, f), 'rb') as fin:
+            sha.update(fin.read())
+
+    return sha.hexdigest()
+
+
+def get_annotator_hash(sha, resource_dir='resources'):
+    """
+    Calculate a hash that identifies the output of a SelfHarmAnnotator: the
+    contents of its resource directory (lexicons and rules), the code of the
+    annotator modules, the spaCy version and model, and every setting that
+    can change the mentions found.
+
+    Arguments:
+        - sha: SelfHarmAnnotator; the annotator.
+        - resource_dir: str; the resource directory.
+
+    Return:
+        - key: str; the hexadecimal hash digest.
+    """
+    settings = ['gender=' + str(sha.gender),
+                'date_formats=' + str(sha.date_formats),
+                'precompile_rules=' + str(sha.precompile_rules),
+                'consolidate_lexicons=' + str(sha.consolidate_lexicons),
+                'prefilter=' + str(sha.prefilter is not None),
+                'sentence_scope=' + str(sha.sentence_scope)]
+
+    return get_resource_hash(resource_dir, [spacy.__version__, get_model_version(SPACY_MODEL), get_source_hash()] + settings)
+
+
+class ResultStore(object):
+    """
+    Result Store
+
+    Store and look up the mentions of documents for a given resource hash.
+    """
+
+    def __init__(self, path, resource_hash, chunk_size=500):
+        """
+        Create a new ResultStore instance.
+
+        Arguments:
+            - path: str; the path to the SQLite database file.
+            - resource_hash: str; the hash of the current resources.
+            - chunk_size: int; the number of documents in each lookup query.
+        """
+        self.path = path
+        self.resource_hash = resource_hash
+        self.chunk_size = chunk_size
+
+        dirname = os.path.dirname(path)
+        if dirname != '':
+            os.makedirs(dirname, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                                'cn_doc_id TEXT NOT NULL, '
+                                'text_hash TEXT NOT NULL, '
+                                'resource_hash TEXT NOT NULL, '
+                                'mentions TEXT NOT NULL, '
+                                'PRIMARY KEY (resource_hash, cn_doc_id, text_hash))')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self.connection.close()
+
+    def get_many(self, keys):
+        """
+        Look up the mentions of documents.
+
+        Arguments:
+            - keys: list; (cn_doc_id, text_hash) tuples.
+
+        Return:
+            - results: dict; the mentions of each stored (cn_doc_id, text_hash)
+                       key. Documents that are not stored are omitted.
+        """
+        keys = set((str(cn_doc_id), text_hash) for (cn_doc_id, text_hash) in keys)
+        doc_ids = sorted(set(cn_doc_id for (cn_doc_id, _) in keys))
+        results = {}
+        for start in range(0, len(doc_ids), self.chunk_size):
+            chunk = doc_ids[start:start + self.chunk_size]
+            query = 'SELECT cn_doc_id, text_hash, mentions FROM results WHERE resource_hash = ? AND cn_doc_id IN (' + ', '.join(['?'] * len(chunk)) + ')'
+            for (cn_doc_id, text_hash, mentions) in self.connection.execute(query, [self.resource_hash] + chunk):
+                if (cn_doc_id, text_hash) in keys:
+                    results[(cn_doc_id, text_hash)] = json.loads(mentions)
+
+        return results
+
+    def put_many(self, rows):
+        """
+        Store the mentions of documents, and commit.
+
+        Arguments:
+            - rows: list; (cn_doc_id, text_hash, mentions) tuples.
+        """
+        self.connection.executemany('INSERT OR REPLACE INTO results (cn_doc_id, text_hash, resource_hash, mentions) VALUES (?, ?, ?, ?)',
+                                    [(str(cn_doc_id), text_hash, self.resource_hash, json.dumps(mentions)) for (cn_doc_id, text_hash, mentions) in rows])
+        self.connection.commit()
+
+    def prune(self):
+        """
+        Delete all results produced with other resources.
+
+        Return:
+            - n: int; the number of deleted results.
+        """
+        n = self.connection.execute('DELETE FROM results WHERE resource_hash != ?', (self.resource_hash,)).rowcount
+        self.connection.commit()
+        print('-- Deleted', n, 'results for previous resources from:', self.path, file=sys.stderr)
+
+        return n
@@ -27,23 +27,63 @@ import os
 import re
 import spacy
 import sys
-import xml.etree.ElementTree as ET
 
-from datetime import datetime
-from lexical_annotator import LexicalAnnotatorSequence
-from lexical_annotator import LemmaAnnotatorSequence
-from token_sequence_annotator import TokenSequenceAnnotator
+from attribute_table import WindowIndex, get_attribute_names, get_attribute_table, register_attributes, set_value
+from bisect import bisect_left, bisect_right
+from candidate_prefilter import CandidatePrefilter
+from collections import deque
+from lexical_annotator import LexicalAnnotator, LexicalAnnotatorSequence
+from lexical_annotator import LemmaAnnotator, LemmaAnnotatorSequence
+from lexical_annotator import LexiconBank
+from token_sequence_annotator import DEFAULT_ATTRIBUTES, TokenSequenceAnnotator
 from detokenizer import Detokenizer
-from spacy.symbols import LEMMA, LOWER
-from xml.dom.minidom import parseString
-from xml.parsers.expat import ExpatError
+from ehost_writer import get_creation_date, write_ehost_xml
+from multiprocessing import Pool
+from pipeline_cache import PipelineCache
+from spacy.symbols import CCONJ, LEMMA, LOWER, POS
+from spacy.tokens import Doc
+from time import time
 
 # store examples outside of main code
 from examples.test_examples import text
 
+# the spaCy model the pipeline is built on
+SPACY_MODEL = 'en_core_web_sm'
+
 FWD_OFFSET = 10
 BWD_OFFSET = 10
 
+# texts of this length or more are annotated in chunks of at most
+# LONG_TEXT_CHUNK_LENGTH characters (see split_long_text)
+MAX_TEXT_LENGTH = 1000000
+LONG_TEXT_CHUNK_LENGTH = 100000
+# chunk boundaries, in order of preference: paragraphs, lines, sentences, words
+LONG_TEXT_BOUNDARIES = [re.compile('\n[ \t]*\n\s*'), re.compile('\n\s*'), re.compile('[.!?]\s+'), re.compile('\s+')]
+
+# non-blank lines and sentence ends, used to select the parts of a text that
+# are annotated in sentence scope mode (see get_candidate_windows)
+LINE_REGEX = re.compile('[^\n]*\S[^\n]*')
+SENTENCE_END_REGEX = re.compile('[.!?]\s+')
+
+# Date pattern regexes, matched as whole tokens (see DateTokenAnnotator)
+MONTH = '(jan(uary)?|feb(ruary)?|mar(ch)?|apr(il)?|may|june?|july?|aug(ust)?|sep(t(ember)?)?|oct(ober)?|nov(ember)?|dec(ember)?)\\.?'
+DATE_FORMATS = {
+    'yyyy': '(19[0-9][0-9]|20[0-9][0-9])',
+    'ddmmyy': '(0?[1-9]|[12][0-9]|3[01])\\/(0[1-9]|1[012])\\/([0-9][0-9])',
+    'ddmmyyyy': '(0?[1-9]|[12][0-9]|3[01])\\/(0[1-9]|1[012])\\/(19[0-9][0-9]|20[0-9][0-9])',
+    'ddmmyy_dot': '(0?[1-9]|[12][0-9]|3[01])\\.(0[1-9]|1[012])\\.([0-9][0-9])',
+    'ddmmyyyy_dot': '(0?[1-9]|[12][0-9]|3[01])\\.(0[1-9]|1[012])\\.(19[0-9][0-9]|20[0-9][0-9])',
+    'iso': '(19[0-9][0-9]|20[0-9][0-9])-(0[1-9]|1[012])-(0[1-9]|[12][0-9]|3[01])',
+    'month_name': '((0?[1-9]|[12][0-9]|3[01])(st|nd|rd|th)?\\s+(of\\s+)?)?' + MONTH + '\\s+(19[0-9][0-9]|20[0-9][0-9])',
+    'aged': 'aged\\s+([1-9]|1[0-9])'
+}
+# TIME value added to the tokens of each format
+DATE_FORMAT_VALUES = {'aged': 'LIFE_STAGE'}
+DEFAULT_DATE_FORMATS = ['yyyy', 'ddmmyy', 'ddmmyyyy', 'ddmmyy_dot', 'ddmmyyyy_dot']
+
+# annotator instance loaded once in each worker process (see init_worker)
+WORKER_ANNOTATOR = None
+
 
 class SelfHarmAnnotator:
     """
@@ -52,30 +92,95 @@ class SelfHarmAnnotator:
     Annotate mentions of self-harm in clinical texts.
     """
 
-    def __init__(self, gender='all', verbose=False):
+    def __init__(self, gender='all', precompile_rules=True, cache_dir=None, consolidate_lexicons=False, date_formats=None, prefilter=False, sentence_scope=False, verbose=False):
         """
         Create a new SelfHarmAnnotator instance.
         
         Arguments:
+            - gender: str; apply rules for female gender only ('fem'), or for
+                      all genders ('all').
+            - precompile_rules: bool; compile token sequence rules into 
+                                matchers once, rather than for each document.
+            - cache_dir: str; a directory in which to store the assembled 
+                         pipeline, which is then reloaded on subsequent runs
+                         instead of being rebuilt from the resource files.
+            - consolidate_lexicons: bool; apply all lexicons with a single 
+                                    LexiconBank component instead of one 
+                                    component per label.
+            - date_formats: list; the names of the date formats to annotate 
+                            (see DATE_FORMATS). If None, the default formats
+                            are used.
+            - prefilter: bool; skip the pipeline for texts that contain none
+                         of the words that mentions are derived from (see
+                         CandidatePrefilter).
+            - sentence_scope: bool; only annotate the sentences of a text 
+                              that contain candidate mentions, with their 
+                              section headers (see get_candidate_windows).
+                              Faster on long texts, but the output can 
+                              differ slightly from annotating the whole text,
+                              e.g. where the parser would have placed other
+                              sentence boundaries.
             - verbose: bool; print all messages.
         """
         print('Self-harm annotator')
-        self.nlp = spacy.load('en_core_web_sm', disable=['ner'])
         self.gender = gender
         self.text = None
+        self.precompile_rules = precompile_rules
+        self.cache_dir = cache_dir
+        self.consolidate_lexicons = consolidate_lexicons
+        self.date_formats = date_formats
         self.verbose = verbose
+        self.prefilter = None
+        self.sentence_scope = sentence_scope
+        self.candidate_filter = None
+        self.header_filter = None
+
+        cache = None
+        if self.cache_dir is not None:
+            cache = PipelineCache(self.cache_dir, 'resources', model=SPACY_MODEL, extra_keys=[self.gender, 'consolidate_lexicons=' + str(self.consolidate_lexicons), 'date_formats=' + str(self.date_formats)])
+
+        if cache is not None and cache.exists():
+            self.load_from_cache(cache)
+        else:
+            self.build_pipeline()
+            if cache is not None:
+                self.save_to_cache(cache)
+
+        # store the attributes set by the pipeline in attribute tables
+        register_attributes(self.get_pipeline_attributes())
+
+        if prefilter or sentence_scope:
+            self.candidate_filter = CandidatePrefilter(self.nlp, verbose=self.verbose)
+        if prefilter:
+            self.prefilter = self.candidate_filter
+        if sentence_scope:
+            # words without which no token is in a history section
+            self.header_filter = CandidatePrefilter(self.nlp, attribute='HISTORY', values=('HISTORY',), verbose=self.verbose)
+        
+        print('-- Gender:', self.gender, file=sys.stderr)
+        print('-- Pipeline:', file=sys.stderr)
+        print('  -- ' + '\n  -- '.join(self.nlp.pipe_names), file=sys.stderr)
+
+    def build_pipeline(self):
+        """
+        Build the annotation pipeline from the resource files.
+        """
+        self.nlp = spacy.load(SPACY_MODEL, disable=['ner'])
+        self.base_pipe_names = list(self.nlp.pipe_names)
         
         # initialise
         # Load pronoun lemma corrector
         self.load_pronoun_lemma_corrector()
         
         # Load date annotator
-        self.load_date_annotator()
+        self.load_date_annotator(self.date_formats)
 
         # Load detokenizer
         self.load_detokenizer(os.path.join('resources', 'detokenization_rules.txt'))
 
         # Load lexical annotators
+        if self.consolidate_lexicons:
+            self.lexicon_bank = LexiconBank(self.nlp)
         self.load_lexicon('./resources/history_type_lex.txt', LOWER, 'LA')
         self.load_lexicon('./resources/sh_lex.txt', LEMMA, 'SH')
         self.load_lexicon('./resources/sh_type_lex.txt', LEMMA, 'SH_TYPE')
@@ -92,6 +197,8 @@ class SelfHarmAnnotator:
         self.load_lexicon('./resources/harm_action_type_lex.txt', LEMMA, 'HA_TYPE')
         self.load_lexicon('./resources/med_lex.txt', LEMMA, 'LA')
         #self.load_lexicon('./resources/reported_speech_lex.txt', LEMMA, 'RSPEECH')
+        if self.consolidate_lexicons:
+            self.nlp.add_pipe(self.lexicon_bank, last=True)
 
         # Load token sequence annotators
         self.load_token_sequence_annotator('history')
@@ -108,10 +215,129 @@ class SelfHarmAnnotator:
             self.load_token_sequence_annotator('status_fem')
         else:
             self.load_token_sequence_annotator('status')
+
+    def get_pipeline_attributes(self):
+        """
+        Get the custom token attributes that are set by the pipeline 
+        components.
         
-        print('-- Gender:', self.gender, file=sys.stderr)
-        print('-- Pipeline:', file=sys.stderr)
-        print('  -- ' + '\n  -- '.join(self.nlp.pipe_names), file=sys.stderr)
+        Return:
+            - names: list; the attribute names, sorted.
+        """
+        names = set()
+        for (_, component) in self.nlp.pipeline:
+            if isinstance(component, LemmaAnnotator):
+                names.add(component.attribute)
+            elif isinstance(component, LexicalAnnotator):
+                names.add(component.target_attribute)
+            elif isinstance(component, LexiconBank):
+                names.update(group['target_attribute'] for group in component.groups)
+            elif isinstance(component, TokenSequenceAnnotator):
+                for rule in component.rules:
+                    for avm in rule['avm'].values():
+                        names.update(name for name in avm.keys() if name not in DEFAULT_ATTRIBUTES)
+            elif isinstance(component, DateTokenAnnotator):
+                names.add('TIME')
+        
+        return sorted(names)
+
+    def get_component_spec(self, component):
+        """
+        Get a serialisable specification from which a custom pipeline 
+        component can be recreated.
+        
+        Arguments:
+            - component: object; a custom pipeline component.
+        
+        Return:
+            - spec: dict; the component specification.
+        """
+        if isinstance(component, LemmaCorrector):
+            return {'type': 'lemma_corrector'}
+        if isinstance(component, DateTokenAnnotator):
+            return {'type': 'date_token_annotator', 'formats': component.formats}
+        if isinstance(component, LexicalAnnotator):
+            return {'type': 'lexical',
+                    'name': component.name,
+                    'terms': component.terms,
+                    'label': component.label,
+                    'source_attribute': component.source_attribute,
+                    'target_attribute': component.target_attribute,
+                    'merge': component.merge,
+                    'patterns': [pattern.to_bytes(exclude=['user_data']) for pattern in component.patterns]
+                    }
+        if isinstance(component, LemmaAnnotator):
+            return {'type': 'lemma',
+                    'name': component.name,
+                    'lemma_sequences': component.lemma_sequences,
+                    'label': component.label,
+                    'attribute': component.attribute,
+                    'merge': component.merge
+                    }
+        if isinstance(component, LexiconBank):
+            groups = []
+            for group in component.groups:
+                group = dict(group)
+                if group['patterns'] is not None:
+                    group['patterns'] = [pattern.to_bytes(exclude=['user_data']) for pattern in group['patterns']]
+                groups.append(group)
+            return {'type': 'lexicon_bank',
+                    'name': component.name,
+                    'groups': groups
+                    }
+        if isinstance(component, TokenSequenceAnnotator):
+            return {'type': 'token_sequence', 'rule_set': component.rule_set}
+        raise TypeError('-- Unable to cache pipeline component: ' + str(component))
+
+    def save_to_cache(self, cache):
+        """
+        Save the assembled pipeline to a cache.
+        
+        Arguments:
+            - cache: PipelineCache; the cache to save the pipeline to.
+        """
+        custom_names = [name for name in self.nlp.pipe_names if name not in self.base_pipe_names]
+        components = [self.get_component_spec(self.nlp.get_pipe(name)) for name in custom_names]
+        cache.save(self.nlp, components, custom_names)
+
+    def load_from_cache(self, cache):
+        """
+        Load the pipeline from a cache and recreate its custom components.
+        Tokenizer special cases are stored with the base pipeline and matcher
+        patterns are stored with the component specifications, so no resource
+        files need to be read.
+        
+        Arguments:
+            - cache: PipelineCache; the cache to load the pipeline from.
+        """
+        self.nlp, components = cache.load(disable=['ner'])
+        self.base_pipe_names = list(self.nlp.pipe_names)
+
+        for spec in components:
+            if spec['type'] == 'lemma_corrector':
+                self.load_pronoun_lemma_corrector()
+            elif spec['type'] == 'date_token_annotator':
+                self.load_date_annotator(spec['formats'])
+            elif spec['type'] == 'lexical':
+                patterns = [Doc(self.nlp.vocab).from_bytes(pattern) for pattern in spec['patterns']]
+                component = LexicalAnnotator(self.nlp, spec['terms'], spec['source_attribute'], spec['target_attribute'], spec['label'], spec['name'], merge=spec['merge'], patterns=patterns)
+                self.nlp.add_pipe(component, last=True)
+            elif spec['type'] == 'lemma':
+                component = LemmaAnnotator(self.nlp, spec['lemma_sequences'], spec['attribute'], spec['label'], spec['name'], merge=spec['merge'])
+                self.nlp.add_pipe(component, last=True)
+            elif spec['type'] == 'lexicon_bank':
+                component = LexiconBank(self.nlp, spec['name'])
+                for group in spec['groups']:
+                    patterns = group['patterns']
+                    if patterns is not None:
+                        patterns = [Doc(self.nlp.vocab).from_bytes(pattern) for pattern in patterns]
+                    component.add_group(group['name'], group['terms'], group['source_attribute'], group['target_attribute'], group['label'], patterns=patterns)
+                self.lexicon_bank = component
+                self.nlp.add_pipe(component, last=True)
+            elif spec['type'] == 'token_sequence':
+                self.load_token_sequence_annotator(spec['rule_set'])
+            else:
+                raise ValueError('-- Unknown pipeline component type in cache: ' + spec['type'])
 
     def load_lexicon(self, path, source_attribute, target_attribute, merge=False):
         """
@@ -126,6 +352,11 @@ class SelfHarmAnnotator:
             - merge: bool; merge annotated spans into a single span.
         """
         print(path, source_attribute, target_attribute, merge)
+        if self.consolidate_lexicons:
+            if merge:
+                print('-- Warning: spans are not merged by consolidated lexicons:', path, file=sys.stderr)
+            self.lexicon_bank.add_lexicon(path, source_attribute, target_attribute)
+            return
         if source_attribute == LEMMA:
             lsa = LemmaAnnotatorSequence(self.nlp, path, target_attribute, merge=merge)
         else:
@@ -147,12 +378,16 @@ class SelfHarmAnnotator:
         else:
             print('-- ', pipe_name, 'exists already. Component not added.')
 
-    def load_date_annotator(self):
+    def load_date_annotator(self, formats=None):
         """
         Load a pipeline component to match and annotate certain date 
         expressions.
+        
+        Arguments:
+            - formats: list; the names of the date formats to annotate (see 
+                       DATE_FORMATS). If None, the default formats are used.
         """
-        component = DateTokenAnnotator()
+        component = DateTokenAnnotator(formats)
         pipe_name = component.name
 
         if not pipe_name in self.nlp.pipe_names:
@@ -182,7 +417,7 @@ class SelfHarmAnnotator:
                     *must* be the name (without the .py extension) of the file
                     containing the token sequence rules.
         """
-        tsa = TokenSequenceAnnotator(self.nlp, name, verbose=self.verbose)
+        tsa = TokenSequenceAnnotator(self.nlp, name, precompile=self.precompile_rules, verbose=self.verbose)
         if tsa.name not in self.nlp.pipe_names:
             self.nlp.add_pipe(tsa)
 
@@ -223,23 +458,59 @@ class SelfHarmAnnotator:
         doc = self.nlp(text)
         return doc
 
-    def annotate_file(self, path):
+    def read_file(self, path):
         """
-        Annotate the contents of a text file.
+        Read the contents of a text file.
         
         Arguments:
-            - path: str; the path to a text file to annotate.
+            - path: str; the path to a text file.
         
         Return:
-            - doc: spacy Doc; the annotated Doc object.
+            - text: str; the text of the file.
         """
         # TODO check for file in input
         # TODO check encoding
-        f = open(path, 'r', encoding='Latin-1')
-        self.text = f.read()
+        with open(path, 'r', encoding='Latin-1') as f:
+            self.text = f.read()
+        
+        return self.text
+
+    def has_candidates(self, text):
+        """
+        Check whether a text needs to be annotated, i.e. whether the 
+        prefilter (if any) finds a candidate mention in it.
+        
+        Arguments:
+            - text: str; the raw text.
+        
+        Return: bool; False if the text cannot contain a mention, else True.
+        """
+        if self.prefilter is None:
+            return True
+
+        return self.prefilter(text)
 
-        if len(self.text) >= 1000000:
-            print('-- Unable to process very long text text:', path)
+    def annotate_file(self, path, text=None):
+        """
+        Annotate the contents of a text file.
+        
+        Arguments:
+            - path: str; the path to a text file to annotate.
+            - text: str; the contents of the file, if already read with 
+                    read_file (the file is then not read again).
+        
+        Return:
+            - doc: spacy Doc; the annotated Doc object, or None if the text 
+                   is too long to be annotated at once (see 
+                   annotate_long_text).
+        """
+        if text is None:
+            self.read_file(path)
+        else:
+            self.text = text
+
+        if len(self.text) >= MAX_TEXT_LENGTH:
+            print('-- Unable to process very long text at once:', path)
             return None
 
         doc = self.nlp(self.text)
@@ -384,7 +655,51 @@ class SelfHarmAnnotator:
         
         return False
 
-    def has_hedging_noun_previous(self, doc, i, verbose=False):
+    def get_sentence_index(self, doc):
+        """
+        Index the sentences of a document once, so that the sentence of a 
+        token can be looked up without calling Token.sent, which walks the 
+        document to find the sentence boundaries on every call.
+        
+        Arguments:
+            - doc: spaCy Doc; the current Doc object.
+        
+        Return:
+            - sentences: tuple; the sentence number of each token, and the 
+                         start and end token index of each sentence.
+        """
+        sent_ids = [0] * len(doc)
+        sent_starts = []
+        sent_ends = []
+        for (n, sent) in enumerate(doc.sents):
+            sent_ids[sent.start:sent.end] = [n] * (sent.end - sent.start)
+            sent_starts.append(sent.start)
+            sent_ends.append(sent.end)
+        
+        return (sent_ids, sent_starts, sent_ends)
+
+    def get_sentence_bounds(self, doc, i, sentences=None):
+        """
+        Get the start and end token indexes of the sentence of a token.
+        
+        Arguments:
+            - doc: spaCy Doc; the current Doc object.
+            - i: int; the token index in the current Doc object.
+            - sentences: tuple; the sentence index of the document (see 
+                         get_sentence_index). If None, Token.sent is used.
+        
+        Return:
+            - start: int; the index of the first token of the sentence.
+            - end: int; the index after the last token of the sentence.
+        """
+        if sentences is None:
+            sent = doc[i].sent
+            return (sent.start, sent.end)
+        (sent_ids, sent_starts, sent_ends) = sentences
+        
+        return (sent_starts[sent_ids[i]], sent_ends[sent_ids[i]])
+
+    def has_hedging_noun_previous(self, doc, i, verbose=False, sentences=None):
         """
         Search for a hedging noun in the preceding tokens within the current
         sentence.
@@ -393,10 +708,12 @@ class SelfHarmAnnotator:
             - doc: spaCy Doc; the current Doc object.
             - i: int; the token index in the current Doc object to 
                  search from.
+            - sentences: tuple; the sentence index of the document (see 
+                         get_sentence_index).
         
         Return: bool; True if hedging noun found, else False.
         """
-        start = doc[i].sent.start
+        (start, _) = self.get_sentence_bounds(doc, i, sentences)
         end = doc[i].i
         if verbose:
             print('-- Checking for previous hedging noun...')
@@ -475,34 +792,43 @@ class SelfHarmAnnotator:
 
         return self.is_reported_speech(curr_token.head.head)
     
-    def is_section_header(self, doc, i, verbose=True):
+    def is_section_header(self, doc, i, verbose=True, sentences=None):
         """
         Check if a given position in the document is part of a section header.
         
         Arguments:
             - doc: spaCy Doc; the current Doc object.
             - i: int; the token index in the current Doc object to search from.
+            - sentences: tuple; the sentence index of the document (see 
+                         get_sentence_index).
 
         Return: bool; True if section header, else False.
         """
-        cur_sent = doc[i].sent
-        end = len(cur_sent) - 1
-        window = cur_sent[i:end].text
-        if re.search(':', window) is not None:
-            return True
+        (sent_start, sent_end) = self.get_sentence_bounds(doc, i, sentences)
+        # the document index is used as an index in the sentence, i.e. the
+        # tokens of sentence[i:len(sentence) - 1], as a span slice
+        length = sent_end - sent_start
+        start = min(i, length)
+        end = min(length, max(start, length - 1))
+        for j in range(sent_start + start, sent_start + end):
+            if ':' in doc[j].text:
+                return True
         return False
     
-    def is_singleton(self, doc, i):
+    def is_singleton(self, doc, i, sentences=None):
         """
         Check if the token at a specified index is the only one in the sentence.
         
         Arguments:
             - doc: spaCy Doc; the current Doc object.
             - i: int; the token index in the current Doc object to check.
+            - sentences: tuple; the sentence index of the document (see 
+                         get_sentence_index).
         
         Return: bool; True if section header, else False.
         """
-        if doc[i].text == doc[i].sent.text:
+        (sent_start, sent_end) = self.get_sentence_bounds(doc, i, sentences)
+        if sent_end - sent_start == 1:
             return True
         return False
     
@@ -537,121 +863,146 @@ class SelfHarmAnnotator:
                                    in the document, else False.
         
         """
+        sentences = self.get_sentence_index(doc)
+        table = get_attribute_table(doc)
+        mention_indexes = table.find('SH', ['SH', 'NON_SH'])
+        if len(mention_indexes) == 0:
+            return False
+
+        # The windows are queried with WindowIndex instead of scanning their
+        # tokens. The values of tokens other than mentions do not change in
+        # the first pass, so they are indexed once; the values of mentions
+        # are set as mentions are processed in order, so previous mentions
+        # are tracked separately: the last one with NEG, MODALITY or HEDGING,
+        # and the prefix counts of those with a TIME marker.
+        is_context = ~table.mask('SH', ['SH', 'NON_SH'])
+        neg_index = WindowIndex(table.mask('NEG', ['NEG']) & is_context)
+        time_index = WindowIndex(table.mask('TIME', ['TIME', 'PAST', 'PRESENT']) & is_context)
+        modality_index = WindowIndex(table.mask('MODALITY', ['MODALITY']) & is_context)
+        hedging_index = WindowIndex(table.mask('HEDGING', ['HEDGING']) & is_context)
+        (last_neg, last_modality, last_hedging) = (-1, -1, -1)
+        time_counts = [0]
+
         # Hack: get attributes from window of 5 tokens before SH mention
         has_history_section = False
-        for i in range(len(doc)):
-            if doc[i]._.SH in ['SH', 'NON_SH']:
-
-                # if token is in a history section annotate as historical
-                if doc[i]._.HISTORY == 'HISTORY':
-                    has_history_section = True
-                    doc[i]._.TIME = 'TIME'
-
-                if self.has_negation_ancestor(doc[i]) and not self.is_definite(doc, i):
-                    if verbose:
-                        print('-- Negation detected for', doc[i])
-                    doc[i]._.NEG = 'NEG'
+        for i in mention_indexes:
+            # if token is in a history section annotate as historical
+            if table.get('HISTORY', i) == 'HISTORY':
+                has_history_section = True
+                table.set('TIME', i, 'TIME')
+
+            if self.has_negation_ancestor(doc[i]) and not self.is_definite(doc, i):
+                if verbose:
+                    print('-- Negation detected for', doc[i])
+                table.set('NEG', i, 'NEG')
                 
-                if self.has_hedging_noun_previous(doc, i):
-                    if verbose:
-                        print('-- Hedging noun detected for', doc[i])
-                    doc[i]._.HEDGING = 'HEDGING'
+            if self.has_hedging_noun_previous(doc, i, sentences=sentences):
+                if verbose:
+                    print('-- Hedging noun detected for', doc[i])
+                table.set('HEDGING', i, 'HEDGING')
                 
-                if self.is_singleton(doc, i):
-                    # mark as HEDGING (NON-RELEVANT)
-                    if verbose:
-                        print('-- Singleton', doc[i])
-                    doc[i]._.HEDGING = 'HEDGING'
+            if self.is_singleton(doc, i, sentences=sentences):
+                # mark as HEDGING (NON-RELEVANT)
+                if verbose:
+                    print('-- Singleton', doc[i])
+                table.set('HEDGING', i, 'HEDGING')
                 
-                if self.is_section_header(doc, i):
-                    if verbose:
-                        print('-- Section header', doc[i])
-                    doc[i]._.HEDGING = 'HEDGING'
+            if self.is_section_header(doc, i, sentences=sentences):
+                if verbose:
+                    print('-- Section header', doc[i])
+                table.set('HEDGING', i, 'HEDGING')
                 
-                # Lowers results
-                #if self.has_propatt_ancestor(doc[i]):
-                #    print('-- Propositional attitude', doc[i])
-                #    doc[i]._.HEDGING = 'HEDGING'
+            # Lowers results
+            #if self.has_propatt_ancestor(doc[i]):
+            #    print('-- Propositional attitude', doc[i])
+            #    table.set('HEDGING', i, 'HEDGING')
                 
-                # Lowers results
-                #if self.has_hedging_ancestor(doc[i]):
-                #    print('-- Hedging ancestor detected for', doc[i])
-                #    doc[i]._.HEDGING = 'HEDGING'
-
-                # Lowers results
-                #if self.has_hedging_dependent(doc[i]):
-                #    print('-- Hedging dependent detected for', doc[i])
-                #    doc[i]._.HEDGING = 'HEDGING'
+            # Lowers results
+            #if self.has_hedging_ancestor(doc[i]):
+            #    print('-- Hedging ancestor detected for', doc[i])
+            #    table.set('HEDGING', i, 'HEDGING')
+
+            # Lowers results
+            #if self.has_hedging_dependent(doc[i]):
+            #    print('-- Hedging dependent detected for', doc[i])
+            #    table.set('HEDGING', i, 'HEDGING')
                 
-                # Slight decrease p, slight increase r, slight increase f
-                #if self.has_historical_ancestor(doc[i]):
-                #    print('-- Historical marker detected for', doc[i])
-                #    doc[i]._.TIME = 'TIME'
-
-                # Lowers results
-                #if self.has_historical_dependent(doc[i]):
-                #    print('-- Historical marker detected for', doc[i])
-                #    doc[i]._.TIME = 'TIME'
-
-                # Check previous tokens in window going back from mention
-                curr_sent = doc[i].sent
-                start = i - BWD_OFFSET
-                if start < 0:
-                    start = curr_sent.start
-                window = doc[start:i]
-                for token in reversed(window):
-                    if token.sent == curr_sent:
-                        # Intended to deal with incorrect HEDGING, but reduces
-                        # performance on other attributes for a slight improvement
-                        # A colon indicates previous words are likely to be a list heading,
-                        # and so are irrelevant
-                        #if token.lemma_ == ':':
-                        #    break
-                        # Improves status, decreases temporality
-                        # Break on newline, consider it a sentence boundary
-                        #if token.pos_ == 'SPACE':
-                        #    break
-                        # Definite mentions are positive
-                        found_present = False
-                        if not self.is_definite(doc, i) and token._.NEG == 'NEG':
-                            doc[i]._.NEG = 'NEG'
-                        if not found_present and token._.TIME in ['TIME', 'PAST']:
-                            doc[i]._.TIME = 'TIME'
-                        # Overwrite past mentions with present
-                        if token._.TIME == 'PRESENT':
-                            doc[i]._.TIME = False
-                            found_present = True
-                        if token._.MODALITY == 'MODALITY':
-                            doc[i]._.MODALITY = 'MODALITY'
-                        if token._.HEDGING == 'HEDGING':
-                            doc[i]._.HEDGING = 'HEDGING'
+            # Slight decrease p, slight increase r, slight increase f
+            #if self.has_historical_ancestor(doc[i]):
+            #    print('-- Historical marker detected for', doc[i])
+            #    table.set('TIME', i, 'TIME')
+
+            # Lowers results
+            #if self.has_historical_dependent(doc[i]):
+            #    print('-- Historical marker detected for', doc[i])
+            #    table.set('TIME', i, 'TIME')
+
+            # Check previous tokens in window going back from mention,
+            # within the same sentence
+            (sent_start, _) = self.get_sentence_bounds(doc, i, sentences)
+            start = max(i - BWD_OFFSET, sent_start)
+            # Intended to deal with incorrect HEDGING, but reduces
+            # performance on other attributes for a slight improvement
+            # A colon indicates previous words are likely to be a list heading,
+            # and so are irrelevant
+            #if token.lemma_ == ':':
+            #    break
+            # Improves status, decreases temporality
+            # Break on newline, consider it a sentence boundary
+            #if token.pos_ == 'SPACE':
+            #    break
+            # Definite mentions are positive
+            if not self.is_definite(doc, i) and (neg_index.any(start, i) or last_neg >= start):
+                table.set('NEG', i, 'NEG')
+            # Going back from the mention, TIME and PAST set TIME and PRESENT
+            # unsets it (overwrite past mentions with present), so the marker
+            # furthest from the mention decides
+            j = time_index.first(start, i)
+            m_start = bisect_left(mention_indexes, start)
+            m_end = bisect_left(mention_indexes, i if j is None else j)
+            if time_counts[m_end] > time_counts[m_start]:
+                j = mention_indexes[bisect_left(time_counts, time_counts[m_start] + 1) - 1]
+            if j is not None:
+                table.set('TIME', i, 'TIME' if table.get('TIME', j) in ['TIME', 'PAST'] else False)
+            if modality_index.any(start, i) or last_modality >= start:
+                table.set('MODALITY', i, 'MODALITY')
+            if hedging_index.any(start, i) or last_hedging >= start:
+                table.set('HEDGING', i, 'HEDGING')
+
+            if table.get('NEG', i) == 'NEG':
+                last_neg = i
+            if table.get('MODALITY', i) == 'MODALITY':
+                last_modality = i
+            if table.get('HEDGING', i) == 'HEDGING':
+                last_hedging = i
+            time_counts.append(time_counts[-1] + (table.get('TIME', i) in ['TIME', 'PAST', 'PRESENT']))
 
         # Hack: get attributes from window of 5 tokens after SH mention in the same sentence
-        for i in range(len(doc)):
-            if doc[i]._.SH in ['SH', 'NON_SH']:
-                curr_sent = doc[i].sent
-                end = i + FWD_OFFSET
-                if end > curr_sent.start + len(curr_sent):
-                    end = curr_sent.start + len(curr_sent)
-                window = doc[i:end]
-                found_CCONJ = False # used for MODALITY and HEDGING
-                for token in window:
-                    if token.sent == curr_sent:
-                        # Increases status for MODALITY and HEDGING, not TIME
-                        # Coordinating conjunction is a syntactic "barrier", 
-                        # so we avoid examining features beyond.
-                        if token.pos_ == 'CCONJ':
-                            if verbose:
-                                print('-- Found subsequent CCONJ', token.text)
-                            found_CCONJ = True
-                        if token._.TIME in ['TIME', 'PAST']:
-                            doc[i]._.TIME = 'TIME'
-                        if token._.MODALITY == 'MODALITY':
-                            if not found_CCONJ:
-                                doc[i]._.MODALITY = 'MODALITY'
-                        if token._.HEDGING == 'HEDGING':
-                            if not found_CCONJ:
-                                doc[i]._.HEDGING = 'HEDGING'
+        # (the values set here are only read by the same mention, so all
+        # windows are queried against the values after the first pass)
+        time_index = WindowIndex(table.mask('TIME', ['TIME', 'PAST']))
+        modality_index = WindowIndex(table.mask('MODALITY', ['MODALITY']))
+        hedging_index = WindowIndex(table.mask('HEDGING', ['HEDGING']))
+        cconj_index = WindowIndex(doc.to_array(POS) == CCONJ)
+        for i in mention_indexes:
+            (_, sent_end) = self.get_sentence_bounds(doc, i, sentences)
+            end = min(i + FWD_OFFSET, sent_end)
+            # Increases status for MODALITY and HEDGING, not TIME
+            # Coordinating conjunction is a syntactic "barrier", 
+            # so we avoid examining features beyond.
+            barrier = cconj_index.first(i, end)
+            if barrier is None:
+                barrier = end
+            elif verbose:
+                for j in range(barrier, end):
+                    if doc[j].pos_ == 'CCONJ':
+                        print('-- Found subsequent CCONJ', doc[j].text)
+            if time_index.any(i, end):
+                table.set('TIME', i, 'TIME')
+            if modality_index.any(i, barrier):
+                table.set('MODALITY', i, 'MODALITY')
+            if hedging_index.any(i, barrier):
+                table.set('HEDGING', i, 'HEDGING')
 
         return has_history_section
 
@@ -666,51 +1017,23 @@ class SelfHarmAnnotator:
             - doc: spaCy Doc; the current Doc object with merged longest spans.
         """
 
-        def get_longest_spans(offsets):
-            """
-            Get a unique list of all overlapping span offsets.
-            
-            Arguments:
-                - offsets: list; the list of offsets.
-            
-            Return:
-                - offsets: list; the list of offsets sorted in decreasing order
-                           of difference between start and end.
-            """
-            overlaps = {}
-            for offset in offsets:
-                o = [(i[0], i[1]) for i in offsets if
-                     i[0] >= offset[0] and i[0] <= offset[1] or i[1] >= offset[0] and i[1] <= offset[1] if
-                     (i[0], i[1]) != offset and (i[0], i[1]) and (i[0], i[1]) not in overlaps]
-                if len(o) > 0:
-                    overlaps[offset] = o
-
-            for offset in [[k] + v for (k, v) in overlaps.items()]:
-                shortest_spans = sorted(offset, key=lambda x: x[1] - x[0], reverse=True)[1:]
-                for ss in shortest_spans:
-                    if ss in offsets:
-                        offsets.remove(ss)
-            
-            return offsets
-
+        table = get_attribute_table(doc)
         offsets = []
         i = 0
         while i < len(doc):
-            token = doc[i]
-            if token._.SH:
+            if table.get('SH', i):
                 start = i
-                while token._.SH:
+                while table.get('SH', i):
                     i += 1
                     if i == len(doc):
-                        print('-- Warning: index is equal to document length:', i, token, len(doc), file=sys.stderr)
+                        print('-- Warning: index is equal to document length:', i, doc[i - 1], len(doc), file=sys.stderr)
                         break
-                    token = doc[i]
                 end = i
                 offsets.append((start, end))
             i += 1
 
         #print('BEFORE:', offsets, file=sys.stderr)
-        #offsets = get_longest_spans(offsets)
+        #offsets = select_longest_spans(offsets)
         #print('AFTER :', offsets, file=sys.stderr)
         
         with doc.retokenize() as retokenizer:
@@ -750,11 +1073,7 @@ class SelfHarmAnnotator:
         s += '\n\n'
         s += '{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}'.format('INDEX', 'WORD', 'LEMMA', 'LOWER', 'POS1', 'POS2', 'HEAD', 'DEP')
 
-        cext = set()        
-        for a in doc.user_data:
-            cext.add(a[1])
-
-        cext = sorted(cext)
+        cext = get_attribute_names(doc)
 
         for a in cext:
             s += '{:<10}'.format(a)
@@ -786,14 +1105,16 @@ class SelfHarmAnnotator:
             - mentions: dict; a dictionary containing all annotations ready for
                         output in eHOST XML format.
         """
+        table = get_attribute_table(doc)
         mentions = {}
         n = 1
-        for token in doc:
-            if token._.SH == 'SH':
+        for i in table.find('SH', ['SH', 'NON_SH']):
+            token = doc[i]
+            if table.get('SH', i) == 'SH':
                 mention_id = 'EHOST_Instance_' + str(n)
                 annotator = 'SYSTEM'
                 mclass = 'SELF-HARM'
-                sh_type = token._.SH_TYPE
+                sh_type = table.get('SH_TYPE', i)
                 comment = None
                 start = token.idx
                 end = token.idx + len(token.text)
@@ -801,16 +1122,16 @@ class SelfHarmAnnotator:
                 status = 'RELEVANT'
                 temporality = 'CURRENT'
                 text = token.text
-                if token._.NEG == 'NEG':
+                if table.get('NEG', i) == 'NEG':
                     polarity = 'NEGATIVE'
                     status = 'NON-RELEVANT'
-                if token._.MODALITY == 'MODALITY':
+                if table.get('MODALITY', i) == 'MODALITY':
                     status = 'UNCERTAIN'
-                if token._.HEDGING == 'HEDGING':
+                if table.get('HEDGING', i) == 'HEDGING':
                     status = 'NON-RELEVANT'
-                if token._.HEDGING == 'UNCERTAIN':
+                if table.get('HEDGING', i) == 'UNCERTAIN':
                     status = 'UNCERTAIN'
-                if token._.TIME in ['HISTORICAL', 'TIME']:
+                if table.get('TIME', i) in ['HISTORICAL', 'TIME']:
                     temporality = 'HISTORICAL'
                 n += 1
                 mentions[mention_id] = {'annotator': annotator,
@@ -824,7 +1145,7 @@ class SelfHarmAnnotator:
                                         'temporality': temporality,
                                         'text': text
                                         }
-            elif token._.SH == 'NON_SH':
+            elif table.get('SH', i) == 'NON_SH':
                 mention_id = 'EHOST_Instance_' + str(n)
                 annotator = 'SYSTEM'
                 mclass = 'SELF-HARM'
@@ -835,9 +1156,9 @@ class SelfHarmAnnotator:
                 status = 'NON-RELEVANT'
                 temporality = 'CURRENT'
                 text = token.text
-                if token._.NEG == 'NEG':
+                if table.get('NEG', i) == 'NEG':
                     polarity = 'NEGATIVE'
-                if token._.TIME in ['HISTORICAL', 'TIME']:
+                if table.get('TIME', i) in ['HISTORICAL', 'TIME']:
                     temporality = 'HISTORICAL'
                 n += 1
                 mentions[mention_id] = {'annotator': annotator,
@@ -854,7 +1175,7 @@ class SelfHarmAnnotator:
         
         return mentions
 
-    def write_ehost_output(self, pin, annotations, verbose=False):
+    def write_ehost_output(self, pin, annotations, verbose=False, compact=False):
         """
         Write an annotated eHOST XML file to disk.
         
@@ -862,140 +1183,29 @@ class SelfHarmAnnotator:
             - pin: str; the input file path (must be in eHOST directory structure).
             - annotations: dict; the dictionary of detected annotations.
             - verbose: bool; print all messages.
+            - compact: bool; write the XML without indentation and line breaks.
         
         Return:
-            - root: Element; the root node of the new XML ElementTree object.
+            - xml: str; the XML document, or None if it could not be created.
         """
         ehost_pout = os.path.splitext(pin.replace('corpus', 'saved'))[0] + '.txt.knowtator.xml'
+        text_source = os.path.basename(os.path.splitext(pin.replace('.knowtator.xml', ''))[0] + '.txt')
 
-        root = ET.Element('annotations')
-        root.attrib['textSource'] = os.path.basename(os.path.splitext(pin.replace('.knowtator.xml', ''))[0] + '.txt')
-
-        n = 1
-        m = 1000
-        for annotation_id in sorted(annotations.keys()):
-            annotation = annotations[annotation_id]
-
-            annotation_node = ET.SubElement(root, 'annotation')
-            mention = ET.SubElement(annotation_node, 'mention')
-            mention_id = 'EHOST_Instance_' + str(n)
-            mention.attrib['id'] = mention_id
-            annotator = ET.SubElement(annotation_node, 'annotator')
-            annotator.attrib['id'] = 'eHOST_2010'
-            annotator.text = annotation['annotator']
-            spanned_text = ET.SubElement(annotation_node, 'spannedText')
-
-            if annotation.get('comment', None) is not None:
-                comment = ET.SubElement(annotation_node, 'annotationComment')
-                comment.text = annotation['comment']
-
-            creation_date = ET.SubElement(annotation_node, 'creationDate')
-            creation_date.text = datetime.now().strftime('%a %b %d %H:%M:%S %Z%Y')
-
-            span = ET.SubElement(annotation_node, 'span')
-            span.attrib['start'] = annotation['start']
-            span.attrib['end'] = annotation['end']
-
-            spanned_text.text = annotation['text']
-
-            class_mention = ET.SubElement(root, 'classMention')
-            class_mention.attrib['id'] = mention_id
-            mention_class_node = ET.SubElement(class_mention, 'mentionClass')
-            mention_class_node.attrib['id'] = annotation['class']
-            mention_class_node.text = annotation['text']
-
-            # sh_type
-            val = annotation.get('sh_type', 'SELF-HARM')
-            slot_mention_node = ET.SubElement(root, 'stringSlotMention')
-            slot_mention_node.attrib['id'] = 'EHOST_Instance_' + str(m)
-            mention_slot_node = ET.SubElement(slot_mention_node, 'mentionSlot')
-            mention_slot_node.attrib['id'] = 'sh_type'
-            string_mention_value_node = ET.SubElement(slot_mention_node, 'stringSlotMentionValue')
-            string_mention_value_node.attrib['value'] = val
-            has_slot_mention_node = ET.SubElement(class_mention, 'hasSlotMention')
-            has_slot_mention_node.attrib['id'] = 'EHOST_Instance_' + str(m)
-            
-            # polarity
-            m += 1
-            val = annotation.get('polarity', 'POSITIVE')
-            slot_mention_node = ET.SubElement(root, 'stringSlotMention')
-            slot_mention_node.attrib['id'] = 'EHOST_Instance_' + str(m)
-            mention_slot_node = ET.SubElement(slot_mention_node, 'mentionSlot')
-            mention_slot_node.attrib['id'] = 'polarity'
-            string_mention_value_node = ET.SubElement(slot_mention_node, 'stringSlotMentionValue')
-            string_mention_value_node.attrib['value'] = val
-            has_slot_mention_node = ET.SubElement(class_mention, 'hasSlotMention')
-            has_slot_mention_node.attrib['id'] = 'EHOST_Instance_' + str(m)
-
-            # status
-            m += 1
-            val = annotation.get('status', 'NON-RELEVANT')
-            slot_mention_node = ET.SubElement(root, 'stringSlotMention')
-            slot_mention_node.attrib['id'] = 'EHOST_Instance_' + str(m)
-            mention_slot_node = ET.SubElement(slot_mention_node, 'mentionSlot')
-            mention_slot_node.attrib['id'] = 'status'
-            string_mention_value_node = ET.SubElement(slot_mention_node, 'stringSlotMentionValue')
-            string_mention_value_node.attrib['value'] = val
-            has_slot_mention_node = ET.SubElement(class_mention, 'hasSlotMention')
-            has_slot_mention_node.attrib['id'] = 'EHOST_Instance_' + str(m)
-
-            # temporality
-            m += 1
-            val = annotation.get('temporality', 'CURRENT')
-            slot_mention_node = ET.SubElement(root, 'stringSlotMention')
-            slot_mention_node.attrib['id'] = 'EHOST_Instance_' + str(m)
-            mention_slot_node = ET.SubElement(slot_mention_node, 'mentionSlot')
-            mention_slot_node.attrib['id'] = 'temporality'
-            string_mention_value_node = ET.SubElement(slot_mention_node, 'stringSlotMentionValue')
-            string_mention_value_node.attrib['value'] = val
-            has_slot_mention_node = ET.SubElement(class_mention, 'hasSlotMention')
-            has_slot_mention_node.attrib['id'] = 'EHOST_Instance_' + str(m)
-            
-            n += 1
-            m += 1
-
-        # Create Adjudication status with default values
-        adj_status = ET.SubElement(root, 'eHOST_Adjudication_Status')
-        adj_status.attrib['version'] = '1.0'
-        adj_sa = ET.SubElement(adj_status, 'Adjudication_Selected_Annotators')
-        adj_sa.attrib['version'] = '1.0'
-        adj_sc = ET.SubElement(adj_status, 'Adjudication_Selected_Classes')
-        adj_sc.attrib['version'] = '1.0'
-        adj_o = ET.SubElement(adj_status, 'Adjudication_Others')
-        check_s = ET.SubElement(adj_o, 'CHECK_OVERLAPPED_SPANS')
-        check_s.text = 'false'
-        check_a = ET.SubElement(adj_o, 'CHECK_ATTRIBUTES')
-        check_a.text = 'false'
-        check_r = ET.SubElement(adj_o, 'CHECK_RELATIONSHIP')
-        check_r.text = 'false'
-        check_cl = ET.SubElement(adj_o, 'CHECK_CLASS')
-        check_cl.text = 'false'
-        check_co = ET.SubElement(adj_o, 'CHECK_COMMENT')
-        check_co.text = 'false'
-
-        # Print to screen
-        xmlstr = ET.tostring(root, encoding='utf8', method='xml')
-        try:
-            pxmlstr = parseString(xmlstr)
-        except ExpatError as e:
+        # one creation date for all annotations in the document
+        xml = write_ehost_xml(ehost_pout, text_source, annotations, get_creation_date(), compact=compact)
+        if xml is None:
             with open('./batch_err.log', 'a') as b_err:
                 print('Unable to create XML file:', ehost_pout, file=b_err)
             b_err.close()
-            return root
-
-        if verbose:
-            print(pxmlstr.toprettyxml(indent='\t'), file=sys.stderr)
-
-        with open(ehost_pout, 'w') as fout:
-            fout.write(pxmlstr.toprettyxml(indent='\t'))
-        fout.close()
+            return None
 
         if verbose:
+            print(xml, file=sys.stderr)
             print('-- Wrote eHOST file: ' + ehost_pout, file=sys.stderr)
 
-        return root
+        return xml
 
-    def process(self, path, write_output=True):
+    def process(self, path, write_output=True, n_process=1):
         """
         Process a single document or directory structure.
         
@@ -1003,6 +1213,8 @@ class SelfHarmAnnotator:
             - path: str; indicates text file or directory to process. If a directory, the
                 structure must be that used by the eHOST annotation tool.
             - write_output: bool; save the annotated output to file.
+            - n_process: int; the number of worker processes used for a 
+                         directory, or for the chunks of a very long file.
         
         Return:
             - global_mentions: dict; a dictionary containing all annotated mentions.
@@ -1011,54 +1223,20 @@ class SelfHarmAnnotator:
 
         if os.path.isdir(path):
             
-            files = os.listdir(path)
-            
-            for f in files:
-                pin = os.path.join(path, f)
-                print('-- Processing file:', pin, file=sys.stderr)
-                if self.verbose:
-                    print('-- Processing file:', pin, file=sys.stderr)
-
-                # Annotate and print results
-                doc = self.annotate_file(pin)
-                
-                if doc is None:
-                    return global_mentions
-                
-                self.calculate_sh_mention_attributes(doc)
-                
-                doc = self.merge_spans(doc)
-                
-                if self.verbose:
-                    self.print_spans(doc)
-                
-                mentions = self.build_ehost_output(doc)
-                global_mentions[f + '.knowtator.xml'] = mentions
-                
-                if write_output:
-                    self.write_ehost_output(pin, mentions, verbose=self.verbose)
+            dir_mentions = self.process_dirs([path], write_output=write_output, n_process=n_process)
+            for (pin, mentions) in dir_mentions.items():
+                global_mentions[os.path.basename(pin) + '.knowtator.xml'] = mentions
                 
         elif os.path.isfile(path):
             print('-- Processing file:', path, file=sys.stderr)
-            doc = self.annotate_file(path)
+            mentions = self.process_file(path, write_output=write_output, n_process=n_process)
             
-            if doc is None:
+            if mentions is None:
                 return global_mentions
             
-            self.calculate_sh_mention_attributes(doc)
-            
-            doc = self.merge_spans(doc)
-            
-            if self.verbose:
-                self.print_spans(doc)
-            
-            mentions = self.build_ehost_output(doc)
             key = os.path.basename(path)
             global_mentions[key] = mentions
 
-            if write_output:
-                self.write_ehost_output(path, mentions, verbose=self.verbose)
-
         else:
             print('-- Processing text string:', path, file=sys.stderr)
             doc = self.nlp(path)
@@ -1078,7 +1256,113 @@ class SelfHarmAnnotator:
         
         return global_mentions
 
-    def process_text(self, text, text_id, write_output=False, verbose=False):
+    def process_file(self, pin, write_output=True, n_process=1):
+        """
+        Process a single text file.
+        
+        Arguments:
+            - pin: str; the text file to process.
+            - write_output: bool; save the annotated output to file.
+            - n_process: int; the number of worker processes used for the 
+                         chunks of a very long text.
+        
+        Return:
+            - mentions: dict; the annotated mentions.
+        """
+        text = self.read_file(pin)
+        if not self.has_candidates(text):
+            mentions = {}
+            if write_output:
+                self.write_ehost_output(pin, mentions, verbose=self.verbose)
+            return mentions
+
+        if self.sentence_scope:
+            mentions = self.annotate_windows(text, n_process=n_process)
+        elif len(text) >= MAX_TEXT_LENGTH:
+            print('-- Processing very long text in chunks:', pin, file=sys.stderr)
+            mentions = self.annotate_long_text(text, n_process=n_process)
+        else:
+            mentions = self.get_mentions(self.annotate_file(pin, text=text))
+        
+        if write_output:
+            self.write_ehost_output(pin, mentions, verbose=self.verbose)
+        
+        return mentions
+
+    def try_process_file(self, pin, write_output=True):
+        """
+        Process a single text file, as process_file, but skip a file that 
+        cannot be processed (e.g. unreadable or not valid text) with a 
+        warning rather than raising.
+        
+        Arguments:
+            - pin: str; the text file to process.
+            - write_output: bool; save the annotated output to file.
+        
+        Return:
+            - mentions: dict; the annotated mentions, or None if the file 
+                        could not be processed.
+        """
+        try:
+            return self.process_file(pin, write_output=write_output)
+        except Exception as e:
+            print('-- Warning: skipping file that cannot be processed:', pin, '(' + repr(e) + ')', file=sys.stderr)
+            return None
+
+    def process_dirs(self, paths, write_output=True, n_process=1, chunksize=8):
+        """
+        Process all text files in one or more directories (e.g. the corpus 
+        directories of several patients), optionally spread across several 
+        worker processes. Each worker loads its own pipeline once. Files that 
+        cannot be processed are skipped.
+        
+        Arguments:
+            - paths: list; the directories to process. The structure must be 
+                     that used by the eHOST annotation tool.
+            - write_output: bool; save the annotated output to file.
+            - n_process: int; the number of worker processes.
+            - chunksize: int; the number of files sent to a worker at a time.
+        
+        Return:
+            - global_mentions: dict; the annotated mentions of each processed 
+                               file, keyed by file path.
+        """
+        files = []
+        for path in paths:
+            for f in sorted(os.listdir(path)):
+                pin = os.path.join(path, f)
+                if os.path.isfile(pin):
+                    files.append(pin)
+        
+        global_mentions = {}
+        n_skipped = 0
+        t0 = time()
+        
+        if n_process <= 1:
+            results = ((pin, self.try_process_file(pin, write_output=write_output)) for pin in files)
+            pool = None
+        else:
+            pool = Pool(n_process, initializer=init_worker, initargs=(self.gender, self.precompile_rules, self.cache_dir, self.consolidate_lexicons, self.date_formats, self.prefilter is not None, self.sentence_scope))
+            results = pool.imap(process_file, [(pin, write_output) for pin in files], chunksize=chunksize)
+        
+        try:
+            for (pin, mentions) in results:
+                print('-- Processed file:', pin, file=sys.stderr)
+                if mentions is None:
+                    n_skipped += 1
+                else:
+                    global_mentions[pin] = mentions
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        
+        t1 = time()
+        print('-- Processed', len(global_mentions), 'files, skipped', n_skipped, 'files, in', round(t1 - t0, 2), 's (' + str(round(len(files) / max(t1 - t0, 1e-6), 2)) + ' files/s)', file=sys.stderr)
+        
+        return global_mentions
+
+    def process_text(self, text, text_id, write_output=False, verbose=False, n_process=1):
         """
         Process a text string.
         
@@ -1087,6 +1371,8 @@ class SelfHarmAnnotator:
             - text_id: str; a user-defined identifier for the text.
             - write_output: bool; write output to file.
             - verbose: bool; print all messages.
+            - n_process: int; the number of worker processes used for the 
+                         chunks of a very long text.
 
         Return:
             - global_mentions: dict; a dictionary containing all annotated mentions.
@@ -1099,9 +1385,24 @@ class SelfHarmAnnotator:
         if text is None:
             print('-- Empty text:', text_id)
             return global_mentions
+
+        if not self.has_candidates(text):
+            global_mentions[text_id] = {}
+            if write_output:
+                self.write_ehost_output('output/test.txt', global_mentions[text_id], verbose=self.verbose)
+            return global_mentions
+
+        if self.sentence_scope:
+            global_mentions[text_id] = self.annotate_windows(text, n_process=n_process)
+            if write_output:
+                self.write_ehost_output('output/test.txt', global_mentions[text_id], verbose=self.verbose)
+            return global_mentions
             
-        if len(text) >= 1000000:
-            print('-- Unable to process very long text with id:', text_id)
+        if len(text) >= MAX_TEXT_LENGTH:
+            print('-- Processing very long text in chunks with id:', text_id)
+            global_mentions[text_id] = self.annotate_long_text(text, n_process=n_process)
+            if write_output:
+                self.write_ehost_output('output/test.txt', global_mentions[text_id], verbose=self.verbose)
             return global_mentions
         
         doc = self.nlp(text)
@@ -1123,6 +1424,492 @@ class SelfHarmAnnotator:
         
         return global_mentions
 
+    def get_mentions(self, doc):
+        """
+        Calculate mention attributes, merge spans and build the mention 
+        dictionary for an annotated document.
+        
+        Arguments:
+            - doc: spaCy Doc; the annotated Doc object.
+        
+        Return:
+            - mentions: dict; a dictionary containing all annotations ready for
+                        output in eHOST XML format.
+        """
+        self.calculate_sh_mention_attributes(doc)
+
+        doc = self.merge_spans(doc)
+
+        if self.verbose:
+            self.print_spans(doc)
+
+        return self.build_ehost_output(doc)
+
+    def annotate_batch(self, batch):
+        """
+        Annotate a batch of texts with nlp.pipe.
+        
+        Arguments:
+            - batch: list; a list of (text_id, text) tuples.
+        
+        Return:
+            - results: list; a list of (text_id, mentions) tuples in input order.
+        """
+        results = []
+        valid = []
+        for (text_id, text) in batch:
+            if text is None:
+                print('-- Empty text:', text_id)
+                results.append((text_id, {}))
+            elif not self.has_candidates(text):
+                results.append((text_id, {}))
+            elif self.sentence_scope:
+                results.append((text_id, self.annotate_windows(text)))
+            elif len(text) >= MAX_TEXT_LENGTH:
+                print('-- Processing very long text in chunks with id:', text_id)
+                results.append((text_id, self.annotate_long_text(text)))
+            else:
+                results.append((text_id, None))
+                valid.append(text)
+
+        docs = self.nlp.pipe(valid, batch_size=max(len(valid), 1))
+        for n, (text_id, mentions) in enumerate(results):
+            if mentions is None:
+                results[n] = (text_id, self.get_mentions(next(docs)))
+
+        return results
+
+    def annotate_long_text(self, text, max_length=LONG_TEXT_CHUNK_LENGTH, n_process=1):
+        """
+        Annotate a text that is too long to be processed at once. The text is
+        split into chunks on paragraph, line or sentence boundaries, the 
+        chunks are annotated one batch at a time (optionally across several 
+        worker processes), and the mention offsets are mapped back to the 
+        full text.
+        
+        Arguments:
+            - text: str; the text to annotate.
+            - max_length: int; the maximum length of a chunk.
+            - n_process: int; the number of worker processes.
+        
+        Return:
+            - mentions: dict; a dictionary containing all annotations ready for
+                        output in eHOST XML format.
+        """
+        chunks = split_long_text(text, max_length)
+        offsets = [offset for (offset, _) in chunks]
+        results = self.annotate_stream(enumerate(chunk for (_, chunk) in chunks), batch_size=1, n_process=n_process)
+        
+        return merge_chunk_mentions((offsets[i], mentions) for (i, mentions) in results)
+
+    def annotate_windows(self, text, n_process=1):
+        """
+        Annotate only the parts of a text around candidate mentions (see 
+        get_candidate_windows), and map the mention offsets back to the full
+        text.
+        
+        Arguments:
+            - text: str; the text to annotate.
+            - n_process: int; the number of worker processes used for the 
+                         chunks of very long windows.
+        
+        Return:
+            - mentions: dict; a dictionary containing all annotations ready for
+                        output in eHOST XML format.
+        """
+        windows = get_candidate_windows(text, self.candidate_filter, self.header_filter)
+        docs = self.nlp.pipe([text[start:end] for (start, end) in windows if end - start < MAX_TEXT_LENGTH])
+        
+        chunk_mentions = []
+        for (start, end) in windows:
+            if end - start < MAX_TEXT_LENGTH:
+                chunk_mentions.append((start, self.get_mentions(next(docs))))
+            else:
+                chunk_mentions.append((start, self.annotate_long_text(text[start:end], n_process=n_process)))
+        
+        return merge_chunk_mentions(chunk_mentions)
+
+    def annotate_stream(self, items, batch_size=1000, n_process=1):
+        """
+        Annotate a stream of texts in batches, optionally spread across 
+        several worker processes. Each worker loads its own pipeline once and 
+        returns the mentions for whole batches. Results are yielded in input 
+        order.
+        
+        Arguments:
+            - items: iterable; (text_id, text) tuples.
+            - batch_size: int; the number of texts sent to nlp.pipe at once.
+            - n_process: int; the number of worker processes.
+        
+        Return:
+            - generator; (text_id, mentions) tuples.
+        """
+        batches = iter_batches(items, batch_size)
+
+        if n_process <= 1:
+            for batch in batches:
+                for result in self.annotate_batch(batch):
+                    yield result
+            return
+
+        # submit a bounded number of batches ahead to avoid loading the whole
+        # input into the task queue
+        with Pool(n_process, initializer=init_worker, initargs=(self.gender, self.precompile_rules, self.cache_dir, self.consolidate_lexicons, self.date_formats, self.prefilter is not None, self.sentence_scope)) as pool:
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.apply_async(annotate_batch, (batch,)))
+                if len(pending) >= 2 * n_process:
+                    for result in pending.popleft().get():
+                        yield result
+            while len(pending) > 0:
+                for result in pending.popleft().get():
+                    yield result
+
+    def audit_prefilter(self, items, gold=None, batch_size=100):
+        """
+        Check the recall of the prefilter on a corpus: annotate every text 
+        with the full pipeline and report the texts that the prefilter would
+        skip although they have mentions.
+        
+        Arguments:
+            - items: iterable; (text_id, text) tuples.
+            - gold: dict; the gold standard mentions of each text id, keyed 
+                    by mention id (e.g. parsed with 
+                    ehost_reader.parse_ehost_xml), if the corpus is labelled.
+            - batch_size: int; the number of texts sent to nlp.pipe at once.
+        
+        Return:
+            - lost: list; the ids of skipped texts with system mentions.
+            - lost_gold: list; the ids of skipped texts with gold mentions.
+        """
+        saved_prefilter = self.prefilter
+        saved_sentence_scope = self.sentence_scope
+        prefilter = self.prefilter
+        if prefilter is None:
+            prefilter = CandidatePrefilter(self.nlp, verbose=self.verbose)
+        
+        n_texts = 0
+        n_skipped = 0
+        lost = []
+        lost_gold = []
+        # annotate all texts, including the ones the prefilter skips
+        self.prefilter = None
+        self.sentence_scope = False
+        try:
+            for batch in iter_batches(items, batch_size):
+                for ((text_id, text), (_, mentions)) in zip(batch, self.annotate_batch(batch)):
+                    n_texts += 1
+                    if text is None or prefilter(text):
+                        continue
+                    n_skipped += 1
+                    if len(mentions) > 0:
+                        lost.append(text_id)
+                    if gold is not None and len(gold.get(text_id, {})) > 0:
+                        lost_gold.append(text_id)
+        finally:
+            self.prefilter = saved_prefilter
+            self.sentence_scope = saved_sentence_scope
+        
+        print('-- Prefilter audit:', n_skipped, '/', n_texts, 'texts skipped,', len(lost), 'with system mentions', end='', file=sys.stderr)
+        if gold is not None:
+            print(',', len(lost_gold), 'with gold mentions', end='', file=sys.stderr)
+        print('.', file=sys.stderr)
+        for text_id in lost:
+            print('-- Error: prefilter skips text with system mentions:', text_id, file=sys.stderr)
+        for text_id in lost_gold:
+            print('-- Warning: prefilter skips text with gold mentions:', text_id, file=sys.stderr)
+        
+        return lost, lost_gold
+
+
+def split_long_text(text, max_length=LONG_TEXT_CHUNK_LENGTH):
+    """
+    Split a text into chunks of at most max_length characters. Each chunk 
+    ends after the last paragraph boundary it contains, or failing that the
+    last line, sentence or word boundary, and the text is only cut 
+    elsewhere if a chunk contains none of these.
+    
+    Arguments:
+        - text: str; the text to split.
+        - max_length: int; the maximum length of a chunk.
+    
+    Return:
+        - chunks: list; (offset, chunk) tuples, where offset is the position
+                  of the chunk in the text.
+    """
+    chunks = []
+    start = 0
+    n = len(text)
+    while n - start > max_length:
+        end = start + max_length
+        for boundary in LONG_TEXT_BOUNDARIES:
+            last = None
+            for match in boundary.finditer(text, start, end):
+                last = match
+            # do not cut a boundary in two
+            if last is not None and last.end() < end:
+                end = last.end()
+                break
+        chunks.append((start, text[start:end]))
+        start = end
+    if start < n or n == 0:
+        chunks.append((start, text[start:]))
+    
+    return chunks
+
+
+def get_candidate_windows(text, is_candidate, is_header, max_length=LONG_TEXT_CHUNK_LENGTH):
+    """
+    Select the parts of a text that need to be annotated in sentence scope
+    mode. The text is split cheaply into lines and, within lines, sentences.
+    Mention attributes only depend on the sentence of the mention and on 
+    history sections, which run from a header to the end of its line or, 
+    for a header on its own line, to the end of the next line. Each 
+    sentence with a candidate mention is therefore selected with:
+        - the start of its line, if it contains a header;
+        - the previous line, if it is a header.
+    Windows are extended over the surrounding whitespace, so that line 
+    breaks are kept, and overlapping windows are merged.
+    
+    Arguments:
+        - text: str; the text.
+        - is_candidate: callable; returns True if a string can contain a 
+                        mention (e.g. a CandidatePrefilter).
+        - is_header: callable; returns True if a string can contain a 
+                     history section header.
+        - max_length: int; headers are not added to a window if this would
+                      make it longer than max_length characters.
+    
+    Return:
+        - windows: list; (start, end) offsets of the windows, in text order.
+    """
+    windows = []
+    n = len(text)
+    prev_line = None
+    for line in LINE_REGEX.finditer(text):
+        (line_start, line_end) = line.span()
+        sent_ends = [match.end() for match in SENTENCE_END_REGEX.finditer(text, line_start, line_end)]
+        if len(sent_ends) == 0 or sent_ends[-1] < line_end:
+            sent_ends.append(line_end)
+        sent_start = line_start
+        for sent_end in sent_ends:
+            if is_candidate(text[sent_start:sent_end]):
+                start = sent_start
+                if start > line_start and sent_end - line_start <= max_length and is_header(text[line_start:start]):
+                    start = line_start
+                if start == line_start and prev_line is not None and sent_end - prev_line[0] <= max_length and is_header(text[prev_line[0]:prev_line[1]]):
+                    start = prev_line[0]
+                end = sent_end
+                while start > 0 and text[start - 1].isspace():
+                    start -= 1
+                while end < n and text[end].isspace():
+                    end += 1
+                while len(windows) > 0 and start <= windows[-1][1]:
+                    (prev_start, prev_end) = windows.pop()
+                    start = min(start, prev_start)
+                    end = max(end, prev_end)
+                windows.append((start, end))
+            sent_start = sent_end
+        prev_line = (line_start, line_end)
+    
+    return windows
+
+
+def merge_chunk_mentions(chunk_mentions):
+    """
+    Merge the mentions of the chunks of a text, mapping their offsets to the
+    full text and numbering the mentions in text order.
+    
+    Arguments:
+        - chunk_mentions: iterable; (offset, mentions) tuples for each chunk
+                          in text order.
+    
+    Return:
+        - mentions: dict; the mentions of the full text.
+    """
+    mentions = {}
+    n = 1
+    for (offset, chunk) in chunk_mentions:
+        for mention_id in sorted(chunk.keys(), key=lambda x: int(x.split('_')[-1])):
+            mention = dict(chunk[mention_id])
+            mention['start'] = str(int(mention['start']) + offset)
+            mention['end'] = str(int(mention['end']) + offset)
+            mentions['EHOST_Instance_' + str(n)] = mention
+            n += 1
+    
+    return mentions
+
+
+def check_precompiled_rules(examples, gender='all'):
+    """
+    Regression check for precompiled token sequence rules. Annotate examples
+    with precompiled rules and with per-rule matching, and compare the 
+    mentions that are output.
+    
+    Arguments:
+        - examples: list; the text strings to annotate.
+        - gender: str; the rule set to use ('fem' or 'all').
+    
+    Return:
+        - differences: list; the examples for which the mentions differ.
+    """
+    sha_compiled = SelfHarmAnnotator(gender=gender, precompile_rules=True)
+    sha_per_rule = SelfHarmAnnotator(gender=gender, precompile_rules=False)
+
+    return compare_annotators(sha_compiled, sha_per_rule, examples, 'Precompiled rules')
+
+
+def check_consolidated_lexicons(examples, gender='all'):
+    """
+    Regression check for the LexiconBank component. Annotate examples with 
+    consolidated lexicons and with one component per lexicon label, and 
+    compare the mentions that are output.
+    
+    Arguments:
+        - examples: list; the text strings to annotate.
+        - gender: str; the rule set to use ('fem' or 'all').
+    
+    Return:
+        - differences: list; the examples for which the mentions differ.
+    """
+    sha_bank = SelfHarmAnnotator(gender=gender, consolidate_lexicons=True)
+    sha_components = SelfHarmAnnotator(gender=gender, consolidate_lexicons=False)
+
+    return compare_annotators(sha_bank, sha_components, examples, 'Consolidated lexicons')
+
+
+def check_prefilter(examples, gender='all'):
+    """
+    Regression check for the candidate prefilter. Audit the prefilter on the
+    examples, i.e. check that no example with mentions would be skipped.
+    
+    Arguments:
+        - examples: list; the text strings to annotate.
+        - gender: str; the rule set to use ('fem' or 'all').
+    
+    Return:
+        - differences: list; the examples with mentions that are skipped.
+    """
+    sha = SelfHarmAnnotator(gender=gender, prefilter=True)
+    lost, _ = sha.audit_prefilter(enumerate(examples))
+
+    return [examples[i] for i in lost]
+
+
+def check_sentence_scope(examples, gender='all'):
+    """
+    Regression check for sentence scope mode. Annotate examples with only the
+    sentences around candidate mentions and with the whole text, and compare
+    the mentions that are output.
+    
+    Arguments:
+        - examples: list; the text strings to annotate.
+        - gender: str; the rule set to use ('fem' or 'all').
+    
+    Return:
+        - differences: list; the examples for which the mentions differ.
+    """
+    sha_scope = SelfHarmAnnotator(gender=gender, sentence_scope=True)
+    sha_full = SelfHarmAnnotator(gender=gender)
+
+    return compare_annotators(sha_scope, sha_full, examples, 'Sentence scope')
+
+
+def compare_annotators(sha_new, sha_old, examples, description):
+    """
+    Annotate examples with two SelfHarmAnnotator instances and compare the
+    mentions that are output.
+    
+    Arguments:
+        - sha_new: SelfHarmAnnotator; the annotator to check.
+        - sha_old: SelfHarmAnnotator; the reference annotator.
+        - examples: list; the text strings to annotate.
+        - description: str; a description of the check for messages.
+    
+    Return:
+        - differences: list; the examples for which the mentions differ.
+    """
+    differences = []
+    for example in examples:
+        mentions_new = sha_new.process_text(example, 'text_001')
+        mentions_old = sha_old.process_text(example, 'text_001')
+        if mentions_new != mentions_old:
+            print('-- Warning: ' + description.lower() + ' give different output for:', example, file=sys.stderr)
+            differences.append(example)
+
+    print('-- ' + description + ' regression check:', len(examples) - len(differences), '/', len(examples), 'examples identical.', file=sys.stderr)
+    
+    return differences
+
+
+def iter_batches(items, batch_size):
+    """
+    Split an iterable into lists of at most batch_size items.
+    
+    Arguments:
+        - items: iterable; the items to split.
+        - batch_size: int; the maximum number of items in a batch.
+    
+    Return:
+        - generator; lists of items.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def init_worker(gender, precompile_rules, cache_dir=None, consolidate_lexicons=False, date_formats=None, prefilter=False, sentence_scope=False):
+    """
+    Load a SelfHarmAnnotator instance once in a worker process.
+    
+    Arguments:
+        - gender: str; the rule set to use ('fem' or 'all').
+        - precompile_rules: bool; compile token sequence rules once.
+        - cache_dir: str; the pipeline cache directory, if any.
+        - consolidate_lexicons: bool; apply lexicons with a LexiconBank.
+        - date_formats: list; the names of the date formats to annotate.
+        - prefilter: bool; skip texts without candidate mentions.
+        - sentence_scope: bool; only annotate sentences with candidate
+                          mentions.
+    """
+    global WORKER_ANNOTATOR
+    WORKER_ANNOTATOR = SelfHarmAnnotator(gender=gender, precompile_rules=precompile_rules, cache_dir=cache_dir, consolidate_lexicons=consolidate_lexicons, date_formats=date_formats, prefilter=prefilter, sentence_scope=sentence_scope)
+
+
+def annotate_batch(batch):
+    """
+    Annotate a batch of texts in a worker process (see init_worker).
+    
+    Arguments:
+        - batch: list; a list of (text_id, text) tuples.
+    
+    Return:
+        - results: list; a list of (text_id, mentions) tuples in input order.
+    """
+    return WORKER_ANNOTATOR.annotate_batch(batch)
+
+
+def process_file(args):
+    """
+    Process a text file in a worker process (see init_worker).
+    
+    Arguments:
+        - args: tuple; the text file path and write_output flag.
+    
+    Return:
+        - pin: str; the text file path.
+        - mentions: dict; the annotated mentions, or None if the file could 
+                    not be processed.
+    """
+    (pin, write_output) = args
+    
+    return (pin, WORKER_ANNOTATOR.try_process_file(pin, write_output=write_output))
+
 
 class LemmaCorrector(object):
     """
@@ -1153,29 +1940,72 @@ class DateTokenAnnotator(object):
     """
     Date Token Annotator
     
-    Annotate specific and easily matched date patterns.
+    Annotate specific and easily matched date patterns. All formats are 
+    compiled into a single regex that is run once over the document text, 
+    and matches are mapped back to tokens via their character offsets. Dates
+    must not be preceded or followed by a letter or digit, so e.g. a dose of
+    '200mg' or a reference number is not annotated.
     """
 
-    def __init__(self):
+    def __init__(self, formats=None):
         """
         Create a new DateTokenAnnotator instance.
+        
+        Arguments:
+            - formats: list; the names of the date formats to annotate (see 
+                       DATE_FORMATS). If None, the default formats are used.
         """
         self.name = 'date_token_annotator'
+        self.formats = list(formats or DEFAULT_DATE_FORMATS)
+        for name in self.formats:
+            if name not in DATE_FORMATS:
+                raise ValueError('-- Error: unknown date format: ' + name)
+        if self.formats == DEFAULT_DATE_FORMATS:
+            self.regex = DATE_REGEX
+        else:
+            self.regex = compile_date_regex(self.formats)
 
     def __call__(self, doc):
-        # Date pattern regexes
-        yyyy = '(19[0-9][0-9]|20[0-9])'
-        ddmmyy = '(0?[1-9]|[12][0-9]|3[01])\/(0[1-9]|1[012])\/([0-9][0-9])'
-        ddmmyyyy = '(0?[1-9]|[12][0-9]|3[01])\/(0[1-9]|1[012])\/(19[0-9][0-9]|20[0-9])'
-        ddmmyy_dot = '(0?[1-9]|[12][0-9]|3[01])\.(0[1-9]|1[012])\.([0-9][0-9])'
-        ddmmyyyy_dot = '(0?[1-9]|[12][0-9]|3[01])\.(0[1-9]|1[012])\.(19[0-9][0-9]|20[0-9])'
-        date = '(' + yyyy + '|' + ddmmyy + '|' + ddmmyyyy + '|' + ddmmyy_dot + '|' + ddmmyyyy_dot + ')'
-        for token in doc:
-            if re.search(date, token.lemma_) is not None:
-                token._.TIME = 'TIME'
+        token_starts = None
+        for match in self.regex.finditer(doc.text):
+            value = DATE_FORMAT_VALUES.get(match.lastgroup, 'TIME')
+            span = doc.char_span(match.start(), match.end())
+            if span is not None:
+                tokens = span
+            else:
+                # the match is not aligned with token boundaries, e.g. a date 
+                # with trailing punctuation that is part of a token
+                if token_starts is None:
+                    token_starts = [token.idx for token in doc]
+                start = max(bisect_right(token_starts, match.start()) - 1, 0)
+                end = bisect_left(token_starts, match.end())
+                tokens = doc[start:end]
+            set_value(doc, 'TIME', tokens.start, tokens.end, value)
         return doc
 
 
+def compile_date_regex(formats):
+    """
+    Compile date formats into a single regex with a named group per format.
+    Formats are tried in order of decreasing pattern length, so e.g. 
+    '01/02/2003' is matched in full rather than as '01/02/20'.
+    
+    Arguments:
+        - formats: list; the names of the date formats (see DATE_FORMATS).
+    
+    Return:
+        - regex: compiled regex; the date regex.
+    """
+    formats = sorted(formats, key=lambda name: len(DATE_FORMATS[name]), reverse=True)
+    date = '|'.join(['(?P<' + name + '>' + DATE_FORMATS[name] + ')' for name in formats])
+    
+    return re.compile('(?<![0-9A-Za-z])(?:' + date + ')(?![0-9A-Za-z])', re.IGNORECASE)
+
+
+# Compiled once for the default formats
+DATE_REGEX = compile_date_regex(DEFAULT_DATE_FORMATS)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Self-Harm Annotator')
     group = parser.add_mutually_exclusive_group()
@@ -1183,7 +2013,13 @@ if __name__ == "__main__":
     group.add_argument('-f', '--input_file', type=str, nargs=1, help='the path to a text file to process.', required=False)
     group.add_argument('-t', '--text', type=str, nargs=1, help='a text string to process.', required=False)
     group.add_argument('-e', '--examples', action='store_true', help='run on test examples (no output to file).', required=False)
+    group.add_argument('-r', '--regression', action='store_true', help='check that precompiled token sequence rules and consolidated lexicons give the same output as per-rule matching and per-label components on the test examples, that the prefilter skips no example with mentions, and that sentence scope mode gives the same output as annotating whole texts.', required=False)
     parser.add_argument('-g', '--gender', type=str, nargs=1, default='all', choices=['fem', 'all'], help='apply rules for female gender only, or for all genders (default)', required=False)
+    parser.add_argument('-c', '--cache_dir', type=str, nargs=1, default=None, help='directory in which to cache the assembled pipeline for fast start-up.', required=False)
+    parser.add_argument('-l', '--consolidate_lexicons', action='store_true', help='apply all lexicons with a single pipeline component.', required=False)
+    parser.add_argument('-p', '--prefilter', action='store_true', help='skip texts that contain none of the words that mentions are derived from.', required=False)
+    parser.add_argument('-s', '--sentence_scope', action='store_true', help='only annotate the sentences with candidate mentions and their section headers.', required=False)
+    parser.add_argument('-j', '--jobs', type=int, nargs=1, default=[1], help='the number of worker processes used to process a directory or the chunks of a very long file (default 1).', required=False)
     parser.add_argument('-w', '--write_output', action='store_true', help='write output to file.', required=False)
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose mode.', required=False)
     
@@ -1193,22 +2029,33 @@ if __name__ == "__main__":
     
     args = parser.parse_args()
 
+    if args.regression:
+        differences = check_precompiled_rules(text, gender=args.gender[0])
+        differences += check_consolidated_lexicons(text, gender=args.gender[0])
+        differences += check_prefilter(text, gender=args.gender[0])
+        differences += check_sentence_scope(text, gender=args.gender[0])
+        sys.exit(len(differences) > 0)
+
+    cache_dir = None
+    if args.cache_dir is not None:
+        cache_dir = args.cache_dir[0]
+
     if args.gender is not None:
-        sha = SelfHarmAnnotator(gender=args.gender[0], verbose=args.verbose)
+        sha = SelfHarmAnnotator(gender=args.gender[0], cache_dir=cache_dir, consolidate_lexicons=args.consolidate_lexicons, prefilter=args.prefilter, sentence_scope=args.sentence_scope, verbose=args.verbose)
     else:
-        sha = SelfHarmAnnotator(verbose=args.verbose)
+        sha = SelfHarmAnnotator(cache_dir=cache_dir, consolidate_lexicons=args.consolidate_lexicons, prefilter=args.prefilter, sentence_scope=args.sentence_scope, verbose=args.verbose)
     
     if args.text is not None:
         sh_annotations = sha.process_text(args.text[0], 'text_001', write_output=args.write_output, verbose=args.verbose)
     elif args.input_dir is not None:
         if os.path.isdir(args.input_dir[0]):
-            sh_annotations = sha.process(args.input_dir[0], write_output=args.write_output)
+            sh_annotations = sha.process(args.input_dir[0], write_output=args.write_output, n_process=args.jobs[0])
         else:
             print('-- Error: argument -d/--input_dir must be an existing directory.\n')
             parser.print_help()
     elif args.input_file is not None:
         if os.path.isfile(args.input_file[0]):
-            sh_annotations = sha.process(args.input_file[0], write_output=args.write_output)
+            sh_annotations = sha.process(args.input_file[0], write_output=args.write_output, n_process=args.jobs[0])
         else:
             print('-- Error: argument -f/--input_file must be an existing text file.\n')
             parser.print_help()            
@@ -5,24 +5,32 @@
     Execution examples are provided in comments in the main() method.
 """
 
+import json
 import os
 import pandas as pd
 import sys
 
 sys.path.append('T:/Andre Bittar/workspace/utils')
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from db_connection import fetch_dataframe, db_name, server_name
 from self_harm_annotator import SelfHarmAnnotator
-from ehost_annotation_reader import convert_file_annotations, get_corpus_files, load_mentions_with_attributes
+from ehost_annotation_reader import convert_file_annotations, get_corpus_files
+from ehost_reader import load_ehost_files
 from evaluate_patient_level import get_brcid_mapping
 from pandas import Timestamp
 from pprint import pprint
-from shutil import copy, move
+from result_store import ResultStore, get_annotator_hash, get_text_hash
+from shutil import copy, rmtree
 from sklearn.metrics import cohen_kappa_score, precision_recall_fscore_support, classification_report
 from time import time
 
 
+# cache of parsed eHOST files used in evaluations
+EHOST_CACHE = 'T:/Andre Bittar/Projects/KA_Self-harm/ehost_mentions.sqlite'
+
 HEURISTICS = ['1m_doc', '2m_doc', '1m_patient', '2m_patient', '2m_diff_doc', '2m_diff_patient', '2m_diff_strict_doc', '2m_diff_strict_patient']
 
 
@@ -116,10 +124,32 @@ def get_true_SH_mentions(mentions, check_temporality):
     return '|'.join(texts)
 
 
-def output_for_batch_processing(source, target_dir, config_file=None):
+def write_patient_files(patient_dir, docs, config_file=None):
+    """
+    Create the eHOST directory structure of a patient and write the texts 
+    of the patient's documents.
+    patient_dir, str: the patient directory
+    docs, list: (filename, text) tuples
+    config_file, str: the eHOST configuration file to copy (optional)
+    Return: the number of files written
+    """
+    for subdir in ['config', 'corpus', 'saved']:
+        os.makedirs(patient_dir + '/' + subdir, exist_ok=True)
+    if config_file is not None:
+        copy(config_file, patient_dir + '/config')
+    for (filename, text) in docs:
+        with open(patient_dir + '/corpus/' + filename, 'w', encoding='utf-8') as fout:
+            print(text, file=fout)
+    
+    return len(docs)
+
+
+def output_for_batch_processing(source, target_dir, config_file=None, n_threads=16):
     """
     From a DataFrame containing all text data extracted from CRIS, create an
     eHOST directory structure ready for files to be manually annotated.
+    Each patient's directories and files are written by a pool of threads.
+    n_threads, int: the number of threads
     """
     # use target_dir: 'Z:/Andre Bittar/Projects/KA_Self-harm/data/text/'
     #df = pd.read_pickle('Z:/Andre Bittar/Projects/KA_Self-harm/data/all_text_processed.pickle')
@@ -134,27 +164,24 @@ def output_for_batch_processing(source, target_dir, config_file=None):
     else:
         raise TypeError('Invalid argument: source must be a DataFrame or a path string.')
 
-    for i, row in df.iterrows():
-        brcid = str(int(row.brcid))
-        cndocid = str(row.cn_doc_id)
-        text = str(row.text_content)
-        #docdate = str(row.date)
-        if not os.path.isdir(target_dir + '/' + brcid):
-            os.makedirs(target_dir + '/' + brcid)
-            os.mkdir(target_dir + '/' + brcid + '/config')
-            os.mkdir(target_dir + '/' + brcid + '/corpus')
-            os.mkdir(target_dir + '/' + brcid + '/saved')
-        #pout = target_dir + '/' + brcid + '/corpus/' + docdate + '_' + cndocid + '_' + str(i) + '.txt'
-        pout = target_dir + '/' + brcid + '/corpus/' + cndocid + '_' + str(i) + '.txt'
-        with open(pout, 'w', encoding='utf-8') as fout:
-            print(text, file=fout)
-        fout.close()
-        if config_file is not None:
-            copy(config_file, target_dir + '/' + brcid + '/config')
-        if i % 1000 == 0:
-            print(i, '/', len(df))
+    t0 = time()
+    patients = []
+    for (brcid, g) in df.groupby(df.brcid.astype(int).astype(str), sort=False):
+        #docs = [(str(docdate) + '_' + str(cndocid) + '_' + str(i) + '.txt', str(text)) for (i, docdate, cndocid, text) in zip(g.index, g.date, g.cn_doc_id, g.text_content)]
+        docs = [(str(cndocid) + '_' + str(i) + '.txt', str(text)) for (i, cndocid, text) in zip(g.index, g.cn_doc_id, g.text_content)]
+        patients.append((target_dir + '/' + brcid, docs))
+    
+    n = 0
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = [executor.submit(write_patient_files, patient_dir, docs, config_file) for (patient_dir, docs) in patients]
+        for (j, future) in enumerate(futures):
+            n += future.result()
+            if j % 1000 == 0:
+                print(j, '/', len(patients))
+    t1 = time()
     
     print('Files saved to target directory:', target_dir)
+    print('-- Wrote', n, 'files for', len(patients), 'patients in', round(t1 - t0, 2), 's (' + str(round(n / max(t1 - t0, 1e-6), 1)) + ' files/s)', file=sys.stderr)
 
 
 def test(check_temporality):
@@ -178,10 +205,12 @@ def test(check_temporality):
     pprint(global_mentions)
 
 
-def count_sh_mentions_per_patient_train(sys_or_gold, recalculate=False):
+def count_sh_mentions_per_patient_train(sys_or_gold, recalculate=False, cache_path=EHOST_CACHE, n_process=1):
     """
     Load gold/train data into a DataFrame and count the number of "true" (positive)
     SH mentions per patient
+    cache_path, str: the eHOST cache (None for no cache)
+    n_process, int: the number of processes used to parse eHOST files
     """
     df = pin = None
 
@@ -211,6 +240,7 @@ def count_sh_mentions_per_patient_train(sys_or_gold, recalculate=False):
             files = get_corpus_files(pin)
         xml = [f for f in files if 'xml' in f]
         txt = [f for f in files if 'xml' not in f]
+        all_mentions = load_ehost_files(xml, cache_path=cache_path, n_process=n_process)
 
         entries = []
         for (x, t) in zip(xml, txt):
@@ -218,7 +248,7 @@ def count_sh_mentions_per_patient_train(sys_or_gold, recalculate=False):
             brcid = t_split[7]
             docid = t_split[9].replace('.txt', '').split('_')[-1]
             text_content = open(t, 'r').read()
-            mentions = load_mentions_with_attributes(x)
+            mentions = all_mentions[x]
             hm = count_true_SH_mentions(mentions)
             #hm = has_SH_mention(mentions)
             entries.append((t, brcid, docid, text_content, hm))
@@ -242,22 +272,25 @@ def count_sh_mentions_per_patient_train(sys_or_gold, recalculate=False):
     return df, results
 
 
-def count_cohort_mentions():
+def count_cohort_mentions(cache_path=EHOST_CACHE, n_process=1):
     """
     Count all positive SH mentions in the manually annotated cohort documents
     (in eHOST) format.
+    cache_path, str: the eHOST cache (None for no cache)
+    n_process, int: the number of processes used to parse eHOST files
     """
     #files = get_corpus_files('Z:/Andre Bittar/Projects/KA_Self-harm/data/text')
     files = get_corpus_files('T:/Andre Bittar/Projects/KA_Self-harm/Adjudication/test_patient')
     xml = [f for f in files if 'xml' in f]
     txt = [f for f in files if 'xml' not in f]
+    all_mentions = load_ehost_files(xml, cache_path=cache_path, n_process=n_process)
     entries = []
     for (x, t) in zip(xml, txt):
         t_split = t.replace('\\', '/').split('/')
         brcid = t_split[6]
         docid = t_split[8].replace('.txt', '').split('_')[-1]
         text_content = open(t, 'r', encoding='latin-1').read()
-        mentions = load_mentions_with_attributes(x)
+        mentions = all_mentions[x]
         hm = count_true_SH_mentions(mentions, check_temporality=True)
         #hm = has_SH_mention(mentions)
         entries.append((t, brcid, docid, text_content, hm))
@@ -321,29 +354,47 @@ def evaluate_sys(results, sys_results):
     print(report_string)
 
 
-def batch_process(main_dir):
+def batch_process(main_dir, n_process=1):
     """
     Run the sh_annotator on text files and output new XML.
+    The files of all patient directories are spread across n_process 
+    worker processes.
     """
     sha = SelfHarmAnnotator(verbose=False)
     
     #main_dir = 'Z:/Andre Bittar/Projects/KA_Self-harm/data/text'
     
     pdirs = os.listdir(main_dir)
-    n = len(pdirs)
-    i = 1
+    pins = [os.path.join(main_dir, pdir, 'corpus').replace('\\', '/') for pdir in pdirs]
     
-    t0 = time()
-    
-    for pdir in pdirs:
-         pin = os.path.join(main_dir, pdir, 'corpus').replace('\\', '/')
-         _ = sha.process(pin, write_output=True)
-         print(i, '/', n, pin)
-         i += 1
+    _ = sha.process_dirs(pins, write_output=True, n_process=n_process)
 
-    t1 = time()
+
+def build_patient_flags(df, column, name='sh', pout=None):
+    """
+    Flag each patient that has at least one document with a True value.
+    df, DataFrame: the processed documents (with a brcid column)
+    column, str: the column containing the document flags
+    name, str: the name of the patient flag column
+    pout, str: if set, the file to write the flags to (.xlsx, .csv or 
+               .parquet)
+    Return: a DataFrame with one row per brcid, sorted by brcid
+    """
+    df_flags = (df[column] == True).groupby(df.brcid).any().rename(name).reset_index()
+    
+    if pout is not None:
+        ext = os.path.splitext(pout)[1].lower()
+        if ext == '.xlsx':
+            df_flags.to_excel(pout)
+        elif ext == '.csv':
+            df_flags.to_csv(pout)
+        elif ext == '.parquet':
+            df_flags.to_parquet(pout)
+        else:
+            raise ValueError('-- Invalid output file type: ' + ext + ' (choose .xlsx, .csv or .parquet)')
+        print('-- Wrote file:', pout)
     
-    print(t1 - t0)
+    return df_flags
 
 
 def process_CC_EE():
@@ -380,42 +431,25 @@ def process_CC_EE():
     df_new.to_pickle(new_p)
     
     # output an Excel spreasheet with flagged patients
-    df_flags = pd.DataFrame(columns=['brcid', 'sh'])
-    for g in df_new.groupby('brcid'):
-        brcid = g[0]
-        flag = False
-        for i, row in g[1].iterrows():
-            if row['sh_' + now + '_notmp'] == True:
-                tmp = pd.DataFrame({'brcid': [brcid], 'sh': [True]})
-                df_flags = pd.concat([df_flags, tmp])
-                flag = True
-                break
-        if flag == False:
-            tmp = pd.DataFrame({'brcid': [brcid], 'sh': [False]})
-            df_flags = pd.concat([df_flags, tmp])
-    
-    df_flags.reset_index(drop=True, inplace=True)
-    df_flags.sort_values(by='brcid', inplace=True)
-    df_flags.to_excel('T:/Andre Bittar/Projects/CC_Eating_Disorder/flagged_patients_full_cohort_' + now + '.xlsx')
+    df_flags = build_patient_flags(df_new, 'sh_' + now + '_notmp', pout='T:/Andre Bittar/Projects/CC_Eating_Disorder/flagged_patients_full_cohort_' + now + '.xlsx')
     
     return df_flags
 
 
-def process_CC_EE_update():
+def process_CC_EE_update(store_path='T:/Andre Bittar/Projects/CC_Eating_Disorder/results.sqlite', n_process=1):
     """
-    Run process on new data only and merge with old data.
+    Run process on the latest data, annotating only documents that are new, 
+    have changed, or were annotated with different resources (lexicons and 
+    rules). Results for all other documents are taken from a persistent 
+    result store.
+    store_path, str: the path to the result store
+    n_process, int: the number of worker processes
     """
-    # Load original data
-    print('-- Loading original data...', end='')
-    df = pd.read_pickle('T:/Andre Bittar/Projects/CC_Eating_Disorder/all_text_processed_SH.pickle')
-    print('Done.')
-    
     # load and store new data for Attachement
     print('-- Fetching Attachment data...', end='')
     query_att = open('T:/Andre Bittar/Projects/CC_Eating_Disorder/CC_Eating_Disorder_get_texts_Attachment_query.sql', 'r').read()
     df_att = fetch_dataframe(server_name, db_name, query_att)
     df_att.rename(columns={'BrcId': 'brcid', 'CN_Doc_ID': 'cn_doc_id', 'ViewDate': 'viewdate', 'Attachment_Text': 'text_content'}, inplace=True)
-    df_att = df_att.loc[~df_att.cn_doc_id.isin(df.cn_doc_id)]
     print('Done.')
     
     # load and store new data for Event
@@ -423,7 +457,6 @@ def process_CC_EE_update():
     query_evt = open('T:/Andre Bittar/Projects/CC_Eating_Disorder/CC_Eating_disorder_get_texts_Event_query.sql', 'r').read()
     df_evt = fetch_dataframe(server_name, db_name, query_evt)
     df_evt.rename(columns={'BrcId': 'brcid', 'CN_Doc_ID': 'cn_doc_id', 'ViewDate': 'viewdate', 'Comments': 'text_content'}, inplace=True)
-    df_evt = df_evt.loc[~df_evt.cn_doc_id.isin(df.cn_doc_id)]
     print('Done.')
     
     df_new = pd.concat([df_att, df_evt])
@@ -433,41 +466,77 @@ def process_CC_EE_update():
     del df_evt
     
     now = str(date.today()).replace('-', '')
-    new_p = 'T:/Andre Bittar/Projects/CC_Eating_Disorder/all_text_processed_SH_new_' + now + '.pickle'
-    df_new.to_pickle(new_p)
     
     print('-- Processing...')
-    df_new = process(new_p, check_counts=False, check_temporality=False)
-    df_new.to_pickle(new_p)
-    
-    # now merge the latest column from df with the new one from df_new
-    latest_key = [t for t in sorted(list(df.columns)) if '_notmp' in t][-1]
-    df_tmp = df[['brcid', 'cn_doc_id', 'viewdate', 'text_content', 'age', latest_key]]
-    df_tmp.rename(columns={latest_key: 'sh_' + now + '_notmp'}, inplace=True)
+    sha = SelfHarmAnnotator(verbose=False)
+    with ResultStore(store_path, get_annotator_hash(sha)) as store:
+        df_new = process_incremental(df_new, store, sha, check_counts=False, check_temporality=False, n_process=n_process)
     
-    # TODO do the merge
+    new_p = 'T:/Andre Bittar/Projects/CC_Eating_Disorder/all_text_processed_SH_' + now + '.pickle'
+    df_new.to_pickle(new_p)
+    print('-- Wrote file:', new_p)
     
     # output an Excel spreasheet with flagged patients
-    df_flags = pd.DataFrame(columns=['brcid', 'sh'])
-    for g in df_tmp.groupby('brcid'):
-        brcid = g[0]
-        flag = False
-        for i, row in g[1].iterrows():
-            if row['sh_20200128_notmp'] == True:
-                tmp = pd.DataFrame({'brcid': [brcid], 'sh': [True]})
-                df_flags = pd.concat([df_flags, tmp])
-                flag = True
-                break
-        if flag == False:
-            tmp = pd.DataFrame({'brcid': [brcid], 'sh': [False]})
-            df_flags = pd.concat([df_flags, tmp])
-    
-    df_flags.to_excel('T:/Andre Bittar/Projects/CC_Eating_Disorder/flagged_patients_updated_cohort' + now + '.xlsx')
+    df_flags = build_patient_flags(df_new, 'sh_' + now + '_notmp', pout='T:/Andre Bittar/Projects/CC_Eating_Disorder/flagged_patients_updated_cohort' + now + '.xlsx')
     
     return df_flags
 
 
-def load_ehost_to_dataframe(pin, key, attribute='text', df=None, pin_ref=None):
+def process_incremental(df, store, sha, check_counts=True, check_temporality=True, heuristic='base', batch_size=100, n_process=1, commit_size=1000):
+    """
+    Run self_harm_annotator on a DataFrame that contains the text for each 
+    file, annotating only documents without a result in the result store.
+    New results are added to the store as they are produced, so an 
+    interrupted run resumes where it stopped.
+    Results are saved to a new column of the DataFrame, as in process().
+    df, DataFrame: the documents (columns cn_doc_id and text_content)
+    store, ResultStore: the result store for the resources of sha
+    sha, SelfHarmAnnotator: the annotator
+    commit_size, int: the number of new results stored at once
+    """
+    now = str(date.today()).replace('-', '')
+
+    if check_temporality:
+        now += '_tmp'
+    else:
+        now += '_notmp'
+    
+    doc_ids = [str(docid) for docid in df.cn_doc_id.tolist()]
+    texts = df.text_content.tolist()
+    text_hashes = [get_text_hash(text) for text in texts]
+    
+    results = store.get_many(zip(doc_ids, text_hashes))
+    todo = {}
+    for (docid, text, text_hash) in zip(doc_ids, texts, text_hashes):
+        if (docid, text_hash) not in results:
+            todo[(docid, text_hash)] = text
+    print('-- Documents:', len(df), 'stored:', len(df) - len(todo), 'to annotate:', len(todo))
+    
+    t0 = time()
+    keys = list(todo.keys())
+    items = ((docid, todo[(docid, text_hash)]) for (docid, text_hash) in keys)
+    rows = []
+    n = 0
+    for ((docid, mentions), (_, text_hash)) in zip(sha.annotate_stream(items, batch_size=batch_size, n_process=n_process), keys):
+        results[(docid, text_hash)] = mentions
+        rows.append((docid, text_hash, mentions))
+        n += 1
+        if len(rows) >= commit_size:
+            store.put_many(rows)
+            rows = []
+            print(n, '/', len(todo))
+    store.put_many(rows)
+    
+    t1 = time()
+    
+    print(t1 - t0)
+    
+    df['sh_' + now] = [get_result_value({docid: results[(docid, text_hash)]}, check_counts, check_temporality, heuristic) for (docid, text_hash) in zip(doc_ids, text_hashes)]
+    
+    return df
+
+
+def load_ehost_to_dataframe(pin, key, attribute='text', df=None, pin_ref=None, cache_path=EHOST_CACHE, n_process=1):
     """
     Load annotations (mention text) from a directory containing eHOST annotations
     into a Pandas DataFrame
@@ -475,6 +544,8 @@ def load_ehost_to_dataframe(pin, key, attribute='text', df=None, pin_ref=None):
     key, str: a key to name the column in which to store SH results
     df, DataFrame: an existing DataFrame to add further results to
     map_brcids, bool: get a mapping from the gold corpus (True) or from the annotated file names (False)
+    cache_path, str: the eHOST cache (None for no cache)
+    n_process, int: the number of processes used to parse eHOST files
     """
     brcid_mapping = {}
     files = []
@@ -491,10 +562,11 @@ def load_ehost_to_dataframe(pin, key, attribute='text', df=None, pin_ref=None):
         df = pd.DataFrame(columns=['filename', 'brcid', key])
         df['filename'] = xml
     
+    all_mentions = load_ehost_files(xml, cache_path=cache_path, n_process=n_process)
     for i, f in enumerate(xml):
         fname = f.split('\\')[-1]
         brcid = brcid_mapping.get(fname)
-        mentions = load_mentions_with_attributes(f)
+        mentions = all_mentions[f]
         mentions = convert_file_annotations(mentions)
         mentions = [m for m in mentions if m.get('status', None) == 'RELEVANT' and \
                     m.get('polarity', None) == 'POSITIVE' and \
@@ -512,6 +584,60 @@ def load_ehost_to_dataframe(pin, key, attribute='text', df=None, pin_ref=None):
     return df, brcid_mapping, files
 
 
+def get_mention_heuristics(df_processed, key, attribute='text', split_attribute=False):
+    """
+    Apply the heuristics that count mentions with different text (or 
+    attribute value) to outputs stored as strings of mentions separated by 
+    a '|'. The strings are split once into a table with one row per 
+    mention, and each heuristic is computed with aggregations by document 
+    and by patient.
+    df_processed: the DataFrame containing the data
+    key: the column containing the outputs
+    attribute, split_attribute: see count_flagged_patients
+    Return: a dict of the list of flagged brcids for each heuristic
+    """
+    df = pd.DataFrame({'brcid': df_processed.brcid.values, 'text': df_processed[key].values})
+    df['mention'] = df.text.str.split('|')
+    df = df.explode('mention')
+    df.index.name = 'doc'
+    df.reset_index(inplace=True)
+    
+    if split_attribute:
+        if attribute == 'text':
+            df['value'] = df.mention.str.split('#').str[0]
+        else:
+            # use the attribute value - mention text must previously have been stored in the format text:attr_value (e.g. overdose#OVERDOSE)
+            df['value'] = df.mention.str.split('#').str[1]
+    else:
+        df['value'] = df.mention
+    
+    # empty mentions only count at the document level if the attribute is not split
+    if split_attribute:
+        docs = df.loc[df.mention != '']
+    else:
+        docs = df
+    docs = docs.groupby(['doc', 'brcid']).value.agg(['size', 'nunique'])
+    
+    # documents without any mentions do not count at the patient level
+    patients = df.loc[df.text != ''].groupby('brcid').value.agg(['size', 'nunique'])
+    
+    results = {}
+    # any patient with at least one true mention
+    results['1m_patient'] = patients.index.tolist()
+    # any patient with at least two true mentions
+    results['2m_patient'] = patients.loc[patients['size'] > 1].index.tolist()
+    # any patient with any document with at least two mentions with different text/attribute value
+    results['2m_diff_doc'] = list(set(docs.loc[docs['nunique'] > 1].index.get_level_values('brcid')))
+    # any patient with at least two true mentions with different text
+    results['2m_diff_patient'] = patients.loc[patients['nunique'] > 1].index.tolist()
+    # any patient with any document with at least two mentions, all with different text/attribute value
+    results['2m_diff_strict_doc'] = list(set(docs.loc[(docs['size'] > 1) & (docs['nunique'] == docs['size'])].index.get_level_values('brcid')))
+    # any patient with at least two true mentions and all mentions with different text
+    results['2m_diff_strict_patient'] = patients.loc[(patients['size'] > 1) & (patients['nunique'] == patients['size'])].index.tolist()
+    
+    return results
+
+
 def count_flagged_patients(df_processed, key, cohort='restricted', attribute='text', split_attribute=False, verbose=True):
     """
     Apply all filtering heuristics to outputs stored in a DataFrame.
@@ -545,8 +671,7 @@ def count_flagged_patients(df_processed, key, cohort='restricted', attribute='te
 
     if data_type == 'object':
         key_int = key + '_int'
-        counts = [len(y) for y in df_processed[key].apply(lambda x: x.split('|') if x != '' else []).tolist()]
-        df_processed[key_int] = counts
+        df_processed[key_int] = (df_processed[key].str.count('\\|') + 1).where(df_processed[key] != '', 0)
         
         # any document with at least one true mention
         flagged = list(set(df_processed.loc[df_processed[key_int] > 0].brcid.tolist()))
@@ -556,55 +681,7 @@ def count_flagged_patients(df_processed, key, cohort='restricted', attribute='te
         flagged = list(set(df_processed.loc[df_processed[key_int] > 1].brcid.tolist()))
         results['2m_doc'] = [str(int(x)) for x in flagged]
         
-        base = []
-        tm = []
-        tmd = []
-        tmd_doc = []
-        tmds = []
-        tmds_doc = []
-        for g in df_processed.groupby('brcid'):
-            brcid = g[0]
-            for i, row in g[1].iterrows():
-                # any patient with any document with at least two mentions with different text/attribute value
-                if split_attribute:
-                    if attribute == 'text':
-                        true_texts = [x.split('#')[0] for x in row[key].split('|') if x != '']
-                    else:
-                        # use the attribute value - mention text must previously have been stored in the format text:attr_value (e.g. overdose#OVERDOSE)
-                        true_texts = [x.split('#')[1] for x in row[key].split('|') if x != '']
-                else:
-                    true_texts = row[key].split('|')
-                if len(set(true_texts)) > 1:
-                    tmd_doc.append(brcid)
-                if len(true_texts) > 1 and len(set(true_texts)) == len(true_texts):
-                    tmds_doc.append(brcid)
-            text_list = [x.split('|') for x in g[1][key].tolist() if x != '']
-            # flatten the list
-            if split_attribute:
-                if attribute == 'text':
-                    true_texts = [item.split('#')[0] for sublist in text_list for item in sublist]
-                else:
-                    true_texts = [item.split('#')[1] for sublist in text_list for item in sublist]
-            else:
-                true_texts = [item for sublist in text_list for item in sublist]
-            # any patient with at least one true mention
-            if len(true_texts) > 0:
-                base.append(brcid)
-            # any patient with at least two true mentions
-            if len(true_texts) > 1:
-                tm.append(brcid)
-            # any patient with at least two true mentions with different text
-            if len(set(true_texts)) > 1:
-                tmd.append(brcid)
-            # any patient with at least two true mentions and all mentions with different text
-            if len(true_texts) > 1 and len(set(true_texts)) == len(true_texts):
-                tmds.append(brcid)
-        results['1m_patient'] = list(set(base))
-        results['2m_patient'] = list(set(tm))
-        results['2m_diff_doc'] = list(set(tmd_doc))
-        results['2m_diff_patient'] = list(set(tmd))
-        results['2m_diff_strict_doc'] = list(set(tmds_doc))
-        results['2m_diff_strict_patient'] = list(set(tmds))
+        results.update(get_mention_heuristics(df_processed, key, attribute=attribute, split_attribute=split_attribute))
         
     elif 'int' in data_type or 'float' in data_type:
         # any document with at least one true mention
@@ -681,43 +758,32 @@ def evaluate_patient_level_with_heuristics(pin_gold, pin_sys, attribute='text',
     
     results_dict = {}
     
+    # build the patient x heuristic matrix of system flags, for patients in the gold standard
+    df_sys_flags = pd.DataFrame({heur: df_gold_brcids.brcid.isin(res_sys[heur]) for heur in res_sys})
+    y_true = df_gold_brcids.flag
+    
+    # count agreement for all heuristics at once
+    tps = df_sys_flags[y_true].sum()
+    fps = df_sys_flags[~y_true].sum()
+    fns = (~df_sys_flags[y_true]).sum()
+    sys_ns = df_sys_flags.sum()
+    
     for heur in res_sys:
-        df_gold[heur] = False
-        for brcid in res_sys[heur]:
-            # calculate boolean value for each document, store in gold dataframe
-            inds = df_gold.loc[df_gold.brcid == brcid].index
-            df_gold.loc[inds, heur] = True
-
         report_string += 'Heuristic: ' + heur + '\n'
         report_string += '----------' + '-' * len(heur) + '\n'
-        system_brcids = []
-        for row in df_gold.groupby('brcid'):
-            if row[1][heur].iloc[0] == True:
-                system_brcids.append(row[0])
-        
-        # make the lists of brcids into sets for following operations
-        #gold_brcids = set(gold_brcids)
-        system_brcids = set(system_brcids)
-
-        # create DataFrame for system flags
-        df_sys_brcids = pd.DataFrame()
-        df_sys_brcids['brcid'] = all_brcids
-        df_sys_brcids['flag'] = False
-        df_sys_brcids.loc[df_sys_brcids.brcid.isin(system_brcids), 'flag'] = True
         
-        fn = len(gold_brcids.difference(system_brcids))
-        fp = len(system_brcids.difference(gold_brcids))
-        tp = len(gold_brcids.intersection(system_brcids))
+        fn = int(fns[heur])
+        fp = int(fps[heur])
+        tp = int(tps[heur])
 
-        sys_n = len(system_brcids)
+        sys_n = int(sys_ns[heur])
         sys_np = round(len(res_sys[heur]) / len(all_brcids) * 100, 2)
         report_string += 'Gold prevalence     : ' + str(len(gold_brcids)) + '/' + str(n_total) + ' (' + str(gold_np) + '%)\n'
         report_string += 'System prevalence   : ' + str(sys_n) + '/' + str(n_total) + ' (' + str(sys_np) + '%)\n'
         report_string += 'Gold and System (TP): ' + str(tp) + '\n'
         report_string += 'Gold not System (FN): ' + str(fn) + '\n'
         report_string += 'System not Gold (FP): ' + str(fp) + '\n'
-        y_true = df_gold_brcids.flag
-        y_pred = df_sys_brcids.flag
+        y_pred = df_sys_flags[heur]
         cr = classification_report(y_true, y_pred)
         cr_d = classification_report(y_true, y_pred, output_dict=True)
         p = cr_d['True']['precision']
@@ -757,12 +823,116 @@ def evaluate_patient_level_with_heuristics(pin_gold, pin_sys, attribute='text',
     return df_results
 
 
-def process(pin, check_counts=True, check_temporality=True, heuristic='base', test_rows=-1):
+def get_result_value(mentions, check_counts, check_temporality, heuristic):
+    """
+    Calculate the value stored for a document in the results column.
+    mentions, dict: the mentions of the document, keyed by document id
+    """
+    if check_counts:
+        if heuristic in ['base', '2m']:
+            return count_true_SH_mentions(mentions, check_temporality=check_temporality)
+        return get_true_SH_mentions(mentions, check_temporality=check_temporality)
+    
+    return has_SH_mention(mentions, check_temporality=check_temporality)
+
+
+def iter_chunks(pin, chunk_size, columns=None):
+    """
+    Read a pickle or parquet file of documents in chunks of rows.
+    Parquet files are read chunk by chunk; pickle files can only be loaded 
+    whole and are then split.
+    The chunks are indexed by row position in the file rather than by the 
+    stored index, which parquet batches do not always restore.
+    pin, str: the path to the input file
+    chunk_size, int: the number of rows in each chunk
+    columns, list: the columns to read from parquet files (all if None)
+    """
+    if os.path.splitext(pin)[1] == '.parquet':
+        import pyarrow.parquet as pq
+        offset = 0
+        for batch in pq.ParquetFile(pin).iter_batches(batch_size=chunk_size, columns=columns):
+            chunk = batch.to_pandas()
+            chunk.index = range(offset, offset + len(chunk))
+            offset += len(chunk)
+            yield chunk
+    else:
+        df = pd.read_pickle(pin)
+        for start in range(0, len(df), chunk_size):
+            chunk = df[start:start + chunk_size]
+            yield chunk.set_axis(range(start, start + len(chunk)))
+
+
+def read_input(pin):
+    """
+    Read a whole pickle or parquet file of documents.
+    """
+    if os.path.splitext(pin)[1] == '.parquet':
+        return pd.read_parquet(pin)
+    
+    return pd.read_pickle(pin)
+
+
+def get_settings_name(settings):
+    """
+    Build a short name for the settings of process(), used in the name of the
+    checkpoint directory.
+    settings, dict: the settings
+    """
+    name = 'counts' if settings['check_counts'] else 'flags'
+    name += '_' + ('tmp' if settings['check_temporality'] else 'notmp')
+    name += '_' + settings['heuristic'] + '_' + str(settings['chunk_size'])
+    
+    return name
+
+
+def check_checkpoint_settings(checkpoint_dir, settings):
+    """
+    Create a checkpoint directory and save the settings of process() in it, 
+    or check that the settings saved in an existing directory are the same.
+    Raises a ValueError if they differ, as the checkpoints would then cover 
+    other rows or hold other values.
+    checkpoint_dir, str: the checkpoint directory
+    settings, dict: the settings of the current run
+    """
+    pin = os.path.join(checkpoint_dir, 'settings.json')
+    if os.path.isfile(pin):
+        with open(pin, 'r') as fin:
+            saved = json.load(fin)
+        if saved != settings:
+            raise ValueError('-- Error: checkpoints in ' + checkpoint_dir + ' were written with other settings: ' + str(saved) + \
+                             ' (remove the directory to start again)')
+        print('-- Resuming from checkpoints in:', checkpoint_dir)
+        return
+    
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    if any(f.endswith('.pickle') for f in os.listdir(checkpoint_dir)):
+        raise ValueError('-- Error: checkpoints in ' + checkpoint_dir + ' have no saved settings (remove the directory to start again)')
+    with open(pin + '.tmp', 'w') as fout:
+        json.dump(settings, fout)
+    os.replace(pin + '.tmp', pin)
+
+
+def process(pin, check_counts=True, check_temporality=True, heuristic='base', test_rows=-1, mention_sink=None, chunk_size=10000, batch_size=100, n_process=1, checkpoint_dir=None):
     """
     Run self_harm_annotator on a DataFrame that contains the text for each file.
     Outputs True for documents with relevant mention.
     Does not write new XML.
     All saved to the DataFrame.
+    pin, str: the path to a pickle or parquet file containing the DataFrame
+    mention_sink, MentionSink: if given, all mentions are also written to 
+                               columnar files, one part per chunk (the caller
+                               closes the sink). To restart, open the sink 
+                               on the same directory with resume=True: the
+                               parts of finished chunks are kept, and those
+                               of other chunks are written again.
+    chunk_size, int: the number of rows in each checkpointed chunk
+    batch_size, int: the number of texts sent to the pipeline at once
+    n_process, int: the number of worker processes
+    checkpoint_dir, str: the directory for the results of finished chunks 
+                         (default: next to the input file, named after it and
+                         the settings). When the process is restarted with 
+                         the same settings, finished chunks are not 
+                         re-annotated.
     """
     
     now = str(date.today()).replace('-', '')
@@ -772,45 +942,105 @@ def process(pin, check_counts=True, check_temporality=True, heuristic='base', te
     else:
         now += '_notmp'
     
-    # temporary save file
-    tmp_pout = os.path.join(os.path.dirname(pin), 'tmp_' + now + '.pickle')
+    key = 'sh_' + now
+    
+    # one checkpoint file with the results of each finished chunk, in a 
+    # directory that does not depend on the date, so that a restart on 
+    # another day resumes; the settings are saved with the checkpoints, as
+    # chunks only cover the same rows and hold the same values with the 
+    # same settings
+    settings = {'input': os.path.abspath(pin),
+                'chunk_size': chunk_size,
+                'check_counts': check_counts,
+                'check_temporality': check_temporality,
+                'heuristic': heuristic}
+    if checkpoint_dir is None:
+        checkpoint_dir = os.path.join(os.path.dirname(pin), 'tmp_' + os.path.splitext(os.path.basename(pin))[0] + '_' + get_settings_name(settings))
+    if test_rows == -1:
+        check_checkpoint_settings(checkpoint_dir, settings)
+    
+    def get_checkpoint_path(chunk_id):
+        return os.path.join(checkpoint_dir, 'chunk_' + str(chunk_id).zfill(5) + '.pickle')
     
     sha = SelfHarmAnnotator(verbose=False)
-    #df = pd.read_pickle('Z:/Andre Bittar/Projects/KA_Self-harm/data/all_text_processed.pickle')
-    df = pd.read_pickle(pin)
-    if test_rows > 0:
-        df = df[0:test_rows]
-    #df['sh'] = False
-    n = len(df)
     
+    # chunks are annotated as one stream, so that worker processes are kept 
+    # busy across chunk boundaries; finished chunks are skipped on restart
+    pending = deque()
+    n_rows = {'read': 0, 'skipped': 0}
+    
+    def iter_texts():
+        for (chunk_id, chunk) in enumerate(iter_chunks(pin, chunk_size)):
+            if test_rows > 0:
+                chunk = chunk[0:max(test_rows - n_rows['read'], 0)]
+                if len(chunk) == 0:
+                    return
+            n_rows['read'] += len(chunk)
+            if len(chunk) == 0:
+                continue
+            if test_rows == -1 and os.path.isfile(get_checkpoint_path(chunk_id)):
+                print('-- Skipping finished chunk:', chunk_id)
+                n_rows['skipped'] += len(chunk)
+                continue
+            brcids = chunk.brcid.tolist() if 'brcid' in chunk.columns else [None] * len(chunk)
+            pending.append((chunk_id, chunk.index.tolist(), brcids))
+            for (docid, text) in zip(chunk.cn_doc_id.tolist(), chunk.text_content.tolist()):
+                yield (docid, text)
+    
+    results = []
+    test_parts = []
     t0 = time()
-    for i, row in df.iterrows():
-        docid = row.cn_doc_id
-        text = row.text_content
-        mentions = sha.process_text(text, docid, write_output=False)
-        if check_counts:
-            if heuristic in ['base', '2m']:
-                df.at[i, 'sh_' + now] = count_true_SH_mentions(mentions, check_temporality=check_temporality)
+    n = 0
+    for (docid, mentions) in sha.annotate_stream(iter_texts(), batch_size=batch_size, n_process=n_process):
+        chunk_id, index, brcids = pending[0]
+        if mention_sink is not None:
+            mention_sink.write(docid, mentions, brcid=brcids[len(results)], part=chunk_id)
+        results.append(get_result_value({docid: mentions}, check_counts, check_temporality, heuristic))
+        n += 1
+        if n % 1000 == 0:
+            print(n, 'documents annotated in', round(time() - t0, 2), 's')
+        if len(results) == len(index):
+            # chunk finished
+            part = pd.Series(results, index=index, name=key)
+            if mention_sink is not None:
+                mention_sink.end_part()
+            if test_rows == -1:
+                pout = get_checkpoint_path(chunk_id)
+                part.to_pickle(pout + '.tmp')
+                os.replace(pout + '.tmp', pout)
+                print('-- Wrote checkpoint:', pout)
             else:
-                text = get_true_SH_mentions(mentions, check_temporality=check_temporality)
-                #print(i, docid, text)
-                df.at[i, 'sh_' + now] = text
-        else:
-            df.at[i, 'sh_' + now] = has_SH_mention(mentions, check_temporality=check_temporality)
-        if i % 1000 == 0:
-            print(i, '/', n)
-        if i % 10000 == 0 and test_rows == -1:
-            print('-- Creating backup:', tmp_pout)
-            df.to_pickle(tmp_pout)
-
+                test_parts.append(part)
+            pending.popleft()
+            results = []
+    
     t1 = time()
     
     print(t1 - t0)
+    print('-- Annotated', n, 'documents,', n_rows['skipped'], 'skipped in finished chunks')
+    
+    # merge all chunk results into the DataFrame
+    df = read_input(pin)
+    if test_rows > 0:
+        df = df[0:test_rows]
+        parts = test_parts
+    else:
+        parts = [pd.read_pickle(os.path.join(checkpoint_dir, f)) for f in sorted(os.listdir(checkpoint_dir)) if f.endswith('.pickle')]
+    # results are indexed by row position, so they are assigned by position
+    # once it is checked that they cover every row
+    results = pd.concat(parts).sort_index() if len(parts) > 0 else pd.Series([], dtype=object)
+    if not results.index.equals(pd.RangeIndex(len(df))):
+        raise ValueError('-- Error: results cover ' + str(len(results)) + ' of ' + str(len(df)) + ' rows' + \
+                         (', checkpoints kept in: ' + checkpoint_dir if test_rows == -1 else ''))
+    df[key] = results.values
     
     if test_rows == -1:
-        move(tmp_pout, pin)
+        if os.path.splitext(pin)[1] == '.parquet':
+            df.to_parquet(pin)
+        else:
+            df.to_pickle(pin)
         print('-- Wrote file:', pin)
-        df.to_pickle(pin)
+        rmtree(checkpoint_dir)
     
     return df
 
@@ -821,4 +1051,7 @@ if __name__ == '__main__':
     print('-- Run one of the two functions...', file=sys.stderr)
     #test(check_temporality=True)
     #df_processed = process('Z:/Andre Bittar/Projects/KA_Self-harm/data/all_text_processed.pickle', check_counts=True, check_temporality=True, heuristic='2m_diff')
+    #from mention_sink import MentionSink
+    #with MentionSink('Z:/Andre Bittar/Projects/KA_Self-harm/data/mentions') as sink:
+    #    df_processed = process('Z:/Andre Bittar/Projects/KA_Self-harm/data/all_text_processed.pickle', check_counts=True, check_temporality=True, heuristic='2m_diff', mention_sink=sink)
     #batch_process('T:/Andre Bittar/Projects/KA_Self-harm/Adjudication/system_train_dev_patient/files')
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+    Span Selector
+
+    Select the longest non-overlapping spans from a list of (possibly
+    overlapping) matches. This is shared by the lexical, lemma and token
+    sequence annotators.
+
+    Spans are (start, end) token offsets with an exclusive end but, as in the
+    previous implementation, spans that touch count as overlapping, e.g.
+    (0, 2) and (2, 3), so that adjacent lexicon matches such as "self-harm
+    Self-harm:" are not both kept. Selection is greedy: spans are considered
+    from longest to shortest (ties broken by the earliest start) and a span
+    is kept if it does not overlap any span kept before it. Identical offsets
+    are only kept once. Kept spans are stored in a list sorted by start
+    offset, so each overlap check is a binary search; inserting a kept span
+    moves the items after it in the list, which is linear in the worst case
+    but a fast memory move, so selection is O(n log n) comparisons plus the
+    insertions.
+
+    Run this file to check the selector against a brute-force reference on
+    random inputs and to benchmark it against the previous quadratic
+    implementation.
+"""
+
+import random
+import sys
+
+from bisect import bisect_right
+from time import time
+
+
+def select_longest_spans(items, get_offsets=None):
+    """
+    Select the longest non-overlapping spans.
+
+    Arguments:
+        - items: list; the items to select from, e.g. (start, end) offsets or
+                 spaCy (match_id, start, end) matches.
+        - get_offsets: function; returns the (start, end) offsets of an item.
+                       If None, items are (start, end) offsets.
+
+    Return:
+        - items: list; the selected items, in their original order.
+    """
+    if get_offsets is None:
+        offsets = [(item[0], item[1]) for item in items]
+    else:
+        offsets = [get_offsets(item) for item in items]
+
+    order = sorted(range(len(offsets)), key=lambda n: (offsets[n][0] - offsets[n][1], offsets[n][0], n))
+
+    # start and end offsets of the kept spans, sorted by start offset
+    starts = []
+    ends = []
+    keep = [False] * len(offsets)
+    for n in order:
+        start, end = offsets[n]
+        k = bisect_right(starts, start)
+        # previous kept span ends after or where this one starts
+        if k > 0 and ends[k - 1] >= start:
+            continue
+        # next kept span starts before or where this one ends
+        if k < len(starts) and starts[k] <= end:
+            continue
+        starts.insert(k, start)
+        ends.insert(k, end)
+        keep[n] = True
+
+    return [item for (n, item) in enumerate(items) if keep[n]]
+
+
+def select_longest_spans_reference(offsets):
+    """
+    Brute-force reference implementation of select_longest_spans, used for
+    testing.
+
+    Arguments:
+        - offsets: list; (start, end) offsets.
+
+    Return:
+        - offsets: list; the selected offsets, in their original order.
+    """
+    order = sorted(range(len(offsets)), key=lambda n: (offsets[n][0] - offsets[n][1], offsets[n][0], n))
+    kept = []
+    for n in order:
+        start, end = offsets[n]
+        if all(end < offsets[m][0] or offsets[m][1] < start for m in kept):
+            kept.append(n)
+    kept = set(kept)
+
+    return [offset for (n, offset) in enumerate(offsets) if n in kept]
+
+
+def select_longest_spans_quadratic(matches):
+    """
+    The previous implementation of get_longest_matches, kept for
+    benchmarking only.
+
+    Arguments:
+        - matches: list; spaCy (match_id, start, end) matches.
+
+    Return:
+        - matches: list; the remaining matches.
+    """
+    offsets = [(match[1], match[2]) for match in matches]
+    overlaps = {}
+    for offset in offsets:
+        o = [(i[0], i[1]) for i in offsets if i[0] >= offset[0] and
+             i[0] <= offset[1] or i[1] >= offset[0] and
+             i[1] <= offset[1] if (i[0], i[1]) != offset and
+             (i[0], i[1]) and (i[0], i[1]) not in overlaps]
+        if len(o) > 0:
+            overlaps[offset] = o
+
+    overlapping_spans = [[k] + v for (k, v) in overlaps.items()]
+    for os in overlapping_spans:
+        longest_span = sorted(os, key=lambda x: x[1] - x[0], reverse=True)[0]
+        for match in matches:
+            start, end = match[1], match[2]
+            if (start, end) in os and (start != longest_span[0] or end != longest_span[1]):
+                matches.remove(match)
+
+    return matches
+
+
+def check_properties(n_tests=2000, max_spans=30, max_offset=40):
+    """
+    Check the selector against the brute-force reference on random inputs,
+    and check that the selected spans do not overlap or touch and that every
+    discarded span overlaps or touches a selected span that is at least as
+    long.
+
+    Arguments:
+        - n_tests: int; the number of random inputs.
+        - max_spans: int; the maximum number of spans per input.
+        - max_offset: int; the maximum token offset.
+
+    Return: bool; True if all checks pass, else False.
+    """
+    rng = random.Random(0)
+    for _ in range(n_tests):
+        offsets = []
+        for _ in range(rng.randint(0, max_spans)):
+            start = rng.randint(0, max_offset)
+            offsets.append((start, start + rng.randint(1, 6)))
+
+        selected = select_longest_spans(offsets)
+        if selected != select_longest_spans_reference(offsets):
+            print('-- Error: selection differs from reference for', offsets, file=sys.stderr)
+            return False
+
+        for (n, (s1, e1)) in enumerate(selected):
+            for (s2, e2) in selected[n + 1:]:
+                if s1 <= e2 and s2 <= e1:
+                    print('-- Error: overlapping spans selected for', offsets, file=sys.stderr)
+                    return False
+
+        for (start, end) in offsets:
+            if (start, end) in selected:
+                continue
+            if not any(s <= end and start <= e and e - s >= end - start for (s, e) in selected):
+                print('-- Error: span discarded without a longer overlapping span:', (start, end), offsets, file=sys.stderr)
+                return False
+
+    # adjacent matches, e.g. "self-harm Self-harm:"
+    if select_longest_spans([(3, 4), (4, 5), (6, 7)]) != [(3, 4), (6, 7)]:
+        print('-- Error: touching spans both selected', file=sys.stderr)
+        return False
+
+    print('-- Checked', n_tests, 'random inputs: OK', file=sys.stderr)
+
+    return True
+
+
+def benchmark(n_matches=5000):
+    """
+    Time the selector and the previous quadratic implementation on a long
+    document with many short matches, e.g. a discharge summary with many
+    medication doses ("OD"), plus some longer overlapping matches.
+
+    Arguments:
+        - n_matches: int; the number of single-token matches.
+    """
+    matches = []
+    for n in range(n_matches):
+        matches.append((0, n * 5, n * 5 + 1))
+        if n % 10 == 0:
+            matches.append((0, n * 5, n * 5 + 3))
+
+    t0 = time()
+    select_longest_spans(list(matches), lambda match: (match[1], match[2]))
+    t1 = time()
+    print('-- select_longest_spans :', len(matches), 'matches in', round(t1 - t0, 4), 's', file=sys.stderr)
+
+    t0 = time()
+    select_longest_spans_quadratic(list(matches))
+    t1 = time()
+    print('-- quadratic (previous) :', len(matches), 'matches in', round(t1 - t0, 4), 's', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    ok = check_properties()
+    benchmark()
+    sys.exit(0 if ok else 1)
@@ -18,8 +18,10 @@
 import spacy
 import sys
 
+from attribute_table import get_attribute_names, set_value
 from spacy.matcher import Matcher
 from spacy.tokens import Span
+from span_selector import select_longest_spans
 
 # Ad hoc import selection
 
@@ -42,16 +44,20 @@ class TokenSequenceAnnotator(object):
     according to a set of grammar rules specified in an external file.
     """
     
-    def __init__(self, nlp, name, verbose=True):
+    def __init__(self, nlp, name, precompile=True, verbose=True):
         """
         Create a new TokenSequenceAnnotator instance.
         
         Arguments:
             - nlp: spaCy Language; a spaCy text processing pipeline instance.
             - name: str; the name suffix of the component.
+            - precompile: bool; compile the rules into matchers once, when the
+                          component is created, rather than building a new
+                          matcher for each rule on each document.
             - verbose: bool; print all messages
         """
         self.name = 'token_sequence_annotator_' + name
+        self.rule_set = name
         # using conditional import while waiting to implement a grammar parser
         self.rules = []
         if name == 'test':
@@ -90,7 +96,11 @@ class TokenSequenceAnnotator(object):
         self.nlp = nlp
         self.matcher = None
         self.matches = {}
+        self.precompile = precompile
         self.verbose = verbose
+        self.stages = []
+        if self.precompile:
+            self.compile_rules()
 
     def __call__(self, doc):
         if self.verbose:
@@ -99,6 +109,10 @@ class TokenSequenceAnnotator(object):
         # clear matches - this is required as we initialise this component only
         # once and matches from previous documents need to be erased
         self.matches = {}
+
+        if self.precompile:
+            self.apply_compiled_rules(doc)
+            return doc
         
         for rule in self.rules:
             pattern = rule['pattern']
@@ -157,36 +171,99 @@ class TokenSequenceAnnotator(object):
         # TODO write grammar parser
         pass
 
-    def get_longest_matches(self):
+    def compile_rules(self):
         """
-        Remove all shortest matching overlapping spans.
+        Compile the rules into as few matchers as possible.
+        Rules are applied in order, and a rule may match on custom attributes
+        that are set by a previous rule in the same file. Consecutive rules are
+        grouped into stages so that no rule reads an attribute written by an
+        earlier rule of the same stage. Each stage is matched in a single pass
+        over the document, which gives the same matches as running each rule
+        separately after its predecessors.
         """
+        self.stages = []
+        stage = []
+        written = set()
+        for n, rule in enumerate(self.rules):
+            read = set()
+            for token_spec in rule['pattern']:
+                read.update(token_spec.get('_', {}).keys())
+            if len(stage) > 0 and len(read.intersection(written)) > 0:
+                self.stages.append(stage)
+                stage = []
+                written = set()
+            stage.append(n)
+            for new_annotations in rule['avm'].values():
+                written.update(new_annotations.keys())
+        if len(stage) > 0:
+            self.stages.append(stage)
+
+        # one matcher per stage; each rule gets a unique key as rule names are
+        # not unique within a rule file
+        compiled_stages = []
+        for stage in self.stages:
+            matcher = Matcher(self.nlp.vocab)
+            keys = []
+            for n in stage:
+                rule = self.rules[n]
+                key = self.name + '_' + str(n) + '_' + rule['name']
+                matcher.add(key, None, rule['pattern'])
+                keys.append(self.nlp.vocab.strings[key])
+            compiled_stages.append((matcher, stage, keys))
+        self.stages = compiled_stages
 
-        def get_overlapping_spans(spans):
-            """ Get a unique list of all overlapping span offsets """
-            offsets = spans.keys()
-            overlaps = {}
-            for offset in offsets:
-                o = [(i[0], i[1]) for i in offsets if
-                     i[0] >= offset[0] and i[0] <= offset[1] or i[1] >= offset[0] and i[1] <= offset[1] if
-                     (i[0], i[1]) != offset and (i[0], i[1]) and (i[0], i[1]) not in overlaps]
-                if len(o) > 0:
-                    overlaps[offset] = o
+        if self.verbose:
+            print('  -- Compiled ' + str(len(self.rules)) + ' rules into ' + str(len(self.stages)) + ' matchers.', file=sys.stderr)
 
-            return [[k] + v for (k, v) in overlaps.items()]
+    def apply_compiled_rules(self, doc):
+        """
+        Match each compiled stage once and add annotations in rule order.
+        
+        Arguments:
+            - doc: spaCy Doc; the current spaCy document object.
+        """
+        for (matcher, stage, keys) in self.stages:
+            stage_matches = {}
+            for (key, start, end) in matcher(doc):
+                stage_matches.setdefault(key, []).append((start, end))
+
+            for (n, key) in zip(stage, keys):
+                rule = self.rules[n]
+                name = rule['name']
+                avm = rule['avm']
+                merge = rule.get('merge', False)
+                match_id = self.nlp.vocab.strings[name]
+                matches = [(match_id, start, end) for (start, end) in stage_matches.get(key, [])]
+
+                # store all matched spans for subsequent merging
+                spans = {}
+                for match in matches:
+                    start = match[1]
+                    end = match[2]
+                    span = Span(doc, start, end)  # store offsets for longest match selection
+                    spans[(start, end)] = span
+
+                if len(spans) > 0:
+                    self.matches[name] = [matches, spans, merge]
+                self.add_annotation(doc, matches, name, avm)
+
+                if self.verbose:
+                    print('  -- Rule ' + name + ': ' + str(len(matches)) + ' matches.', file=sys.stderr)
+
+    def get_longest_matches(self):
+        """
+        Remove all shortest matching overlapping spans.
+        """
 
         rule_names = self.matches.keys()
         for rule_name in rule_names:
             match = self.matches[rule_name]
             all_spans = match[1]
-            overlapping_spans = get_overlapping_spans(all_spans)
-            for os in overlapping_spans:
-                shortest_spans = sorted(os, key=lambda x: x[1] - x[0], reverse=True)[1:]
-                # pop shortest spans
-                for ss in shortest_spans:
-                    # avoid trying to remove a span more than once
-                    if ss in all_spans:
-                        all_spans.pop(ss)
+            longest_spans = set(select_longest_spans(list(all_spans.keys())))
+            # pop shortest spans
+            for offsets in list(all_spans.keys()):
+                if offsets not in longest_spans:
+                    all_spans.pop(offsets)
 
     def add_annotation(self, doc, matches, rule_name, rule_avm):
         """
@@ -211,24 +288,22 @@ class TokenSequenceAnnotator(object):
             new_annotations = rule_avm.get('ALL', None)
             if new_annotations is not None:
                 for new_attr in new_annotations:
-                    for j in range(len(span)):
-                        token = span[j]
-                        val = new_annotations[new_attr]
-                        if new_attr in DEFAULT_ATTRIBUTES:
+                    val = new_annotations[new_attr]
+                    if new_attr in DEFAULT_ATTRIBUTES:
+                        for j in range(len(span)):
                             print('  -- Warning: cannot modify built-in attribute', new_attr, ' in rule', rule_name, file=sys.stderr)
-                        else:
-                            token._.set(new_attr, val)
+                    else:
+                        set_value(doc, new_attr, start, end, val)
             else:
                 new_annotations = rule_avm.get('LAST', None)
 
                 if new_annotations is not None:
                     for new_attr in new_annotations:
-                        token = span[len(span) - 1]
                         val = new_annotations[new_attr]
                         if new_attr in DEFAULT_ATTRIBUTES:
                             print('  -- Warning: cannot modify built-in attribute', new_attr, ' in rule', rule_name,  file=sys.stderr)
                         else:
-                            token._.set(new_attr, val)
+                            set_value(doc, new_attr, end - 1, end, val)
 
                 # Now annotate token-by-token according to rule (for rules with LAST and integers)
                 int_keys = [key for key in rule_avm.keys() if isinstance(key, int)]
@@ -239,12 +314,11 @@ class TokenSequenceAnnotator(object):
                             new_annotations = rule_avm.get(j, None)
                             if new_annotations is not None:
                                 for new_attr in new_annotations:
-                                    token = span[j]
                                     val = new_annotations[new_attr]
                                     if new_attr in DEFAULT_ATTRIBUTES:
                                         print('  -- Warning: cannot modify built-in attribute', new_attr, ' in rule', rule_name,  file=sys.stderr)
                                     else:
-                                        token._.set(new_attr, val)
+                                        set_value(doc, new_attr, start + j, start + j + 1, val)
 
     def print_spans(self, doc):
         """
@@ -256,11 +330,7 @@ class TokenSequenceAnnotator(object):
         s = '\n'
         s += '{:<10}{:<10}{:<10}{:<10}{:<10}'.format('INDEX', 'WORD', 'LEMMA', 'POS1', 'POS2')
 
-        cext = set()        
-        for a in doc.user_data:
-            cext.add(a[1])
-
-        cext = sorted(cext)
+        cext = get_attribute_names(doc)
 
         for a in cext:
             s += '{:<10}'.format(a)